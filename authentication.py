@@ -1,75 +1,154 @@
-import re
-from passlib.context import CryptContext
 from fastapi import HTTPException, status
 import jwt
 
-from models import User
+from tortoise.signals import post_save, post_delete
+from tortoise import BaseDBAsyncClient
+from tortoise.exceptions import DoesNotExist
+from functools import lru_cache
+from typing import Any, Dict, List, NamedTuple, Optional, Type
+
+from models import Business, User
 from config import get_settings
+from cache import TTLCache
+from tokens import ACCESS, REFRESH, VERIFY_EMAIL, encode, decode, get_revocations
+from state import get_state
+from workers import WorkerPool
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+@lru_cache()
+def pwd_context():
+    '''passlib and bcrypt load on the first hash, not at import'''
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-def get_hashed_password(password):
-    return pwd_context.hash(password)
 
+# user id -> User, for the endpoints that need more than the token claims
+user_cache = TTLCache(maxsize=get_settings().USER_CACHE_SIZE,
+                      ttl=get_settings().USER_CACHE_TTL)
 
-async def very_token(token: str):
-    '''verify token from login'''
-    try:
-        payload = jwt.decode(token, get_settings().SECRET,
-                             algorithms=["HS256"])
-        user = await User.get(id=payload.get("id"))
 
-    except:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid Token",
-            headers={"WWW-Authenticate": "Bearer"}
-        )
-    return await user
+# every bcrypt hash/verify costs ~250ms of CPU
+hash_pool = WorkerPool("bcrypt",
+                       workers=get_settings().HASH_WORKERS,
+                       max_pending=get_settings().HASH_MAX_PENDING,
+                       kind=get_settings().HASH_POOL)
+
+
+# module level so ProcessPoolExecutor can pickle them
+def _hash(password: str) -> str:
+    return pwd_context().hash(password)
+
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context().verify(plain_password, hashed_password)
 
 
-async def very_token_email(token: str):
-    '''verify token from email'''
+async def get_hashed_password(password):
+    return await hash_pool.run(_hash, password)
+
+
+def invalid_token(detail: str = "Invalid Token") -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=detail,
+        headers={"WWW-Authenticate": "Bearer"}
+    )
+
+
+class TokenUser(NamedTuple):
+    '''the user an access token was issued to, as of issuing it'''
+    id: int
+    username: str
+    is_verifide: bool
+    business_id: Optional[int]
+
+
+async def very_token(token: str) -> TokenUser:
+    '''verify an access token from the claims alone, no query'''
     try:
-        payload = jwt.decode(token, get_settings().SECRET,
-                             algorithms=["HS256"])
-        user = await User.get(id=payload.get("id"), email=payload.get("email"))
+        claims = decode(token, ACCESS)
+        user = TokenUser(claims["id"], claims["username"],
+                         claims["verified"], claims["business_id"])
+    except (jwt.InvalidTokenError, KeyError):
+        raise invalid_token()
+    if await get_revocations().is_revoked(claims):
+        raise invalid_token()
+    return user
+
+
+async def load_user(user_id: int) -> User:
+    '''the row behind a token, cached; a deleted user gets a 401'''
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await User.get_or_none(id=user_id)
+        if user is None:
+            raise invalid_token()
+        user_cache.set(user.id, user)
+    return user
+
+
+@post_save(User)
+async def forget_saved_user(
+        sender: "Type[User]",
+        instance: User,
+        created: bool,
+        using_db: "Optional[BaseDBAsyncClient]",
+        update_fields: List[str]) -> None:
+    '''password and verification changes go through User.save();
+    queryset .update() calls bypass signals and must await forget_user'''
+    await forget_user(instance.id)
+
+
+@post_delete(User)
+async def forget_deleted_user(
+        sender: "Type[User]",
+        instance: User,
+        using_db: "Optional[BaseDBAsyncClient]") -> None:
+    await forget_user(instance.id)
+
+
+async def forget_user(user_id: int) -> None:
+    '''drop the user from the cache of every worker'''
+    await get_state().publish("forget-user", str(user_id))
 
-    except:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid Token",
-            headers={"WWW-Authenticate": "Bearer"}
-        )
-    return await user
 
-# bug: sam_ple@gma.com:Trye ; sam_p_le@gma.com: False!!
-regex = '^[a-z0-9]+[\._]?[a-z0-9]+[@]\w+[.]\w{2,3}$'
+def _forget_published_user(message: str) -> None:
+    user_cache.invalidate(int(message))
 
 
-def is_not_email(email):
-    """if valid mail: return 'True' \n 
-     ** This is a simple way to do this and is not recommended for a real project ** """
-    if(re.search(regex, email)):
-        return False
-    else:
-        return True
+get_state().subscribe("forget-user", _forget_published_user)
+
+
+async def very_token_email(token: str, purpose: str = VERIFY_EMAIL):
+    '''verify token from email; each one works once'''
+    try:
+        claims = decode(token, purpose)
+        user = await User.get(id=claims["id"], email=claims["email"])
+    except (jwt.InvalidTokenError, KeyError, DoesNotExist):
+        raise invalid_token()
+    if not await get_revocations().revoke(claims):
+        raise invalid_token("Token already used")
+    return user
 
 
 async def verify_password(plain_password, database_hashed_password):
-    return pwd_context.verify(plain_password, database_hashed_password)
+    return await hash_pool.run(_verify, plain_password, database_hashed_password)
 
 
 async def authenticate_user(username: str, password: str):
-    user = await User.get(username=username)
-    if user and verify_password(password, user.password):
+    user = await User.get_or_none(username=username)
+    if user and await verify_password(password, user.password):
         if not user.is_verifide:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Email not verifide",
                 headers={"WWW-Authenticate": "Bearer"}
             )
+        # the plain password is only known here, so upgrade
+        # hashes made with old schemes or rounds on the way in
+        if pwd_context().needs_update(user.password):
+            user.password = await get_hashed_password(password)
+            await user.save(update_fields=["password"])
         return user
     return False
 
@@ -84,9 +163,47 @@ async def token_generator(username: str, password: str):
             headers={"WWW-Authenticate": "Bearer"}
         )
 
-    token_data = {
-        "id": user.id,
-        "username": user.username
-    }
-    token = jwt.encode(token_data, get_settings().SECRET, algorithm="HS256")
-    return token
+    return await issue_tokens(user)
+
+
+async def issue_tokens(user: User) -> Dict[str, Any]:
+    '''a short-lived access token carrying what the endpoints check,
+    and a refresh token that gets a new pair once'''
+    settings = get_settings()
+    business_id = await Business.filter(owner_id=user.id).limit(1).values_list("id", flat=True)
+    access_token = encode(ACCESS, settings.ACCESS_TOKEN_TTL,
+                          id=user.id, username=user.username, verified=user.is_verifide,
+                          business_id=business_id[0] if business_id else None)
+    refresh_token = encode(REFRESH, settings.REFRESH_TOKEN_TTL, id=user.id)
+    return {"access_token": access_token, "refresh_token": refresh_token,
+            "token_type": "bearer", "expires_in": settings.ACCESS_TOKEN_TTL}
+
+
+async def refresh_tokens(refresh_token: str) -> Dict[str, Any]:
+    '''trade a refresh token for a new pair; the old one is revoked, so
+    a stolen copy stops working as soon as either party uses it'''
+    try:
+        claims = decode(refresh_token, REFRESH)
+    except jwt.InvalidTokenError:
+        raise invalid_token()
+    if not await get_revocations().revoke(claims):
+        raise invalid_token("Token already used")
+    # fresh claims, the user may have changed since the last pair
+    user = await User.get_or_none(id=claims["id"])
+    if user is None or not user.is_verifide:
+        raise invalid_token()
+    return await issue_tokens(user)
+
+
+async def revoke_tokens(access_token: str, refresh_token: Optional[str] = None) -> None:
+    '''log out: neither token works any more'''
+    try:
+        claims = [decode(access_token, ACCESS)]
+        if refresh_token:
+            claims.append(decode(refresh_token, REFRESH))
+    except jwt.InvalidTokenError:
+        raise invalid_token()
+    if claims[-1]["id"] != claims[0]["id"]:
+        raise invalid_token()
+    for token_claims in claims:
+        await get_revocations().revoke(token_claims)
@@ -0,0 +1,182 @@
+"""
+shared pieces of the benchmark scripts: the environment the app is
+started with, a throwaway SMTP sink, the uvicorn subprocess and
+latency statistics
+"""
+import asyncio
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Iterator, List, Optional
+
+import httpx
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "benchmark-password"
+SMTP_PORT = 8025
+
+
+def bench_env(db_path: str, workdir: str, **overrides) -> Dict[str, str]:
+    '''settings for a benchmark run; nothing is read from .env'''
+    env = {
+        "MAIL_USERNAME": "bench@bench.local",
+        "MAIL_PASSWORD": "bench",
+        "MAIL_FROM": "bench@bench.local",
+        "MAIL_PORT": str(SMTP_PORT),
+        "MAIL_SERVER": "127.0.0.1",
+        "MAIL_TLS": "False",
+        "MAIL_SSL": "False",
+        "USE_CREDENTIALS": "False",
+        "VALIDATE_CERTS": "False",
+        "SECRET": "benchmark-secret",
+        "SITE_URL": "http://127.0.0.1:8000/",
+        "SITE_NAME": "benchmark-shop",
+        "DB_URL": f"sqlite://{os.path.abspath(db_path)}",
+        "MEDIA_ROOT": os.path.join(workdir, "media"),
+        "UPLOAD_TMP_DIR": os.path.join(workdir, "uploads"),
+        "MEDIA_GC_INTERVAL": "0",
+        # every simulated client shares one IP
+        "RATE_LIMIT_TOKEN": "",
+        "RATE_LIMIT_REGISTER": "",
+        "RATE_LIMIT_UPLOAD": "",
+    }
+    env.update({key: str(value) for key, value in overrides.items()})
+    return env
+
+
+@contextmanager
+def workdir() -> Iterator[str]:
+    '''the app resolves static/ and templates/ against its working directory'''
+    with tempfile.TemporaryDirectory(prefix="bench-") as path:
+        os.makedirs(os.path.join(path, "static"))
+        os.symlink(os.path.join(REPO, "templates"), os.path.join(path, "templates"))
+        yield path
+
+
+class SMTPSink:
+    '''accepts and drops every message, so the outbox has somewhere to send;
+    while `reject` is set every message is refused with that reply'''
+
+    def __init__(self, port: int = SMTP_PORT) -> None:
+        self.port = port
+        self.messages = 0
+        self.reject: Optional[bytes] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def _session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        writer.write(b"220 sink ESMTP\r\n")
+        data = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if data:
+                    if line == b".\r\n":
+                        data = False
+                        if self.reject:
+                            writer.write(self.reject + b"\r\n")
+                        else:
+                            self.messages += 1
+                            writer.write(b"250 OK\r\n")
+                    continue
+                command = line[:4].upper()
+                if command == b"DATA":
+                    data = True
+                    writer.write(b"354 go ahead\r\n")
+                elif command == b"QUIT":
+                    writer.write(b"221 bye\r\n")
+                    break
+                elif command == b"EHLO":
+                    writer.write(b"250-sink\r\n250 8BITMIME\r\n")
+                else:
+                    writer.write(b"250 OK\r\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def __aenter__(self) -> "SMTPSink":
+        self._server = await asyncio.start_server(self._session, "127.0.0.1", self.port)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+
+@asynccontextmanager
+async def server(env: Dict[str, str], cwd: str, port: int = 8000):
+    '''uvicorn running main:app in a subprocess, yields its base url'''
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "--app-dir", REPO, "main:app",
+         "--host", "127.0.0.1", "--port", str(port), "--no-access-log", "--log-level", "warning"],
+        cwd=cwd, env={**os.environ, **env})
+    url = f"http://127.0.0.1:{port}"
+    try:
+        async with httpx.AsyncClient(base_url=url) as client:
+            deadline = time.monotonic() + 120
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f"server exited with {process.returncode}")
+                try:
+                    if (await client.get("/metrics")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise RuntimeError("server did not start")
+                await asyncio.sleep(0.2)
+        yield url
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def make_images(count: int, size=(800, 600), seed: int = 0) -> List[bytes]:
+    '''distinct PNGs, so content-addressed storage can't dedup them away'''
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        image = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(20):
+            x, y = rng.randrange(size[0]), rng.randrange(size[1])
+            draw.rectangle((x, y, x + rng.randrange(200), y + rng.randrange(200)),
+                           fill=tuple(rng.randrange(256) for _ in range(3)))
+        out = io.BytesIO()
+        image.save(out, "PNG")
+        images.append(out.getvalue())
+    return images
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float], statuses: Dict[int, int], elapsed: float) -> Dict:
+    latencies = sorted(latencies)
+    requests = len(latencies)
+    errors = sum(count for status, count in statuses.items() if status >= 400 or status == 0)
+    return {
+        "requests": requests,
+        "errors": errors,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "rps": round(requests / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p90_ms": round(percentile(latencies, 0.90) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
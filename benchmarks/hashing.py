@@ -0,0 +1,57 @@
+"""
+logins per second for each size of the bcrypt pool
+
+    python -m benchmarks.hashing --db bench.sqlite3 --workers 1 2 4 8
+
+restarts the app for every HASH_WORKERS value (and HASH_POOL kind) and
+drives POST /token with twice as many clients as workers, so the pool
+is always saturated.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+
+import httpx
+
+from benchmarks.common import SMTPSink, bench_env, server, workdir
+from benchmarks.loadtest import Context, run_scenario, seeded_counts
+
+
+async def logins_per_second(args, kind: str, workers: int) -> dict:
+    with workdir() as path:
+        db = os.path.join(path, "bench.sqlite3")
+        shutil.copy(args.db, db)
+        env = bench_env(db, path, HASH_POOL=kind, HASH_WORKERS=workers,
+                        HASH_MAX_PENDING=workers * 100)
+        async with SMTPSink(), server(env, path, args.port) as url:
+            async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+                ctx = Context(client, *seeded_counts(args.db), random.Random(args.seed))
+                return await run_scenario(ctx, "token", workers * 2, args.duration)
+
+
+async def main(args) -> None:
+    results = {}
+    for kind in args.pools:
+        for workers in args.workers:
+            result = await logins_per_second(args, kind, workers)
+            results[f"{kind}:{workers}"] = result
+            print(f"{kind:>7} x{workers:<3} {result['rps']:>8} logins/s  "
+                  f"p99 {result['p99_ms']:>8} ms  errors {result['errors']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--db", default="bench.sqlite3", help="made by benchmarks.seed")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 8])
+    parser.add_argument("--pools", nargs="+", choices=("thread", "process"), default=["thread", "process"])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results here as JSON")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,248 @@
+"""
+load test the hot endpoints against a seeded database
+
+    python -m benchmarks.seed --db bench.sqlite3
+    python -m benchmarks.loadtest --db bench.sqlite3 --save-baseline
+    # ... change something ...
+    python -m benchmarks.loadtest --db bench.sqlite3
+
+starts the app with uvicorn on a copy of the database, runs every
+scenario for --duration seconds with --concurrency clients and writes
+p50/p90/p99 latency and requests per second to --output. When a
+baseline exists, a scenario whose p50 or p99 got slower, or whose rps
+dropped, by more than --tolerance fails the run (exit code 1).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import time
+from collections import Counter
+from typing import Callable, Dict, List
+
+import httpx
+
+from benchmarks.common import (PASSWORD, SMTPSink, bench_env, make_images,
+                               server, summarize, workdir)
+
+SCENARIOS = ("token", "register", "products", "product_detail", "create_product", "upload")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+class Context:
+    '''what the scenarios need to know about the seeded data'''
+
+    def __init__(self, client: httpx.AsyncClient, users: int, products: int,
+                 rng: random.Random) -> None:
+        self.client = client
+        self.users = users
+        self.products = products
+        self.rng = rng
+        self.tokens: Dict[int, str] = {}
+        self.images: List[bytes] = []
+
+    async def login(self, user_id: int) -> str:
+        response = await self.client.post(
+            "/token", data={"username": f"user{user_id}", "password": PASSWORD})
+        response.raise_for_status()
+        return response.json()["access_token"]
+
+    def auth(self, user_id: int) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.tokens[user_id]}"}
+
+    def any_user(self) -> int:
+        return self.rng.choice(list(self.tokens))
+
+
+async def scenario_token(ctx: Context) -> httpx.Response:
+    user_id = ctx.rng.randint(1, ctx.users)
+    return await ctx.client.post("/token", data={"username": f"user{user_id}", "password": PASSWORD})
+
+
+registrations = itertools.count(1)
+
+
+async def scenario_register(ctx: Context) -> httpx.Response:
+    n = next(registrations)
+    return await ctx.client.post("/users/", json={
+        "username": f"newuser{n}", "email": f"newuser{n}@bench.local", "password": PASSWORD})
+
+
+class PageWalker:
+    '''follows next_cursor a few pages deep, then starts over'''
+
+    def __init__(self) -> None:
+        self.sort = "newest"
+        self.cursor = None
+        self.depth = 0
+
+    async def __call__(self, ctx: Context) -> httpx.Response:
+        if not self.cursor or self.depth >= 10:
+            self.sort = ctx.rng.choice(("newest", "price_asc", "price_desc"))
+            self.cursor, self.depth = None, 0
+        params = {"limit": 20, "sort": self.sort}
+        if self.cursor:
+            params["cursor"] = self.cursor
+        response = await ctx.client.get("/products", params=params)
+        if response.status_code == 200:
+            self.cursor = response.json()["next_cursor"]
+            self.depth = self.depth + 1 if self.cursor else 0
+        return response
+
+
+async def scenario_product_detail(ctx: Context) -> httpx.Response:
+    return await ctx.client.get(f"/products/{ctx.rng.randint(1, ctx.products)}")
+
+
+async def scenario_create_product(ctx: Context) -> httpx.Response:
+    original = ctx.rng.randrange(100, 100000) / 100
+    return await ctx.client.post("/products/", headers=ctx.auth(ctx.any_user()), json={
+        "name": f"load test product {ctx.rng.randrange(10 ** 6)}", "category": "benchmark",
+        "original_price": original, "new_price": round(original * 0.8, 2),
+        "offer_expiration_date": "2030-01-01"})
+
+
+async def scenario_upload(ctx: Context) -> httpx.Response:
+    user_id = ctx.any_user()
+    # product p belongs to business (p - 1) % users + 1, see seed.py
+    product_id = user_id + ctx.users * ctx.rng.randrange(max(1, ctx.products // ctx.users))
+    image = ctx.images[ctx.rng.randrange(len(ctx.images))]
+    return await ctx.client.post(f"/uploadfile/product/{product_id}", headers=ctx.auth(user_id),
+                                 files={"file": ("bench.png", image, "image/png")})
+
+
+def scenario(name: str) -> Callable[[], Callable]:
+    '''a factory, so stateful scenarios get one state per client'''
+    return {
+        "token": lambda: scenario_token,
+        "register": lambda: scenario_register,
+        "products": PageWalker,
+        "product_detail": lambda: scenario_product_detail,
+        "create_product": lambda: scenario_create_product,
+        "upload": lambda: scenario_upload,
+    }[name]
+
+
+async def run_scenario(ctx: Context, name: str, concurrency: int, duration: float) -> Dict:
+    make = scenario(name)
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    deadline = time.perf_counter() + duration
+
+    async def client_loop() -> None:
+        request = make()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                status = (await request(ctx)).status_code
+            except httpx.HTTPError:
+                status = 0
+            latencies.append(time.perf_counter() - start)
+            statuses[status] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    return summarize(latencies, statuses, time.perf_counter() - started)
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    regressions = []
+    for name, result in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        for key in ("p50_ms", "p99_ms"):
+            if base[key] and result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {base[key]} -> {result[key]}")
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: rps {base['rps']} -> {result['rps']}")
+        base_error_rate = base["errors"] / max(1, base["requests"])
+        error_rate = result["errors"] / max(1, result["requests"])
+        if error_rate > base_error_rate + 0.01:
+            regressions.append(f"{name}: error rate {base_error_rate:.1%} -> {error_rate:.1%}")
+    return regressions
+
+
+async def load_test(args) -> Dict:
+    rng = random.Random(args.seed)
+    with workdir() as path:
+        # work on a copy, create_product and upload write to it
+        db = os.path.join(path, "bench.sqlite3")
+        shutil.copy(args.db, db)
+        overrides = dict(arg.split("=", 1) for arg in args.env)
+        env = bench_env(db, path, **overrides)
+        async with SMTPSink(), server(env, path, args.port) as url:
+            limits = httpx.Limits(max_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+                ctx = Context(client, *seeded_counts(args.db), rng)
+                for user_id in rng.sample(range(1, ctx.users + 1), min(ctx.users, args.concurrency)):
+                    ctx.tokens[user_id] = await ctx.login(user_id)
+                if "upload" in args.scenarios:
+                    ctx.images = make_images(args.images, seed=args.seed)
+
+                results = {"config": {"concurrency": args.concurrency, "duration": args.duration,
+                                      "users": ctx.users, "products": ctx.products, "env": overrides},
+                           "scenarios": {}}
+                for name in args.scenarios:
+                    result = await run_scenario(ctx, name, args.concurrency, args.duration)
+                    results["scenarios"][name] = result
+                    print(f"{name:>15}: {result['rps']:>8} rps  p50 {result['p50_ms']:>8} ms  "
+                          f"p99 {result['p99_ms']:>8} ms  errors {result['errors']}", file=sys.stderr)
+    return results
+
+
+def seeded_counts(db_path: str):
+    import sqlite3
+
+    with sqlite3.connect(db_path) as db:
+        users = db.execute('SELECT COUNT(*) FROM "user"').fetchone()[0]
+        products = db.execute('SELECT MAX("id") FROM "product"').fetchone()[0] or 0
+    return users, products
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--db", default="bench.sqlite3", help="made by benchmarks.seed")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20, help="seconds per scenario")
+    parser.add_argument("--images", type=int, default=50, help="distinct upload fixtures")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", nargs="*", default=[], metavar="SETTING=VALUE",
+                        help="extra app settings, e.g. HASH_WORKERS=4")
+    parser.add_argument("--output", help="write the results here as JSON")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown as a fraction of the baseline")
+    args = parser.parse_args()
+
+    results = asyncio.run(load_test(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(output + "\n")
+        print(f"baseline saved to {args.baseline}", file=sys.stderr)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("regressions against the baseline:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+        print("no regressions against the baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+many buyers, one product: checkout must never sell more than the stock
+
+    python -m benchmarks.oversell --buyers 500 --stock 100
+
+seeds a fresh database, starts the app with uvicorn and has every buyer
+POST /orders for the same product at once, each one twice with the same
+Idempotency-Key (a client retrying). Exits with 1 unless exactly
+--stock orders were placed, no buyer got two and the stock ended at 0.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import time
+import uuid
+from collections import Counter
+
+import httpx
+
+from benchmarks.common import SMTPSink, bench_env, server, summarize, workdir
+
+PRODUCT_ID = 1
+
+
+async def prepare(buyers: int, stock: int) -> None:
+    from tortoise import Tortoise
+
+    from database import migrate, tortoise_config
+    from benchmarks.seed import seed
+
+    await Tortoise.init(config=tortoise_config())
+    try:
+        await migrate()
+        await seed(buyers, 10, random.Random(1))
+        await Tortoise.get_connection("default").execute_query(
+            'INSERT INTO "inventory" ("product_id", "stock") VALUES (?, ?)', [PRODUCT_ID, stock])
+    finally:
+        await Tortoise.close_connections()
+
+
+async def buy(client: httpx.AsyncClient, env: dict, user_id: int, attempts: int):
+    # minted directly, logging 500 users in would only benchmark bcrypt
+    from tokens import ACCESS, encode
+    token = encode(ACCESS, 3600, id=user_id, username=f"user{user_id}", verified=True, business_id=None)
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": uuid.uuid4().hex}
+    body = {"items": [{"product_id": PRODUCT_ID, "quantity": 1}]}
+
+    async def attempt():
+        start = time.perf_counter()
+        try:
+            status = (await client.post("/orders", headers=headers, json=body)).status_code
+        except httpx.HTTPError:
+            status = 0
+        return status, time.perf_counter() - start
+
+    return await asyncio.gather(*(attempt() for _ in range(attempts)))
+
+
+async def run(args, env: dict, path: str) -> Counter:
+    async with SMTPSink(), server(env, path, args.port) as url:
+        limits = httpx.Limits(max_connections=args.buyers * args.attempts)
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+            started = time.perf_counter()
+            results = await asyncio.gather(*(buy(client, env, user_id, args.attempts)
+                                             for user_id in range(1, args.buyers + 1)))
+            elapsed = time.perf_counter() - started
+    statuses = Counter(status for attempts in results for status, _ in attempts)
+    latencies = [latency for attempts in results for _, latency in attempts]
+    summary = summarize(latencies, statuses, elapsed)
+    print(f"{summary['requests']} checkouts in {elapsed:.1f}s, p50 {summary['p50_ms']} ms, "
+          f"p99 {summary['p99_ms']} ms, statuses {summary['statuses']}")
+    return statuses
+
+
+def check(db_path: str, args, statuses: Counter) -> list:
+    with sqlite3.connect(db_path) as db:
+        stock = db.execute('SELECT "stock" FROM "inventory" WHERE "product_id" = ?',
+                           [PRODUCT_ID]).fetchone()[0]
+        sold = db.execute('SELECT COALESCE(SUM("quantity"), 0) FROM "orderitem" WHERE "product_id" = ?',
+                          [PRODUCT_ID]).fetchone()[0]
+        orders = db.execute('SELECT COUNT(*) FROM "order"').fetchone()[0]
+        repeat_buyers = db.execute('SELECT COUNT(*) FROM (SELECT "user_id" FROM "order" '
+                                   'GROUP BY "user_id" HAVING COUNT(*) > 1)').fetchone()[0]
+    expected = min(args.stock, args.buyers)
+    problems = []
+    if sold != expected or orders != expected:
+        problems.append(f"sold {sold} in {orders} orders, expected {expected}")
+    if stock != args.stock - expected:
+        problems.append(f"stock ended at {stock}, expected {args.stock - expected}")
+    if repeat_buyers:
+        problems.append(f"{repeat_buyers} buyers got more than one order")
+    unexpected = {status: count for status, count in statuses.items()
+                  if status not in (200, 201, 409)}
+    if unexpected:
+        problems.append(f"unexpected responses {unexpected}")
+    print(f"sold {sold} of {args.stock}, {stock} left, {orders} orders")
+    return problems
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--buyers", type=int, default=500)
+    parser.add_argument("--stock", type=int, default=100)
+    parser.add_argument("--attempts", type=int, default=2, help="requests per buyer, same key")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--env", nargs="*", default=[], metavar="SETTING=VALUE",
+                        help="extra app settings")
+    args = parser.parse_args()
+
+    with workdir() as path:
+        db = os.path.join(path, "oversell.sqlite3")
+        env = bench_env(db, path, **dict(arg.split("=", 1) for arg in args.env))
+        os.environ.update(env)
+        asyncio.run(prepare(args.buyers, args.stock))
+        statuses = asyncio.run(run(args, env, path))
+        problems = check(db, args, statuses)
+    if problems:
+        print("OVERSOLD:\n  " + "\n  ".join(problems))
+        sys.exit(1)
+    print("no overselling")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+build a benchmark database
+
+    python -m benchmarks.seed --db bench.sqlite3 --users 100000 --products 1000000
+
+every user is verified, has the password benchmarks.common.PASSWORD
+and owns the business with its own id; products are spread evenly over
+the businesses (product p belongs to business (p - 1) % users + 1).
+The data is the same for the same --seed.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.common import PASSWORD, bench_env
+
+BATCH = 10000
+CATEGORIES = ["laptops", "phones", "tablets", "cameras", "audio", "tv", "gaming",
+              "books", "kitchen", "garden", "tools", "toys", "sports", "fashion",
+              "shoes", "beauty", "health", "pets", "office", "music", "auto",
+              "baby", "food", "drinks", "furniture", "lighting", "bags",
+              "watches", "jewelry", "outdoor"]
+ADJECTIVES = ["red", "blue", "smart", "classic", "pro", "mini", "ultra", "eco",
+              "wireless", "compact", "deluxe", "portable", "vintage", "silent"]
+NOUNS = ["laptop", "phone", "speaker", "lamp", "chair", "backpack", "camera",
+         "watch", "kettle", "drill", "guitar", "monitor", "sneaker", "jacket"]
+
+
+async def seed(users: int, products: int, rng: random.Random) -> None:
+    from tortoise import Tortoise
+    from tortoise.transactions import in_transaction
+
+    from authentication import pwd_context
+    from search import FTS5Backend, get_search_backend
+
+    connection = Tortoise.get_connection("default")
+    # the search index (created by the migrations) is filled in one
+    # statement at the end
+    backend = get_search_backend()
+    # bcrypt'ing 100k passwords would take hours; they all share one hash
+    password = pwd_context().hash(PASSWORD)
+    now = datetime.utcnow()
+
+    for start in range(1, users + 1, BATCH):
+        ids = range(start, min(start + BATCH, users + 1))
+        async with in_transaction() as transaction:
+            await transaction.execute_many(
+                'INSERT INTO "user" ("id", "username", "email", "password", "is_verifide", "join_date") '
+                "VALUES (?, ?, ?, ?, 1, ?)",
+                [[i, f"user{i}", f"user{i}@bench.local", password,
+                  str(now - timedelta(days=rng.randrange(1000)))] for i in ids])
+            await transaction.execute_many(
+                'INSERT INTO "business" ("id", "business_name", "city", "region", "owner_id") '
+                "VALUES (?, ?, 'Unspecified', 'Unspecified', ?)",
+                [[i, f"business{i}", i] for i in ids])
+
+    for start in range(1, products + 1, BATCH):
+        rows = []
+        for i in range(start, min(start + BATCH, products + 1)):
+            original = rng.randrange(100, 500000) / 100
+            new = round(original * rng.uniform(0.3, 1.0), 2)
+            rows.append([
+                i, f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {i}", rng.choice(CATEGORIES),
+                f"{original:.2f}", f"{new:.2f}", int((original - new) / original * 100),
+                str((now + timedelta(days=rng.randrange(1, 365))).date()),
+                str(now - timedelta(seconds=rng.randrange(365 * 24 * 3600))),
+                (i - 1) % users + 1])
+        async with in_transaction() as transaction:
+            await transaction.execute_many(
+                'INSERT INTO "product" ("id", "name", "category", "original_price", "new_price", '
+                '"percentage_discount", "offer_expiration_date", "date_published", "business_id") '
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    if isinstance(backend, FTS5Backend):
+        await connection.execute_script(
+            'INSERT INTO "product_fts" (rowid, name, category) '
+            'SELECT "id", "name", "category" FROM "product"')
+    await connection.execute_script("ANALYZE")
+
+
+async def main(args) -> None:
+    if os.path.exists(args.db):
+        raise SystemExit(f"{args.db} exists, remove it first")
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ.update(bench_env(args.db, workdir))
+
+        from tortoise import Tortoise
+        from database import migrate, tortoise_config
+
+        started = time.perf_counter()
+        await Tortoise.init(config=tortoise_config())
+        try:
+            await migrate()
+            await seed(args.users, args.products, random.Random(args.seed))
+        finally:
+            await Tortoise.close_connections()
+    print(f"seeded {args.users} users and {args.products} products into {args.db} "
+          f"in {time.perf_counter() - started:.0f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--db", default="bench.sqlite3")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--products", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
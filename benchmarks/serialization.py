@@ -0,0 +1,99 @@
+"""
+pages of 100 products per second, default vs fast serialization
+
+    python -m benchmarks.serialization --db bench.sqlite3
+
+restarts the app with FAST_SERIALIZATION off and on, with the response
+cache off so every request builds its page, and has --concurrency
+clients walk GET /products?limit=100 (newest first, following
+next_cursor a few pages deep) and GET /products/{id}.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import time
+from collections import Counter
+from typing import Dict, List
+
+import httpx
+
+from benchmarks.common import SMTPSink, bench_env, server, summarize, workdir
+from benchmarks.loadtest import seeded_counts
+
+MODES = {"default": "False", "fast": "True"}
+
+
+async def walk_pages(client: httpx.AsyncClient, rng: random.Random, products: int,
+                     path: str, deadline: float, latencies: List[float], statuses: Counter) -> None:
+    cursor, depth = None, 0
+    while time.perf_counter() < deadline:
+        if path == "detail":
+            request = client.get(f"/products/{rng.randint(1, products)}")
+        else:
+            params = {"limit": 100}
+            if cursor and depth < 10:
+                params["cursor"] = cursor
+            else:
+                depth = 0
+            request = client.get("/products", params=params)
+        start = time.perf_counter()
+        try:
+            response = await request
+            status = response.status_code
+        except httpx.HTTPError:
+            status = 0
+        latencies.append(time.perf_counter() - start)
+        statuses[status] += 1
+        if path == "list" and status == 200:
+            cursor, depth = response.json()["next_cursor"], depth + 1
+
+
+async def measure(args, mode: str, path: str) -> Dict:
+    with workdir() as tmp:
+        db = os.path.join(tmp, "bench.sqlite3")
+        shutil.copy(args.db, db)
+        env = bench_env(db, tmp, FAST_SERIALIZATION=MODES[mode], RESPONSE_CACHE_SIZE=0)
+        async with SMTPSink(), server(env, tmp, args.port) as url:
+            limits = httpx.Limits(max_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+                _, products = seeded_counts(args.db)
+                rng = random.Random(args.seed)
+                latencies: List[float] = []
+                statuses: Counter = Counter()
+                started = time.perf_counter()
+                deadline = started + args.duration
+                await asyncio.gather(*(walk_pages(client, rng, products, path, deadline,
+                                                  latencies, statuses)
+                                       for _ in range(args.concurrency)))
+                return summarize(latencies, statuses, time.perf_counter() - started)
+
+
+async def main(args) -> None:
+    results = {}
+    for path in args.paths:
+        for mode in MODES:
+            result = await measure(args, mode, path)
+            results[f"{path}:{mode}"] = result
+            print(f"{path:>6} {mode:>7} {result['rps']:>8} rps  p50 {result['p50_ms']:>8} ms  "
+                  f"p99 {result['p99_ms']:>8} ms  errors {result['errors']}")
+        default, fast = results[f"{path}:default"]["rps"], results[f"{path}:fast"]["rps"]
+        if default:
+            print(f"{path:>6} fast is {fast / default:.2f}x the default throughput")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--db", default="bench.sqlite3", help="made by benchmarks.seed")
+    parser.add_argument("--paths", nargs="+", choices=("list", "detail"), default=["list", "detail"])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results here as JSON")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,113 @@
+"""
+how long a fresh worker takes to become ready
+
+    python -m benchmarks.startup --db bench.sqlite3 --runs 10
+
+starts uvicorn --runs times on a copy of the database and times each
+from spawning the process to the first 200 from GET /health/ready (the
+check a load balancer or autoscaler waits for), then imports main in a
+fresh interpreter with -X importtime and lists the packages whose
+modules took the longest to import (their own time, summed).
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import httpx
+
+from benchmarks.common import REPO, SMTPSink, bench_env, percentile, workdir
+
+
+async def time_to_ready(env: Dict[str, str], cwd: str, port: int) -> float:
+    '''seconds from spawning uvicorn to its first ready answer'''
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "--app-dir", REPO, "main:app",
+         "--host", "127.0.0.1", "--port", str(port), "--no-access-log", "--log-level", "warning"],
+        cwd=cwd, env={**os.environ, **env})
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f"server exited with {process.returncode}")
+                try:
+                    if (await client.get("/health/ready")).status_code == 200:
+                        return time.perf_counter() - start
+                except httpx.TransportError:
+                    pass
+                if time.perf_counter() - start > 120:
+                    raise RuntimeError("server did not become ready")
+                await asyncio.sleep(0.01)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def import_times(env: Dict[str, str], cwd: str) -> Tuple[float, List[Tuple[str, float]]]:
+    '''seconds to import main, and (top-level package, seconds) for
+    everything imported along the way, slowest first'''
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         "import time; start = time.perf_counter(); import main; "
+         "print(time.perf_counter() - start)"],
+        cwd=cwd, env={**os.environ, **env, "PYTHONPATH": REPO},
+        capture_output=True, text=True, check=True)
+    packages: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, _, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(own) / 1e6
+    return (float(result.stdout.strip().splitlines()[-1]),
+            sorted(packages.items(), key=lambda package: -package[1]))
+
+
+async def main(args) -> None:
+    with workdir() as tmp:
+        db = os.path.join(tmp, "bench.sqlite3")
+        shutil.copy(args.db, db)
+        env = bench_env(db, tmp, **dict(item.split("=", 1) for item in args.env))
+        async with SMTPSink():
+            # the first start fills what the later ones find ready
+            await time_to_ready(env, tmp, args.port)
+            runs = sorted([await time_to_ready(env, tmp, args.port) for _ in range(args.runs)])
+        imported, packages = import_times(env, tmp)
+
+    result = {
+        "runs": args.runs,
+        "ready_p50_ms": round(percentile(runs, 0.5) * 1000, 1),
+        "ready_min_ms": round(runs[0] * 1000, 1),
+        "ready_max_ms": round(runs[-1] * 1000, 1),
+        "import_main_ms": round(imported * 1000, 1),
+        "slowest_imports": [{"package": name, "ms": round(seconds * 1000, 1)}
+                            for name, seconds in packages[:args.top]],
+    }
+    print(f"ready after  p50 {result['ready_p50_ms']} ms  min {result['ready_min_ms']} ms  "
+          f"max {result['ready_max_ms']} ms  ({args.runs} starts)")
+    print(f"import main  {result['import_main_ms']} ms")
+    for package in result["slowest_imports"]:
+        print(f"  {package['ms']:>8} ms  {package['package']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--db", default="bench.sqlite3", help="made by benchmarks.seed")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15, help="slowest packages to list")
+    parser.add_argument("--env", nargs="*", default=[], help="extra settings, KEY=VALUE")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--output", help="write the results here as JSON")
+    asyncio.run(main(parser.parse_args()))
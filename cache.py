@@ -0,0 +1,179 @@
+"""
+in-process caches and the public catalogue response cache
+"""
+import hashlib
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Hashable, List, Optional, Type
+from urllib.parse import urlencode
+
+from fastapi import Request, Response
+from tortoise import BaseDBAsyncClient, Model
+from tortoise.signals import post_delete, post_save
+
+from models import Business, Product, User
+from config import get_settings
+from serialization import get_dumps
+
+
+class TTLCache:
+    '''LRU-bounded mapping whose entries expire `ttl` seconds after being set'''
+
+    def __init__(self, maxsize: int, ttl: float,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= self.clock():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (self.clock() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class MemoryBackend:
+    '''per-process response store; only correct with a single worker'''
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._version = 0
+
+    async def version(self) -> int:
+        return self._version
+
+    async def bump(self) -> None:
+        self._version += 1
+        self.entries.clear()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.entries.get(key)
+
+    async def set(self, key: str, value: bytes) -> None:
+        self.entries.set(key, value)
+
+
+class RedisBackend:
+    '''shared by every worker; a version counter in redis namespaces
+    the keys, so one INCR invalidates every cached response at once'''
+
+    def __init__(self, redis, ttl: int, prefix: str = "response-cache:") -> None:
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def version(self) -> int:
+        return int(await self.redis.get(self.prefix + "version") or 0)
+
+    async def bump(self) -> None:
+        await self.redis.incr(self.prefix + "version")
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.redis.get(self.prefix + key)
+
+    async def set(self, key: str, value: bytes) -> None:
+        await self.redis.set(self.prefix + key, value, ex=self.ttl)
+
+
+class ResponseCache:
+    '''caches rendered JSON bodies of public catalogue reads
+
+    every entry is keyed by the catalogue version, and invalidate()
+    bumps it from the Product/Business/User save and delete signals,
+    so a read after a write never sees the old body'''
+
+    def __init__(self, backend) -> None:
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(request: Request) -> str:
+        query = urlencode(sorted(request.query_params.multi_items()))
+        return f"{request.url.path}?{query}"
+
+    async def invalidate(self) -> None:
+        await self.backend.bump()
+
+    async def respond(self, request: Request,
+                      build: Callable[[], Awaitable[Any]]) -> Response:
+        '''serve the cached body for this request, or `build()` it and cache it;
+        answers If-None-Match with 304'''
+        key = f"{await self.backend.version()}:{self.key_for(request)}"
+        entry = await self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+            body = get_dumps()(await build())
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'.encode()
+            entry = etag + b"\n" + body
+            await self.backend.set(key, entry)
+        else:
+            self.hits += 1
+
+        etag, body = entry.split(b"\n", 1)
+        headers = {"ETag": etag.decode(), "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type="application/json", headers=headers)
+
+
+@lru_cache()
+def get_redis():
+    import aioredis
+    return aioredis.from_url(get_settings().REDIS_URL)
+
+
+@lru_cache()
+def get_response_cache() -> ResponseCache:
+    settings = get_settings()
+    if settings.backend("CACHE_BACKEND") == "redis":
+        return ResponseCache(RedisBackend(get_redis(), ttl=settings.RESPONSE_CACHE_TTL))
+    return ResponseCache(MemoryBackend(maxsize=settings.RESPONSE_CACHE_SIZE,
+                                       ttl=settings.RESPONSE_CACHE_TTL))
+
+
+@post_save(Product, Business, User)
+async def invalidate_saved(
+        sender: "Type[Model]",
+        instance: Model,
+        created: bool,
+        using_db: "Optional[BaseDBAsyncClient]",
+        update_fields: List[str]) -> None:
+    # a new user has no business yet, nothing public changed
+    if sender is User and created:
+        return
+    await get_response_cache().invalidate()
+
+
+@post_delete(Product, Business, User)
+async def invalidate_deleted(
+        sender: "Type[Model]",
+        instance: Model,
+        using_db: "Optional[BaseDBAsyncClient]") -> None:
+    await get_response_cache().invalidate()
@@ -0,0 +1,254 @@
+"""
+bulk product import and export
+
+imports are read from the request body a line at a time (NDJSON or
+CSV), validated row by row and inserted BULK_BATCH_SIZE rows per
+transaction with bulk_create; a bad row is reported and skipped, it
+doesn't fail the rest of the file. Exports page through the catalogue
+by id and stream each page as soon as it is read.
+"""
+import codecs
+import csv
+import io
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from pydantic import ValidationError
+from tortoise import BaseDBAsyncClient
+from tortoise.exceptions import BaseORMException
+
+from models import Product, product_pydanticIn
+from config import get_settings
+from cache import get_response_cache
+from search import get_search_backend
+from deals import refresh_categories
+from changes import CREATE, atomic, record
+
+IMPORT_FIELDS = ("name", "category", "original_price", "new_price", "offer_expiration_date")
+EXPORT_FIELDS = ("id", "name", "category", "original_price", "new_price",
+                 "percentage_discount", "offer_expiration_date", "product_image",
+                 "date_published")
+MAX_REPORTED_ERRORS = 1000
+EXPORT_PAGE_SIZE = 1000
+
+# (line number, parsed row or None, error or None)
+Row = Tuple[int, Optional[Dict[str, Any]], Optional[str]]
+
+
+async def lines(stream: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    buffer = ""
+    async for chunk in stream:
+        buffer += decoder.decode(chunk)
+        *complete, buffer = buffer.split("\n")
+        for line in complete:
+            yield line
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+
+async def ndjson_rows(stream: AsyncIterator[bytes]) -> AsyncIterator[Row]:
+    number = 0
+    async for line in lines(stream):
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            # Decimal, not float: 19.99 must stay 19.99
+            row = json.loads(line, parse_float=Decimal)
+        except ValueError as e:
+            yield number, None, f"invalid JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield number, None, "expected a JSON object"
+            continue
+        yield number, row, None
+
+
+async def csv_rows(stream: AsyncIterator[bytes]) -> AsyncIterator[Row]:
+    '''the first record is the header; quoted fields may span lines'''
+    header = None
+    number = start = 0
+    record: List[str] = []
+    async for line in lines(stream):
+        number += 1
+        if not record:
+            start = number
+        record.append(line)
+        text = "\n".join(record)
+        if text.count('"') % 2:
+            continue  # inside a quoted field
+        record = []
+        if not text.strip():
+            continue
+        try:
+            values = next(csv.reader([text]))
+        except csv.Error as e:
+            yield start, None, f"invalid CSV: {e}"
+            continue
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        if len(values) != len(header):
+            yield start, None, f"expected {len(header)} columns, got {len(values)}"
+            continue
+        yield start, dict(zip(header, values)), None
+    if record:
+        yield start, None, "unterminated quoted field"
+
+
+def validate(row: Dict[str, Any]):
+    '''a product_pydanticIn, or raises ValueError / ValidationError'''
+    # unknown columns (e.g. the id of an export) are ignored, empty ones
+    # fall back to the model default
+    product = product_pydanticIn.parse_obj(
+        {field: row[field] for field in IMPORT_FIELDS if row.get(field) not in (None, "")})
+    if product.original_price <= 0:
+        raise ValueError("original_price: the original price must be greater than 0")
+    return product
+
+
+def error_messages(error: Exception) -> List[str]:
+    if isinstance(error, ValidationError):
+        return [f"{'.'.join(str(part) for part in e['loc'])}: {e['msg']}"
+                for e in error.errors()]
+    return [str(error)]
+
+
+def percentage_discounts(original_prices: List[Decimal], new_prices: List[Decimal]) -> List[int]:
+    '''one pass over the price columns of a whole batch'''
+    return [int((original - new) / original * 100)
+            for original, new in zip(original_prices, new_prices)]
+
+
+class ImportReport:
+
+    def __init__(self) -> None:
+        self.created = 0
+        self.failed = 0
+        self.errors: List[Dict[str, Any]] = []
+
+    def fail(self, line: int, messages: List[str]) -> None:
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "errors": messages})
+
+    def dict(self) -> Dict[str, Any]:
+        return {"created": self.created, "failed": self.failed, "errors": self.errors}
+
+
+async def insert_batch(business_id: int, batch: List[Tuple[int, Any]],
+                       report: ImportReport) -> List[Product]:
+    '''the products inserted, with their ids; none if the batch failed'''
+    products = [product.dict(exclude_unset=True) for _, product in batch]
+    discounts = percentage_discounts([product["original_price"] for product in products],
+                                     [product["new_price"] for product in products])
+    try:
+        async with atomic() as connection:
+            postgres = connection.capabilities.dialect == "postgres"
+            if postgres:
+                ids = await reserve_product_ids(connection, len(products))
+                for product, id in zip(products, ids):
+                    product["id"] = id
+            objects = [Product(**product, percentage_discount=discount, business_id=business_id)
+                       for product, discount in zip(products, discounts)]
+            await Product.bulk_create(objects, using_db=connection)
+            if not postgres:
+                await assign_inserted_ids(connection, objects)
+            # bulk_create fires no signals, do what they would have done
+            await record(Product, objects, CREATE)
+            await get_search_backend().index(objects)
+    except BaseORMException as e:
+        for line, _ in batch:
+            report.fail(line, [f"not saved: {e}"])
+        return []
+    report.created += len(objects)
+    return objects
+
+
+async def reserve_product_ids(connection: BaseDBAsyncClient, count: int) -> List[int]:
+    '''postgres: take `count` ids from the sequence, bulk_create inserts
+    the ids it is given'''
+    rows = await connection.execute_query_dict(
+        "SELECT nextval(pg_get_serial_sequence('product', 'id')) AS id "
+        "FROM generate_series(1, $1)", [count])
+    return [row["id"] for row in rows]
+
+
+async def assign_inserted_ids(connection: BaseDBAsyncClient, objects: List[Product]) -> None:
+    '''sqlite: bulk_create leaves the ids unset. The transaction holds the
+    write lock, so nobody else inserted in between and the batch got the
+    consecutive rowids ending at last_insert_rowid()'''
+    rows = await connection.execute_query_dict("SELECT last_insert_rowid() AS id")
+    first = rows[0]["id"] - len(objects) + 1
+    for offset, product in enumerate(objects):
+        product.id = first + offset
+
+
+async def import_products(business_id: int, rows: AsyncIterator[Row]) -> Dict[str, Any]:
+    batch_size = get_settings().BULK_BATCH_SIZE
+    report = ImportReport()
+    categories = set()
+    batch: List[Tuple[int, Any]] = []
+    async for line, row, error in rows:
+        if error is not None:
+            report.fail(line, [error])
+            continue
+        try:
+            batch.append((line, validate(row)))
+        except (ValueError, ValidationError) as e:
+            report.fail(line, error_messages(e))
+            continue
+        if len(batch) >= batch_size:
+            categories.update(product.category for product in
+                              await insert_batch(business_id, batch, report))
+            batch = []
+    if batch:
+        categories.update(product.category for product in
+                          await insert_batch(business_id, batch, report))
+
+    if report.created:
+        await refresh_categories(categories)
+        await get_response_cache().invalidate()
+    return report.dict()
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _csv_value(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return format(value, "f")  # the db normalizes 100.00 to 1E+2
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+async def export_products(business_id: int, format: str) -> AsyncIterator[bytes]:
+    '''the business' products in id order, one chunk per page'''
+    if format == "csv":
+        yield (",".join(EXPORT_FIELDS) + "\r\n").encode()
+    last_id = 0
+    while True:
+        rows = await Product.filter(business_id=business_id, id__gt=last_id) \
+            .order_by("id").limit(EXPORT_PAGE_SIZE).values(*EXPORT_FIELDS)
+        if not rows:
+            return
+        if format == "csv":
+            out = io.StringIO()
+            writer = csv.writer(out)
+            writer.writerows([_csv_value(row[field]) for field in EXPORT_FIELDS]
+                             for row in rows)
+            yield out.getvalue().encode()
+        else:
+            yield "".join(json.dumps(row, default=_json_default) + "\n"
+                          for row in rows).encode()
+        last_id = rows[-1]["id"]
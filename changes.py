@@ -0,0 +1,174 @@
+"""
+the catalogue change log
+
+every create, update and delete of a Product or Business appends a
+ChangeEvent (with the row as it now is) in the same transaction as the
+write, so the log and the tables never disagree. Consumers read it from
+GET /changes?since=<seq>, a page at a time, or follow GET /changes/stream
+(Server-Sent Events); either way they resume after the last seq they
+saw instead of re-reading the catalogue.
+
+writes go through atomic(): the events are inserted right before the
+commit, and once it has committed every worker's streams are woken.
+The bulk paths (import, offer expiry) fire no signals and call record()
+themselves.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Type
+
+from fastapi.encoders import jsonable_encoder
+from tortoise import BaseDBAsyncClient, Model
+from tortoise.signals import post_delete, post_save
+from tortoise.transactions import in_transaction
+
+from models import (Business, ChangeEvent, Product,
+                    business_pydantic, product_pydantic)
+from config import get_settings
+from cache import get_response_cache
+from serialization import get_dumps
+from state import get_state
+
+CREATE = "create"
+UPDATE = "update"
+DELETE = "delete"
+
+ENTITIES = {Product: "product", Business: "business"}
+CHANGE_FIELDS = ("seq", "entity", "entity_id", "action", "data", "created_at")
+
+# postgres advisory lock held by whoever is appending to the log
+LOG_LOCK = 0x6368616e6765
+CHANNEL = "changes"
+
+# events of the atomic() block this task is in, written at its end
+_pending: ContextVar[Optional[List[ChangeEvent]]] = ContextVar("pending_changes", default=None)
+# one per open stream, set when new events may have been committed
+_wakeups: Set[asyncio.Event] = set()
+
+
+def snapshot(instance: Model) -> Dict[str, Any]:
+    if isinstance(instance, Product):
+        data = jsonable_encoder(product_pydantic.from_orm(instance))
+        data["business_id"] = instance.business_id
+    else:
+        data = jsonable_encoder(business_pydantic.from_orm(instance))
+        data["owner_id"] = instance.owner_id
+    return data
+
+
+async def write(events: List[ChangeEvent]) -> None:
+    async with in_transaction() as connection:
+        if connection.capabilities.dialect == "postgres":
+            # seqs are handed out at INSERT but show up at COMMIT; with one
+            # writer at a time they show up in order, so a reader that has
+            # seen seq n can't miss a smaller one committed after it
+            await connection.execute_query("SELECT pg_advisory_xact_lock($1)", [LOG_LOCK])
+        await ChangeEvent.bulk_create(events, using_db=connection)
+
+
+async def record(model: Type[Model], instances: List[Model], action: str) -> None:
+    '''log `action` on `instances`: at the end of the enclosing atomic()
+    block, or right away in the open transaction (or one of its own)'''
+    if not instances:
+        return
+    events = [ChangeEvent(entity=ENTITIES[model], entity_id=instance.pk, action=action,
+                          data=None if action == DELETE else snapshot(instance))
+              for instance in instances]
+    pending = _pending.get()
+    if pending is not None:
+        pending.extend(events)
+    else:
+        await write(events)
+
+
+async def committed() -> None:
+    '''after a transaction that logged changes: drop the responses cached
+    from the old rows while it was open and wake the streams'''
+    await get_response_cache().invalidate()
+    await get_state().publish(CHANNEL, "")
+
+
+@asynccontextmanager
+async def atomic() -> AsyncIterator[BaseDBAsyncClient]:
+    '''a transaction for catalogue writes and their change events'''
+    if _pending.get() is not None:
+        # already in one, its commit covers ours
+        async with in_transaction() as connection:
+            yield connection
+        return
+    events: List[ChangeEvent] = []
+    token = _pending.set(events)
+    try:
+        async with in_transaction() as connection:
+            yield connection
+            if events:
+                await write(events)
+    finally:
+        _pending.reset(token)
+    if events:
+        await committed()
+
+
+async def changes_since(since: int, limit: int) -> List[Dict[str, Any]]:
+    return await ChangeEvent.filter(seq__gt=since).order_by("seq") \
+        .limit(limit).values(*CHANGE_FIELDS)
+
+
+def wake_streams(message: str = "") -> None:
+    for wakeup in _wakeups:
+        wakeup.set()
+
+
+async def stream(since: int, alive: Callable[[], bool]) -> AsyncIterator[bytes]:
+    '''Server-Sent Events from `since` on, each with its seq as the id so a
+    reconnecting client resumes with Last-Event-ID; ends after
+    CHANGES_STREAM_SECONDS or once `alive()` is false'''
+    settings = get_settings()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.CHANGES_STREAM_SECONDS
+    dumps = get_dumps()
+    wakeup = asyncio.Event()
+    _wakeups.add(wakeup)
+    try:
+        yield f"retry: {settings.CHANGES_RETRY_MS}\n\n".encode()
+        while alive() and loop.time() < deadline:
+            # cleared before reading, a commit in between sets it again
+            wakeup.clear()
+            events = await changes_since(since, settings.CHANGES_PAGE_SIZE)
+            if events:
+                since = events[-1]["seq"]
+                yield b"".join(b"id: %d\ndata: %s\n\n" % (event["seq"], dumps(event))
+                               for event in events)
+                if len(events) == settings.CHANGES_PAGE_SIZE:
+                    continue
+            # writes from other paths don't wake us, the heartbeat
+            # doubles as a poll for them
+            timeout = min(settings.CHANGES_HEARTBEAT, max(0, deadline - loop.time()))
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+    finally:
+        _wakeups.discard(wakeup)
+
+
+@post_save(Product, Business)
+async def record_saved(
+        sender: "Type[Model]",
+        instance: Model,
+        created: bool,
+        using_db: "Optional[BaseDBAsyncClient]",
+        update_fields: List[str]) -> None:
+    await record(sender, [instance], CREATE if created else UPDATE)
+
+
+@post_delete(Product, Business)
+async def record_deleted(
+        sender: "Type[Model]",
+        instance: Model,
+        using_db: "Optional[BaseDBAsyncClient]") -> None:
+    await record(sender, [instance], DELETE)
+
+
+get_state().subscribe(CHANNEL, wake_streams)
@@ -0,0 +1,149 @@
+"""
+database connection settings and schema migrations
+
+the schema is no longer generated at startup: every change is a SQL
+file in migrations/, named <version>_<name>.<dialect>.sql, applied once
+and in order by
+
+    python database.py
+
+which records each applied version in the "schema_migration" table.
+"""
+import asyncio
+import logging
+import os
+import re
+from datetime import datetime
+from typing import List, Tuple
+
+from tortoise import BaseDBAsyncClient, Tortoise
+from tortoise.backends.base.config_generator import expand_db_url
+from tortoise.exceptions import OperationalError
+from tortoise.transactions import in_transaction
+
+from config import get_settings
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_FILE = re.compile(r"^(\d+_\w+)\.(sqlite|postgres)\.sql$")
+
+
+def tortoise_config() -> dict:
+    settings = get_settings()
+    connection = expand_db_url(settings.DB_URL)
+    credentials = connection["credentials"]
+    if connection["engine"] == "tortoise.backends.sqlite":
+        # one writer at a time is all sqlite can do: WAL keeps readers
+        # going during a write, synchronous=NORMAL drops the fsync per
+        # commit (still safe in WAL mode) and busy_timeout makes other
+        # processes wait for the write lock instead of failing
+        credentials.update({
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": settings.DB_BUSY_TIMEOUT * 1000,
+            "cache_size": -64000,  # KiB
+            "temp_store": "MEMORY",
+            "foreign_keys": "ON",
+        })
+    else:
+        credentials.update({
+            "minsize": settings.DB_POOL_MIN,
+            "maxsize": settings.DB_POOL_MAX,
+            "max_inactive_connection_lifetime": 300,
+            "server_settings": {
+                "statement_timeout": str(settings.DB_STATEMENT_TIMEOUT * 1000),
+                "idle_in_transaction_session_timeout": str(settings.DB_STATEMENT_TIMEOUT * 1000),
+            },
+        })
+    return {
+        "connections": {"default": connection},
+        "apps": {"models": {"models": ["models"], "default_connection": "default"}},
+    }
+
+
+def migration_files(dialect: str) -> List[Tuple[str, str]]:
+    '''(version, path) of every migration for `dialect`, oldest first'''
+    files = []
+    for name in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(name)
+        if match and match.group(2) == dialect:
+            files.append((match.group(1), os.path.join(MIGRATIONS_DIR, name)))
+    return sorted(files, key=lambda file: int(file[0].split("_", 1)[0]))
+
+
+def statements(path: str) -> List[str]:
+    '''statements end with ";" at the end of a line'''
+    with open(path) as f:
+        sql = f.read()
+    return [statement.strip() for statement in re.split(r";\s*$", sql, flags=re.M)
+            if statement.strip()]
+
+
+async def applied_versions(connection: BaseDBAsyncClient, create: bool = True) -> set:
+    if create:
+        await connection.execute_script(
+            'CREATE TABLE IF NOT EXISTS "schema_migration" ('
+            '"version" VARCHAR(100) NOT NULL PRIMARY KEY, '
+            '"applied_at" TIMESTAMP NOT NULL)')
+    try:
+        rows = await connection.execute_query_dict('SELECT "version" FROM "schema_migration"')
+    except OperationalError:
+        # never migrated
+        return set()
+    return {row["version"] for row in rows}
+
+
+async def pending_migrations(connection: BaseDBAsyncClient,
+                             create: bool = True) -> List[Tuple[str, str]]:
+    applied = await applied_versions(connection, create)
+    return [(version, path)
+            for version, path in migration_files(connection.capabilities.dialect)
+            if version not in applied]
+
+
+async def migrate(connection_name: str = "default") -> List[str]:
+    '''apply pending migrations, each in its own transaction; returns the
+    versions applied'''
+    connection = Tortoise.get_connection(connection_name)
+    done = []
+    for version, path in await pending_migrations(connection):
+        async with in_transaction(connection_name) as transaction:
+            if connection.capabilities.dialect == "postgres":
+                # two processes migrating at once: the second waits, then skips
+                await transaction.execute_query("SELECT pg_advisory_xact_lock(72707369)")
+                if version in await applied_versions(transaction):
+                    continue
+            for statement in statements(path):
+                await transaction.execute_query(statement)
+            await transaction.execute_query(
+                'INSERT INTO "schema_migration" ("version", "applied_at") VALUES '
+                + ("($1, $2)" if connection.capabilities.dialect == "postgres" else "(?, ?)"),
+                [version, datetime.utcnow()])
+        logger.info("applied migration %s", version)
+        done.append(version)
+    return done
+
+
+async def check_migrations(connection_name: str = "default") -> List[str]:
+    '''log an error at startup if the database is behind the code; one
+    read, a starting worker doesn't touch the schema'''
+    pending = [version for version, _ in
+               await pending_migrations(Tortoise.get_connection(connection_name), create=False)]
+    if pending:
+        logger.error("database has pending migrations (%s), run `python database.py`",
+                     ", ".join(pending))
+    return pending
+
+
+async def main() -> None:
+    await Tortoise.init(config=tortoise_config())
+    try:
+        applied = await migrate()
+        print("\n".join(applied) if applied else "database is up to date")
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
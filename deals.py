@@ -0,0 +1,171 @@
+"""
+offer expiry and the "top deals" index
+
+an offer ends after its offer_expiration_date: expire_offers() puts the
+product back at its original price, a batch at a time, from a periodic
+job. The "deal" table holds the DEALS_PER_CATEGORY biggest active
+discounts of every category, so GET /deals is one indexed read. Saves
+insert or bump a product's row in place; a category is recomputed only
+when a product leaves its list or its discount drops, and after the
+bulk paths (import, expiry) that skip the signals.
+"""
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Type
+
+from tortoise import BaseDBAsyncClient, Tortoise
+from tortoise.exceptions import IntegrityError
+from tortoise.expressions import F
+from tortoise.query_utils import Q
+from tortoise.signals import post_delete, post_save
+from tortoise.transactions import in_transaction
+
+from models import Deal, Product
+from config import get_settings
+from cache import get_response_cache
+from changes import UPDATE, atomic, record
+
+# a change to anything else can't move a product in or out of the deals
+DEAL_FIELDS = {"category", "original_price", "new_price", "percentage_discount",
+               "offer_expiration_date"}
+
+
+def today() -> date:
+    return datetime.utcnow().date()
+
+
+def is_active(product: Product) -> bool:
+    expires = product.offer_expiration_date
+    if isinstance(expires, datetime):
+        expires = expires.date()
+    return product.percentage_discount > 0 and expires >= today()
+
+
+async def refresh_category(category: str) -> None:
+    '''replace the category's deals with its current top offers'''
+    connection = Tortoise.get_connection("default")
+    if connection.capabilities.dialect == "postgres":
+        params = ["$1", "$2", "$3"]
+    else:
+        params = ["?", "?", "?"]
+    async with in_transaction() as transaction:
+        await Deal.filter(category=category).using_db(transaction).delete()
+        await transaction.execute_query(
+            'INSERT INTO "deal" ("product_id", "category", "percentage_discount") '
+            'SELECT "id", "category", "percentage_discount" FROM "product" '
+            f'WHERE "category" = {params[0]} AND "percentage_discount" > 0 '
+            f'AND "offer_expiration_date" >= {params[1]} '
+            f'ORDER BY "percentage_discount" DESC, "id" DESC LIMIT {params[2]}',
+            [category, today(), get_settings().DEALS_PER_CATEGORY])
+
+
+async def refresh_categories(categories: Iterable[str]) -> None:
+    for category in sorted(set(categories)):
+        await refresh_category(category)
+
+
+async def rebuild_deals() -> None:
+    categories = await Product.all().distinct().values_list("category", flat=True)
+    await refresh_categories(categories)
+
+
+async def setup_deals() -> None:
+    '''fill the index on the first start'''
+    if not await Deal.exists():
+        await rebuild_deals()
+
+
+async def update_deals_for(product: Product) -> None:
+    '''apply a saved product to the deals, starting from one query over
+    its category's (and its own) deal rows; only a product leaving a top
+    list or dropping its discount recomputes that category'''
+    rows = await Deal.filter(Q(category=product.category) | Q(product_id=product.id)) \
+        .values_list("product_id", "category", "percentage_discount")
+    active = is_active(product)
+    discount = int(product.percentage_discount)
+    listed = [row for row in rows if row[0] == product.id]
+    if listed:
+        _, category, listed_discount = listed[0]
+        if category == product.category and active and discount >= listed_discount:
+            if discount > listed_discount:
+                await Deal.filter(product_id=product.id).update(percentage_discount=discount)
+            return
+        await refresh_category(category)
+        if category == product.category or not active:
+            return
+    if not active:
+        return
+
+    ranked = sorted((row[2], row[0]) for row in rows
+                    if row[1] == product.category and row[0] != product.id)
+    if len(ranked) >= get_settings().DEALS_PER_CATEGORY:
+        if (discount, product.id) < ranked[0]:
+            return
+        await Deal.filter(product_id=ranked[0][1]).delete()
+    try:
+        await Deal.create(product_id=product.id, category=product.category,
+                          percentage_discount=discount)
+    except IntegrityError:
+        # a concurrent save of the same product got there first
+        await refresh_category(product.category)
+
+
+async def top_deals(category: Optional[str] = None, limit: Optional[int] = None) -> Dict[str, List[Product]]:
+    '''category -> its deals, biggest discount first'''
+    queryset = Deal.all().select_related("product") \
+        .order_by("category", "-percentage_discount", "-product_id")
+    if category is not None:
+        queryset = queryset.filter(category=category)
+    deals: Dict[str, List[Product]] = {}
+    for deal in await queryset:
+        products = deals.setdefault(deal.category, [])
+        if limit is None or len(products) < limit:
+            products.append(deal.product)
+    return deals
+
+
+async def expire_offers() -> int:
+    '''end every offer past its expiration date; returns how many'''
+    batch_size = get_settings().OFFER_EXPIRY_BATCH
+    expired = 0
+    categories = set()
+    while True:
+        rows = await Product.filter(percentage_discount__gt=0, offer_expiration_date__lt=today()) \
+            .limit(batch_size).values("id", "category")
+        if not rows:
+            break
+        ids = [row["id"] for row in rows]
+        async with atomic():
+            await Product.filter(id__in=ids) \
+                .update(new_price=F("original_price"), percentage_discount=0)
+            await record(Product, await Product.filter(id__in=ids), UPDATE)
+        categories.update(row["category"] for row in rows)
+        expired += len(rows)
+
+    if expired:
+        # queryset updates fire no signals, do what they would have done
+        await refresh_categories(categories)
+        await get_response_cache().invalidate()
+    return expired
+
+
+@post_save(Product)
+async def update_deals(
+        sender: "Type[Product]",
+        instance: Product,
+        created: bool,
+        using_db: "Optional[BaseDBAsyncClient]",
+        update_fields: List[str]) -> None:
+    if update_fields and not DEAL_FIELDS & set(update_fields):
+        return
+    await update_deals_for(instance)
+
+
+@post_delete(Product)
+async def update_deleted_deals(
+        sender: "Type[Product]",
+        instance: Product,
+        using_db: "Optional[BaseDBAsyncClient]") -> None:
+    # the deal row went with the product (ON DELETE CASCADE); refill
+    # the category if that opened a slot
+    if await Deal.filter(category=instance.category).count() < get_settings().DEALS_PER_CATEGORY:
+        await refresh_category(instance.category)
@@ -1,78 +1,56 @@
-from typing import List
+from typing import Any, Dict, List, Optional
 
 from models import User
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
-from pydantic import EmailStr
-import jwt
+from tortoise import BaseDBAsyncClient
 
 from config import get_settings
+from tokens import PASSWORD_RESET, VERIFY_EMAIL, email_token
+from outbox import enqueue
+from rendering import render
 
-SITE_URL = get_settings().SITE_URL
 SITE_NAME = get_settings().SITE_NAME
 
 
-conf = ConnectionConfig(
-    MAIL_USERNAME=get_settings().MAIL_USERNAME,
-    MAIL_PASSWORD=get_settings().MAIL_PASSWORD,
-    MAIL_FROM=get_settings().MAIL_FROM,
-    MAIL_PORT=get_settings().MAIL_PORT,
-    MAIL_SERVER=get_settings().MAIL_SERVER,
-    MAIL_TLS=get_settings().MAIL_TLS,
-    MAIL_SSL=get_settings().MAIL_SSL,
-    USE_CREDENTIALS=get_settings().USE_CREDENTIALS,
-    VALIDATE_CERTS=get_settings().VALIDATE_CERTS
-)
+async def queue_mail(template: str, recipients: List[str], subject: str,
+                     context: Dict[str, Any],
+                     using_db: Optional[BaseDBAsyncClient] = None):
+    """render templates/email/<template> and queue it, outbox.run_dispatcher sends it"""
+    await enqueue(recipients=recipients,
+                  subject=subject,
+                  body=render(f"email/{template}", **context),
+                  subtype="html",
+                  using_db=using_db)
 
 
-async def send_mail(email: List[EmailStr], instance: User):
-    """send Account Verification mail"""
+async def send_mail(email: List[str], instance: User,
+                    using_db: Optional[BaseDBAsyncClient] = None):
+    """queue Account Verification mail"""
 
-    token_data = {
-        "id": instance.id,
-        "username": instance.username,
-        "email": instance.email
-    }
+    await queue_mail("verification.html", email,
+                     subject=SITE_NAME + " account verification",
+                     context={"username": instance.username,
+                              "token": email_token(instance, VERIFY_EMAIL)},
+                     using_db=using_db)
 
-    token = jwt.encode(token_data, get_settings().SECRET, algorithm="HS256")
 
-    template = f"""
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-    </head>
-    <body>
-        <div style = "display:flex; align-items: center; flex-direction: column" >
-            <h3>Account Verification</H3>
+async def send_password_reset_mail(instance: User,
+                                   using_db: Optional[BaseDBAsyncClient] = None):
+    """queue Password Reset mail"""
 
-            <br>
+    await queue_mail("password_reset.html", [instance.email],
+                     subject=SITE_NAME + " password reset",
+                     context={"username": instance.username,
+                              "token": email_token(instance, PASSWORD_RESET)},
+                     using_db=using_db)
 
-            <p>
-                Thanx for choosing us, please click on the button below
-                to verify your account
-            </p> 
-            
-            <a style = "display:marign-top: 1rem ; padding: 1rem; border-redius: 0.5rem;
-             font-size:1rem; text-decoration: no; background: #0275d8; color:white"
-             href="{SITE_URL}/verification/email/?token={token}">
-                Verify your email
-             </a>
-        </div>
-    </body>
-    </html>
-    """
-    # print(f"""
 
-    # your mail:
-    # {SITE_URL}verification/email/?token={token}
+async def send_order_receipt(instance: User, order_id: int,
+                             items: List[Dict[str, Any]], total,
+                             using_db: Optional[BaseDBAsyncClient] = None):
+    """queue Order Receipt mail; items are dicts with name, quantity, unit_price"""
 
-    # """)
-
-    message = MessageSchema(
-        subject=SITE_NAME + " account verification",
-        recipients=email,  # List of recipients,
-        body=template,
-        subtype="html"
-    )
-    fm = FastMail(conf)
-    await fm.send_message(message)
+    await queue_mail("order_receipt.html", [instance.email],
+                     subject=f"{SITE_NAME} order #{order_id}",
+                     context={"username": instance.username, "order_id": order_id,
+                              "items": items, "total": total},
+                     using_db=using_db)
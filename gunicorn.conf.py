@@ -0,0 +1,31 @@
+"""
+gunicorn settings for using every core of the box
+
+    gunicorn -c gunicorn.conf.py main:app
+
+each worker is a uvicorn process on uvloop with its own event loop,
+database pool and in-process caches. Set STATE_BACKEND=redis so they
+share the response cache, rate limits, revoked tokens and locks (see
+state.py), and prefer postgres to sqlite for the writes.
+"""
+import logging
+import multiprocessing
+
+from config import get_settings
+
+settings = get_settings()
+
+bind = settings.WEB_BIND
+workers = settings.WEB_WORKERS or multiprocessing.cpu_count()
+worker_class = "uvicorn.workers.UvicornWorker"
+# import the app in every worker, not once in the master: event loops,
+# connection pools and executors must not cross a fork
+preload_app = False
+# the app drains for up to DRAIN_TIMEOUT, leave it time to close the database
+graceful_timeout = settings.DRAIN_TIMEOUT + 10
+keepalive = 5
+
+if workers > 1 and settings.STATE_BACKEND != "redis":
+    logging.getLogger("gunicorn.error").warning(
+        "%s workers with STATE_BACKEND=%s: caches, rate limits and token "
+        "revocations are per worker, set STATE_BACKEND=redis", workers, settings.STATE_BACKEND)
@@ -0,0 +1,285 @@
+"""
+image upload pipeline
+
+a body over MAX_UPLOAD_SIZE is refused by UploadLimitMiddleware before
+starlette spools it. Uploads are copied to a temp file in chunks while
+being hashed, checked (header and structure, no decoding) to be the
+image their extension claims, then stored content-addressed (see
+storage.py). The rest of the PIL work (resize, re-encode) runs on a worker pool after
+the response has been sent; Business.logo / Product.product_image point
+at the original until the renditions are ready, and go back to the
+previous image if rendering fails.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Dict, NamedTuple
+
+import aiofiles
+from fastapi import HTTPException, UploadFile, status
+from fastapi.responses import JSONResponse
+
+from models import Business, Product
+from config import get_settings
+from storage import (MEDIA_URL, get_storage, media_path,
+                     key_digest, collect_garbage)
+from workers import WorkerPool
+from changes import atomic
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_EXTENSIONS = ("png", "jpg", "jpeg")
+# extension -> the format PIL must find in the bytes
+FORMATS = {"png": "PNG", "jpg": "JPEG", "jpeg": "JPEG"}
+CHUNK_SIZE = 64 * 1024
+UPLOAD_PATH = "/uploadfile/"
+# multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD = 16 * 1024
+
+# name: (size, crop to exact size)
+RENDITIONS = {
+    "thumb": ((200, 200), True),
+    "medium": ((800, 800), False),
+}
+
+image_pool = WorkerPool("pillow",
+                        workers=get_settings().IMAGE_WORKERS,
+                        max_pending=get_settings().IMAGE_MAX_PENDING,
+                        kind=get_settings().IMAGE_POOL)
+
+
+class Upload(NamedTuple):
+    digest: str
+    extension: str
+    path: str  # local temp copy, removed once the renditions are stored
+
+    @property
+    def key(self) -> str:
+        return f"{self.digest}.{self.extension}"
+
+    def rendition_key(self, name: str, extension: str) -> str:
+        return f"{self.digest}_{name}.{extension}"
+
+
+class UploadLimitMiddleware:
+    '''plain ASGI middleware: starlette spools the whole multipart body
+    before the endpoint runs, so MAX_UPLOAD_SIZE is enforced here. A
+    Content-Length over the limit is answered with 413 before anything is
+    read; a body without one is counted as it arrives and cut off at the
+    limit'''
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or not scope["path"].startswith(UPLOAD_PATH):
+            return await self.app(scope, receive, send)
+
+        max_size = get_settings().MAX_UPLOAD_SIZE
+        too_large = JSONResponse({"detail": f"File larger than {max_size} bytes"},
+                                 status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        limit = max_size + MULTIPART_OVERHEAD
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > limit:
+            return await too_large(scope, receive, send)
+
+        received = 0
+        exceeded = False
+        started = False
+
+        async def receive_limited():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # the form parser sees a disconnect and stops reading
+                    exceeded = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def send_limited(message) -> None:
+            nonlocal started
+            if exceeded and not started:
+                # whatever error the app made of the disconnect becomes a 413
+                started = True
+                return await too_large(scope, receive, send)
+            if exceeded:
+                return
+            started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive_limited, send_limited)
+        except Exception:
+            if not exceeded:
+                raise
+        if exceeded and not started:
+            await too_large(scope, receive, send)
+
+
+def get_extension(file_name: str) -> str:
+    extension = file_name.rsplit(".", 1)[-1].lower() if "." in file_name else ""
+    if extension not in ALLOWED_EXTENSIONS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="File extension not allowed")
+    return extension
+
+
+async def save_upload(file: UploadFile) -> Upload:
+    '''copy the upload to a temp file chunk by chunk and store the
+    original; identical bytes are only stored once'''
+    extension = get_extension(file.filename)
+    max_size = get_settings().MAX_UPLOAD_SIZE
+    tmp_dir = get_settings().UPLOAD_TMP_DIR
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix="." + extension, dir=tmp_dir)
+    os.close(fd)
+
+    size = 0
+    digest = hashlib.sha256()
+    async with aiofiles.open(path, "wb") as f:
+        while True:
+            chunk = await file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                break
+            digest.update(chunk)
+            await f.write(chunk)
+
+    if size > max_size:
+        os.remove(path)
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"File larger than {max_size} bytes")
+
+    # the extension is only a claim, nothing is stored or pointed at
+    # until the bytes decode as that format
+    try:
+        await image_pool.run(verify, path, FORMATS[extension], admit=False)
+    except Exception:
+        os.remove(path)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="File is not a valid image")
+
+    upload = Upload(digest.hexdigest(), extension, path)
+    storage = get_storage()
+    if await storage.exists(upload.key):
+        # an old orphan is about to be referenced again
+        await storage.touch(upload.key)
+    else:
+        # keep a copy to render from, the store consumes its file
+        original = path + ".original"
+        os.link(path, original)
+        await storage.put_file(upload.key, original)
+    return upload
+
+
+def verify(path: str, image_format: str) -> None:
+    '''runs in the worker pool: raise unless the header and structure
+    are those of `image_format`; no pixels are decoded here, a file that
+    still fails in render() puts the previous image back'''
+    from PIL import Image
+
+    with Image.open(path) as image:
+        if image.format != image_format:
+            raise ValueError(f"{image.format} data, expected {image_format}")
+        image.verify()
+
+
+def render(path: str) -> Dict[str, str]:
+    '''runs in the worker pool: write every rendition (plus a WebP copy
+    of each) next to the original, returns {rendition name: path}'''
+    # imported here, in the worker, so starting the app doesn't load PIL
+    from PIL import Image, ImageOps
+
+    base, extension = path.rsplit(".", 1)
+    paths = {}
+    with Image.open(path) as original:
+        original = ImageOps.exif_transpose(original)
+        if extension in ("jpg", "jpeg") and original.mode not in ("RGB", "L"):
+            original = original.convert("RGB")
+        for name, (size, crop) in RENDITIONS.items():
+            if crop:
+                img = ImageOps.fit(original, size)
+            else:
+                img = original.copy()
+                img.thumbnail(size)
+            paths[name] = f"{base}_{name}.{extension}"
+            img.save(paths[name], optimize=True)
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+            paths[name + "_webp"] = f"{base}_{name}.webp"
+            img.save(paths[name + "_webp"], "WEBP", quality=80)
+    return paths
+
+
+async def store_renditions(upload: Upload) -> Dict[str, str]:
+    '''render and store every rendition of the upload unless an earlier
+    upload of the same bytes already did, returns {name: media path}'''
+    storage = get_storage()
+    keys = {}
+    for name in RENDITIONS:
+        keys[name] = upload.rendition_key(name, upload.extension)
+        keys[name + "_webp"] = upload.rendition_key(name, "webp")
+
+    try:
+        missing = []
+        for key in keys.values():
+            if await storage.exists(key):
+                await storage.touch(key)
+            else:
+                missing.append(key)
+        if missing:
+            paths = await image_pool.run(render, upload.path, admit=False)
+            for name, key in keys.items():
+                await storage.put_file(key, paths[name])
+    finally:
+        if os.path.exists(upload.path):
+            os.remove(upload.path)
+    return {name: media_path(key) for name, key in keys.items()}
+
+
+async def process_logo(business_id: int, upload: Upload, previous: str) -> None:
+    try:
+        renditions = await store_renditions(upload)
+    except Exception:
+        logger.exception("rendering logo %s of business %s failed", upload.key, business_id)
+        renditions = None
+    async with atomic():
+        business = await Business.get_or_none(id=business_id)
+        # skip if the business was deleted or a newer upload replaced the logo
+        if business and business.logo == media_path(upload.key):
+            business.logo = renditions["thumb"] if renditions else previous
+            await business.save(update_fields=["logo"])
+
+
+async def process_product_image(product_id: int, upload: Upload, previous: str) -> None:
+    try:
+        renditions = await store_renditions(upload)
+    except Exception:
+        logger.exception("rendering image %s of product %s failed", upload.key, product_id)
+        renditions = None
+    async with atomic():
+        product = await Product.get_or_none(id=product_id)
+        if product and product.product_image == media_path(upload.key):
+            product.product_image = renditions["medium"] if renditions else previous
+            await product.save(update_fields=["product_image"])
+
+
+async def referenced_digests() -> set:
+    digests = set()
+    for paths in (Business.all().distinct().values_list("logo", flat=True),
+                  Product.all().distinct().values_list("product_image", flat=True)):
+        for path in await paths:
+            if path and path.startswith(MEDIA_URL):
+                digests.add(key_digest(path[len(MEDIA_URL):]))
+    return digests
+
+
+async def collect_orphans() -> int:
+    '''delete stored images no Business or Product points at any more'''
+    return await collect_garbage(get_storage(), await referenced_digests(),
+                                 min_age=get_settings().MEDIA_GC_MIN_AGE)
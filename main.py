@@ -1,34 +1,85 @@
-
 from fastapi import (FastAPI, status, Request,
-                     HTTPException, Depends, Query)
-from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
+                     HTTPException, Depends, Query, Header)
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 # database
 from tortoise.contrib.fastapi import register_tortoise
+from database import tortoise_config, check_migrations
 from models import (User, Business, Product,
                     user_pydantic, user_pydanticIn, user_pydanticOut,
                     business_pydantic, business_pydanticIn,
-                    product_pydantic, product_pydanticIn)
+                    product_pydantic, product_pydanticIn,
+                    UserPage, ProductPage, ProductWithBusiness,
+                    ProductSearchPage, BulkImportResult, UserRegistration,
+                    OrderIn, OrderOut, StockIn, DealPage, RefreshToken,
+                    ChangePage, BatchIds, BatchProduct, ProductBatch, BusinessBatch)
 from datetime import datetime
 # authentication
-from authentication import (get_hashed_password,
-                            very_token, very_token_email,
-                            is_not_email, token_generator)
+from authentication import (get_hashed_password, hash_pool,
+                            very_token, very_token_email, load_user,
+                            token_generator, refresh_tokens, revoke_tokens,
+                            user_cache)
+from tokens import get_revocations
 from fastapi.security import (OAuth2PasswordBearer, OAuth2PasswordRequestForm)
 
 # signal
 from tortoise.signals import post_save
-from tortoise import BaseDBAsyncClient
+from tortoise import BaseDBAsyncClient, Tortoise
+from tortoise.exceptions import IntegrityError
+from tortoise.query_utils import Q
 from typing import List, Optional, Type
 
+# query planning
+from queries import (products_with_business, products_with_owner,
+                     with_business, is_owner,
+                     products_by_ids, businesses_by_ids)
+
+# search
+from search import SORTS as SEARCH_SORTS, SearchQuery, search_products, get_search_backend
+
+# bulk import / export
+from catalogue import csv_rows, ndjson_rows, import_products, export_products
+
+# offers
+from deals import top_deals, setup_deals, expire_offers
+
+# checkout
+from orders import place_order, set_stock
+
+# response cache
+from cache import get_response_cache
+
+# change log
+from changes import atomic, changes_since, stream as change_stream, wake_streams
+
+# serialization
+from serialization import (fast_serialization, response_class,
+                           product_rows, product_detail_row)
+
+# pagination
+from pagination import PRODUCT_SORTS, USER_SORT, paginate, next_page
+
 # email
 from emails import send_mail
+from outbox import run_dispatcher
+from rendering import page, warm_up as warm_up_templates
 
 # images
-from fastapi import File, UploadFile
+from fastapi import File, UploadFile, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
-from PIL import Image
-import secrets
+from images import (image_pool, save_upload, collect_orphans,
+                    process_logo, process_product_image, UploadLimitMiddleware)
+from storage import CACHE_CONTROL, get_storage, media_path, key_digest
+from workers import run_periodically
+import asyncio
+
+# rate limiting
+from ratelimit import rate_limit, limits as rate_limits
+
+# metrics
+from metrics import MetricsMiddleware, registry, instrument_db, sample_loop_lag
+
+# workers
+from state import get_state, exclusive
 
 # env file
 from config import get_settings
@@ -36,27 +87,53 @@ SITE_URL = get_settings().SITE_URL
 
 
 app = FastAPI(title="E-commerce API", version="0.1.1",
-              description=" E-commerce API created with FastAPI and jwt Authenticated")
+              description=" E-commerce API created with FastAPI and jwt Authenticated",
+              default_response_class=response_class())
+app.add_middleware(UploadLimitMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 
 oauth_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# bcrypt, SMTP and PIL sit behind these
+token_limit = rate_limit("token", get_settings().RATE_LIMIT_TOKEN)
+register_limit = rate_limit("register", get_settings().RATE_LIMIT_REGISTER)
+upload_limit = rate_limit("upload", get_settings().RATE_LIMIT_UPLOAD)
+
 # static file setup config
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
-@app.post("/token", tags=["User"])
+@app.post("/token", tags=["User"], dependencies=[Depends(token_limit)])
 async def generate_token(request_form: OAuth2PasswordRequestForm = Depends()):
-    token = await token_generator(request_form.username, request_form.password)
-    return {"access_token": token, "token_type": "bearer"}
+    return await token_generator(request_form.username, request_form.password)
+
+
+@app.post("/token/refresh", tags=["User"])
+async def refresh_token(body: RefreshToken):
+    '''a new token pair for a refresh token, which then stops working'''
+    return await refresh_tokens(body.refresh_token)
+
+
+@app.post("/token/revoke", tags=["User"], status_code=status.HTTP_204_NO_CONTENT)
+async def revoke_token(body: Optional[RefreshToken] = None,
+                       token: str = Depends(oauth_scheme)):
+    '''log out: the access token and, when given, its refresh token'''
+    await revoke_tokens(token, body.refresh_token if body else None)
 
 
 async def get_current_user(token: str = Depends(oauth_scheme)):
+    '''the token's claims (authentication.TokenUser), no query'''
     return await very_token(token)
 
 
+async def get_current_user_record(user=Depends(get_current_user)):
+    '''the full User row, for endpoints that need more than the claims'''
+    return await load_user(user.id)
+
+
 @app.post("/users/me", tags=["User"])
-async def client_data(user: user_pydanticIn = Depends(get_current_user)):
+async def client_data(user: user_pydanticIn = Depends(get_current_user_record)):
 
     business = await Business.get(owner=user)
     logo = business.logo
@@ -67,7 +144,7 @@ async def client_data(user: user_pydanticIn = Depends(get_current_user)):
         "data": {
             "username": user.username,
             "email": user.email,
-            "is_verified": user.is_verified,
+            "is_verified": user.is_verifide,
             "join_date": user.join_date.strftime("%b %d %Y"),
             "logo": logo,
             "business": await business_pydantic.from_tortoise_orm(business)
@@ -75,14 +152,16 @@ async def client_data(user: user_pydanticIn = Depends(get_current_user)):
     }
 
 
-@app.get("/users/", tags=["User"], response_model=List[user_pydanticOut])
+@app.get("/users/", tags=["User"], response_model=UserPage)
 async def get_users(user: user_pydanticIn = Depends(get_current_user),
-                    limit: int = Query(100, le=100),
-                    skip: int = Query(0, ge=0)
+                    limit: int = Query(100, ge=1, le=100),
+                    cursor: Optional[str] = None
                     ):
 
-    users = await User.filter(id__gt=skip, id__lte=skip+limit)
-    return users
+    users = await user_pydanticOut.from_queryset(
+        paginate(User.all(), USER_SORT, limit, cursor))
+    users, next_cursor = next_page(users, USER_SORT, limit)
+    return {"data": users, "next_cursor": next_cursor}
 
 
 @post_save(User)
@@ -95,10 +174,11 @@ async def create_business(
     if created:
         business_obj = await Business.create(
             business_name=instance.username,
-            owner=instance)
+            owner=instance,
+            using_db=using_db)
         await business_pydantic.from_tortoise_orm(business_obj)
-        # send the email
-        await send_mail([instance.email], instance)
+        # queue the email, the outbox dispatcher sends it
+        await send_mail([instance.email], instance, using_db=using_db)
 
 
 @app.put("/business/{id}", response_model=business_pydantic, tags=["Business"])
@@ -107,13 +187,13 @@ async def update_business(id: int,
                           user: user_pydantic = Depends(get_current_user)):
 
     business = await Business.get(id=id)
-    owner = await business.owner
 
     update_business = update_business.dict()
 
-    if user == owner:
-        await business.update_from_dict(update_business)
-        await business.save()
+    if is_owner(business, user):
+        async with atomic():
+            await business.update_from_dict(update_business)
+            await business.save()
         return await business_pydantic.from_tortoise_orm(business)
 
     raise HTTPException(
@@ -123,52 +203,60 @@ async def update_business(id: int,
     )
 
 
-@app.post("/users/", tags=["User"], status_code=status.HTTP_201_CREATED, response_model=user_pydanticOut)
-async def user_registration(user: user_pydanticIn):
-    user_info = user.dict(exclude_unset=True)
-
-    # This is a bad way to do it:
-    # TODO fix this, create custom 'user_pydanticIn for validate data '
-    if len(user_info["password"]) < 8:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="Password must be longer than 8 characters")
-    if len(user_info["username"]) < 5:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="Username must be longer than 5 characters")
-    if is_not_email(user_info["email"]):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="This is not a valid email")
+@app.post("/business/batch", tags=["Business"], response_model=BusinessBatch)
+async def get_business_batch(batch: BatchIds):
+    '''up to 100 businesses by id in one call, in the order asked for'''
+    businesses = await businesses_by_ids(batch.ids)
+    return {
+        "data": [business_pydantic.from_orm(business) if business else None
+                 for business in businesses],
+        "not_found": [id for id, business in zip(batch.ids, businesses) if business is None]
+    }
 
-    if await User.exists(username=user_info.get("username")):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="Username already exists")
-    if await User.exists(email=user_info.get("email")):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="Email already exists")
 
-    user_info["password"] = get_hashed_password(user_info["password"])
+@app.post("/users/", tags=["User"], status_code=status.HTTP_201_CREATED, response_model=user_pydanticOut,
+          dependencies=[Depends(register_limit)])
+async def user_registration(user: UserRegistration):
+    user_info = user.dict()
+    user_info["password"] = await get_hashed_password(user_info["password"])
 
-    user_obj = await User.create(**user_info)
-    user_new = await user_pydanticOut.from_tortoise_orm(user_obj)
-    return user_new
+    # no exists() checks up front: the unique constraints decide, which
+    # also covers two registrations racing for the same name
+    try:
+        async with atomic() as connection:
+            user_obj = await User.create(**user_info, using_db=connection)
+    except IntegrityError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=await registration_conflict(user_info))
+    return user_pydanticOut.from_orm(user_obj)
 
 
-template = Jinja2Templates(directory="templates")
+async def registration_conflict(user_info: dict) -> str:
+    '''which unique field a failed registration hit, in one query'''
+    taken = await User.filter(
+        Q(username=user_info["username"]) | Q(email=user_info["email"])
+    ).values_list("username", flat=True)
+    if user_info["username"] in taken:
+        return "Username already exists"
+    if taken:
+        return "Email already exists"
+    # create_business names the business after the user
+    return "Business name already exists"
 
 
 @app.get("/verification/email", response_class=HTMLResponse, tags=["User"])
 async def email_verification(request: Request, token: str):
     user = await very_token_email(token)
     if user:
-        if not user.is_verified:
-            user.is_verified = True
+        if not user.is_verifide:
+            user.is_verifide = True
             await user.save()
         context = {
             "request": request,
-            "is_verified": user.is_verified,
+            "is_verifide": user.is_verifide,
             "username": user.username
         }
-        return template.TemplateResponse("verification.html", context)
+        return page("verification.html", context)
 
     raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -178,37 +266,19 @@ async def email_verification(request: Request, token: str):
 
 
 @app.post("/uploadfile/profile", tags=["User"])
-async def upload_profile_image(file: UploadFile = File(..., max_lenght=10485760),
-                               user: user_pydantic = Depends(get_current_user)):
-
-    FILEPATH = "./static/images/"
-    file_name = file.filename
-
-    try:
-        extension = file_name.split(".")[1]
-    finally:
-        if extension not in ["png", "jpg", "jpeg"]:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail="File extension not allowed")
-
-    token_name = "logo" + secrets.token_hex(10) + "." + extension
-    generated_name = FILEPATH + token_name
-    file_content = await file.read()
-
-    with open(generated_name, "wb") as f:
-        f.write(file_content)
-
-    # PILLOW
-    img = Image.open(generated_name)
-    img = img.resize(size=(200, 200))
-    img.save(generated_name)
-
-    business = await Business.get(owner=user)
-    owner = await business.owner
-
-    if owner == user:
-        business.logo = generated_name[1:]
-        await business.save()
+async def upload_profile_image(background_tasks: BackgroundTasks,
+                               file: UploadFile = File(...),
+                               user: user_pydantic = Depends(upload_limit.per_user(get_current_user))):
+
+    image_pool.check()
+    business = await Business.get(id=user.business_id)
+
+    if is_owner(business, user):
+        upload = await save_upload(file)
+        previous, business.logo = business.logo, media_path(upload.key)
+        async with atomic():
+            await business.save(update_fields=["logo"])
+        background_tasks.add_task(process_logo, business.id, upload, previous)
         return await business_pydantic.from_tortoise_orm(business)
 
     raise HTTPException(
@@ -218,41 +288,39 @@ async def upload_profile_image(file: UploadFile = File(..., max_lenght=10485760)
     )
 
 
+@app.get("/media/{key}", tags=["Media"])
+async def get_media(key: str, request: Request):
+    if not key_digest(key):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Not Found")
+
+    # keys are content hashes, so the key itself is a strong ETag
+    headers = {"Cache-Control": CACHE_CONTROL, "ETag": f'"{key}"'}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return await get_storage().response(key, headers)
+
+
 @app.post("/uploadfile/product/{id}", tags=["Product"])
 async def upload_product_image(
         id: int,
-        file: UploadFile = File(..., max_lenght=10485760),
-        user: user_pydantic = Depends(get_current_user)):
-
-    FILEPATH = "./static/images/"
-    file_name = file.filename
+        background_tasks: BackgroundTasks,
+        file: UploadFile = File(...),
+        user: user_pydantic = Depends(upload_limit.per_user(get_current_user))):
 
-    try:
-        extension = file_name.split(".")[1]
-    finally:
-        if extension not in ["png", "jpg", "jpeg"]:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail="File extension not allowed")
-
-    token_name = "product" + secrets.token_hex(10) + "." + extension
-    generated_name = FILEPATH + token_name
-    file_content = await file.read()
-
-    with open(generated_name, "wb") as f:
-        f.write(file_content)
-
-    product = await Product.get_or_none(id=id)
-    if product:
-        business = await product.business
-        owner = await business.owner
-    else:
+    image_pool.check()
+    product = await products_with_business().get_or_none(id=id)
+    if not product:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Product Not Found"
         )
-    if owner == user:
-        product.product_image = generated_name[1:]
-        await product.save()
+    if is_owner(product.business, user):
+        upload = await save_upload(file)
+        previous, product.product_image = product.product_image, media_path(upload.key)
+        async with atomic():
+            await product.save(update_fields=["product_image"])
+        background_tasks.add_task(process_product_image, product.id, upload, previous)
         return await product_pydantic.from_tortoise_orm(product)
     else:
         raise HTTPException(
@@ -271,7 +339,8 @@ async def add_new_product(product: product_pydanticIn,
         product["percentage_discount"] = (
             (product["original_price"] - product["new_price"]) / product["original_price"]) * 100
 
-        product_obj = await Product.create(**product, business=user)
+        async with atomic():
+            product_obj = await Product.create(**product, business_id=user.business_id)
         product_obj = await product_pydantic.from_tortoise_orm(product_obj)
         return product_obj
 
@@ -282,12 +351,11 @@ async def add_new_product(product: product_pydanticIn,
 
 @app.delete("/products/{id}", tags=["Product"], status_code=status.HTTP_204_NO_CONTENT)
 async def delete_product(id: int, user: user_pydantic = Depends(get_current_user)):
-    product = await Product.get(id=id)
-    business = await product.business
-    owner = await business.owner
+    product = await products_with_business().get(id=id)
 
-    if user == owner:
-        await product.delete()
+    if is_owner(product.business, user):
+        async with atomic():
+            await product.delete()
         return
 
     raise HTTPException(
@@ -301,61 +369,345 @@ async def delete_product(id: int, user: user_pydantic = Depends(get_current_user
 async def update_product(id: int,
                          updated_product: product_pydanticIn,
                          user: user_pydantic = Depends(get_current_user)):
-    product = await Product.get(id=id)
-    business = await product.business
-    owner = await business.owner
+    product = await products_with_business().get(id=id)
 
     updated_product = updated_product.dict(exclude_unset=True)
     updated_product["percentage_discount"] = (
         (updated_product["original_price"] - updated_product["new_price"]) / updated_product["original_price"]) * 100
 
-    if user == owner and updated_product["original_price"] > 0:
-        await product.update_from_dict(updated_product)
-        await product.save()
+    if is_owner(product.business, user) and updated_product["original_price"] > 0:
+        async with atomic():
+            await product.update_from_dict(updated_product)
+            await product.save()
         return await product_pydantic.from_tortoise_orm(product)
 
     raise HTTPException(
-        status_code=status.HTTP_400_UNAUTHORIZED,
+        status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Not authenticated to perform this action or Invalid user input",
         headers={"WWW-Authenticate": "Bearer"}
     )
 
 
-@app.get("/products", tags=["Product"], response_model=List[product_pydantic])
-async def get_product_list(limit: int = Query(100, le=100),
-                           skip: int = Query(0, ge=0)):
+@app.put("/products/{id}/stock", tags=["Product"])
+async def update_product_stock(id: int, stock: StockIn,
+                               user: user_pydantic = Depends(get_current_user)):
+    product = await products_with_business().get_or_none(id=id)
+    if not product:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Product Not Found"
+        )
+    if is_owner(product.business, user):
+        await set_stock(id, stock.stock)
+        return {"product_id": id, "stock": stock.stock}
+
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Not authenticated to perform this action",
+        headers={"WWW-Authenticate": "Bearer"}
+    )
+
+
+@app.get("/products", tags=["Product"], response_model=ProductPage)
+async def get_product_list(request: Request,
+                           limit: int = Query(100, ge=1, le=100),
+                           cursor: Optional[str] = None,
+                           sort: str = Query("newest", regex="^(newest|price_asc|price_desc)$"),
+                           embed_business: bool = False):
+    async def build():
+        order = PRODUCT_SORTS[sort]
+        queryset = paginate(Product.all(), order, limit, cursor)
+        if not embed_business:
+            if fast_serialization():
+                products = await product_rows(queryset)
+            else:
+                products = await product_pydantic.from_queryset(queryset)
+            products, next_cursor = next_page(products, order, limit)
+            return {"data": products, "next_cursor": next_cursor}
+
+        products, next_cursor = next_page(await with_business(queryset), order, limit)
+        return {
+            "data": [ProductWithBusiness(**product_pydantic.from_orm(product).dict(),
+                                         business=business_pydantic.from_orm(product.business))
+                     for product in products],
+            "next_cursor": next_cursor
+        }
 
-    response = await product_pydantic.from_queryset(Product.filter(id__gt=skip, id__lte=skip+limit))
-    return response
+    return await get_response_cache().respond(request, build)
+
+
+@app.get("/products/search", tags=["Product"], response_model=ProductSearchPage)
+async def search_product_list(request: Request,
+                              q: Optional[str] = Query(None, max_length=200),
+                              category: Optional[str] = None,
+                              min_price: Optional[float] = Query(None, ge=0),
+                              max_price: Optional[float] = Query(None, ge=0),
+                              min_discount: Optional[int] = Query(None, ge=0, le=100),
+                              sort: str = Query("relevance", regex=f"^({'|'.join(SEARCH_SORTS)})$"),
+                              limit: int = Query(20, ge=1, le=100),
+                              offset: int = Query(0, ge=0, le=10000)):
+    async def build():
+        products, result = await search_products(SearchQuery(
+            q=q, category=category, min_price=min_price, max_price=max_price,
+            min_discount=min_discount, sort=sort, limit=limit, offset=offset))
+        return {
+            "data": [product_pydantic.from_orm(product) for product in products],
+            "total": result.total,
+            "facets": result.facets
+        }
 
+    return await get_response_cache().respond(request, build)
 
-@app.get("/products/{id}", tags=["Product"])
-async def get_product_detail(id: int):
-    product = await Product.get(id=id)
-    business = await product.business
-    owner = await business.owner
-    response = await product_pydantic.from_queryset_single(Product.get(id=id))
-    response = response.dict()
-    response["product_image"] = f'{SITE_URL}{response["product_image"]}'
+
+@app.get("/deals", tags=["Product"], response_model=DealPage)
+async def get_deals(request: Request,
+                    category: Optional[str] = None,
+                    limit: int = Query(get_settings().DEALS_PER_CATEGORY, ge=1,
+                                       le=get_settings().DEALS_PER_CATEGORY)):
+    '''the biggest running discounts of every category (or one)'''
+    async def build():
+        deals = await top_deals(category, limit)
+        return {"data": {name: [product_pydantic.from_orm(product) for product in products]
+                         for name, products in deals.items()}}
+
+    return await get_response_cache().respond(request, build)
+
+
+@app.post("/products/bulk", tags=["Product"], response_model=BulkImportResult)
+async def bulk_import_products(request: Request,
+                               user: user_pydantic = Depends(get_current_user)):
+    '''NDJSON (one product object per line) or CSV with a header row;
+    bad rows are skipped and reported, the rest are saved'''
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type == "text/csv":
+        rows = csv_rows(request.stream())
+    elif content_type in ("application/x-ndjson", "application/jsonl"):
+        rows = ndjson_rows(request.stream())
+    else:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail="Send text/csv or application/x-ndjson")
+    return await import_products(user.business_id, rows)
+
+
+@app.post("/products/batch", tags=["Product"], response_model=ProductBatch)
+async def get_product_batch(batch: BatchIds):
+    '''up to 100 products by id in one call (a cart, a wishlist), in the
+    order asked for; their businesses come once each under "businesses"'''
+    products = await products_by_ids(batch.ids)
     return {
-        "product_details": response,
-        "business_detaild": {
-            "name": business.business_name,
-            "city": business.city,
-            "region": business.region,
-            "description": business.business_description,
-            "logo": f'{SITE_URL}{business.logo}',
-            "owner_id": owner.id,
-            "email": owner.email,
-            "join_date": owner.join_date.strftime("%b %d %Y")
-        }
+        "data": [BatchProduct(**product_pydantic.from_orm(product).dict(),
+                              business_id=product.business_id) if product else None
+                 for product in products],
+        "businesses": {product.business_id: business_pydantic.from_orm(product.business)
+                       for product in products if product},
+        "not_found": [id for id, product in zip(batch.ids, products) if product is None]
     }
 
 
+@app.get("/products/export", tags=["Product"])
+async def export_product_list(format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+                              user: user_pydantic = Depends(get_current_user)):
+    if format == "csv":
+        return StreamingResponse(
+            export_products(user.business_id, format), media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="products.csv"'})
+    return StreamingResponse(export_products(user.business_id, format),
+                             media_type="application/x-ndjson")
+
+
+@app.get("/products/{id}", tags=["Product"])
+async def get_product_detail(id: int, request: Request):
+    async def build():
+        if fast_serialization():
+            return await product_detail_row(id, SITE_URL)
+        product = await products_with_owner().get(id=id)
+        business = product.business
+        owner = business.owner
+        response = product_pydantic.from_orm(product).dict()
+        response["product_image"] = f'{SITE_URL}{response["product_image"]}'
+        return {
+            "product_details": response,
+            "business_detaild": {
+                "name": business.business_name,
+                "city": business.city,
+                "region": business.region,
+                "description": business.business_description,
+                "logo": f'{SITE_URL}{business.logo}',
+                "owner_id": owner.id,
+                "email": owner.email,
+                "join_date": owner.join_date.strftime("%b %d %Y")
+            }
+        }
+
+    return await get_response_cache().respond(request, build)
+
+
+@app.get("/changes", tags=["Changes"], response_model=ChangePage)
+async def get_changes(since: int = Query(0, ge=0),
+                      limit: int = Query(100, ge=1, le=1000)):
+    '''product and business changes after seq `since`, oldest first;
+    pass next_since back to get the ones after them'''
+    changes = await changes_since(since, limit)
+    return {"data": changes, "next_since": changes[-1]["seq"] if changes else since}
+
+
+@app.get("/changes/stream", tags=["Changes"])
+async def stream_changes(since: int = Query(0, ge=0),
+                         last_event_id: Optional[int] = Header(None)):
+    '''the same changes as Server-Sent Events, live; a reconnecting
+    EventSource sends Last-Event-ID and picks up where it left off'''
+    if last_event_id is not None:
+        since = last_event_id
+    return StreamingResponse(change_stream(since, lambda: ready),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/orders", tags=["Order"], status_code=status.HTTP_201_CREATED, response_model=OrderOut)
+async def checkout(order: OrderIn, response: Response,
+                   idempotency_key: Optional[str] = Header(None, max_length=64),
+                   user: user_pydantic = Depends(get_current_user_record)):
+    '''send the same Idempotency-Key when retrying a checkout: the first
+    order comes back (200) instead of a second one being placed'''
+    order, created = await place_order(user, order.items, idempotency_key)
+    if not created:
+        response.status_code = status.HTTP_200_OK
+    return order
+
+
+registry.counter("user_cache_hits_total", "Authenticated user cache hits",
+                 lambda: user_cache.hits)
+registry.counter("user_cache_misses_total", "Authenticated user cache misses",
+                 lambda: user_cache.misses)
+registry.gauge("user_cache_entries", "Users in the cache", lambda: len(user_cache))
+registry.counter("tokens_revoked_total", "Tokens revoked by use, refresh or logout",
+                 lambda: get_revocations().revoked)
+registry.counter("response_cache_hits_total", "Catalogue response cache hits",
+                 lambda: get_response_cache().hits)
+registry.counter("response_cache_misses_total", "Catalogue response cache misses",
+                 lambda: get_response_cache().misses)
+registry.gauge("worker_pool_pending", "Jobs running or queued per pool",
+               lambda: {pool.name: pool.pending for pool in (hash_pool, image_pool)}, label="pool")
+registry.counter("worker_pool_rejected_total", "Jobs turned away with a 503 per pool",
+                 lambda: {pool.name: pool.rejected for pool in (hash_pool, image_pool)}, label="pool")
+registry.counter("rate_limited_total", "Requests turned away with a 429 per limit",
+                 lambda: {limit.name: limit.rejected for limit in rate_limits.values()}, label="limit")
+
+
+registry.gauge("http_requests_in_flight", "Requests being handled",
+               lambda: MetricsMiddleware.in_flight)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+# true between the end of startup and the start of shutdown
+ready = False
+
+
+@app.get("/health/live", include_in_schema=False)
+async def liveness():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready", include_in_schema=False)
+async def readiness():
+    '''503 until this worker has started and once it starts draining,
+    or while the database is unreachable; route traffic on this'''
+    try:
+        if ready:
+            await Tortoise.get_connection("default").execute_query("SELECT 1")
+            return {"status": "ready"}
+    except Exception:
+        pass
+    return Response('{"status": "unavailable"}', status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    media_type="application/json")
+
+
 register_tortoise(
     app,
-    db_url="sqlite://db.sqlite3",
-    modules={"models": ["models"]},
-    generate_schemas=True,
+    config=tortoise_config(),
+    generate_schemas=get_settings().GENERATE_SCHEMAS,
     add_exception_handlers=True
 )
+
+
+@app.on_event("startup")
+async def check_schema():
+    if not get_settings().GENERATE_SCHEMAS:
+        await check_migrations()
+
+
+@app.on_event("startup")
+async def instrument_database():
+    instrument_db(Tortoise.get_connection("default"))
+
+
+@app.on_event("startup")
+async def setup_search():
+    await get_search_backend().setup()
+
+
+@app.on_event("startup")
+async def setup_deal_index():
+    # one worker fills it, the others would only race it
+    await exclusive("setup-deals", 300, setup_deals)()
+
+
+background_jobs: List[asyncio.Task] = []
+
+
+@app.on_event("startup")
+async def start_background_jobs():
+    global ready
+    # every worker sends mail, the outbox rows are claimed one by one
+    background_jobs.append(asyncio.create_task(run_dispatcher()))
+    background_jobs.append(asyncio.create_task(get_state().listen()))
+    background_jobs.append(asyncio.create_task(
+        sample_loop_lag(get_settings().LOOP_LAG_INTERVAL)))
+    # the periodic jobs run in one worker per tick
+    interval = get_settings().OFFER_EXPIRY_INTERVAL
+    if interval:
+        background_jobs.append(asyncio.create_task(
+            run_periodically(interval, exclusive("expire-offers", interval, expire_offers))))
+    interval = get_settings().MEDIA_GC_INTERVAL
+    if interval:
+        background_jobs.append(asyncio.create_task(
+            run_periodically(interval, exclusive("collect-orphans", interval, collect_orphans))))
+    # compiled before ready so the first page or mail doesn't pay for it,
+    # on a thread so the loop keeps answering /health/live meanwhile; a
+    # template that doesn't compile fails the start instead of a request
+    await asyncio.get_running_loop().run_in_executor(None, warm_up_templates)
+    ready = True
+
+
+async def drain():
+    '''stop taking work, give in-flight requests (and their background
+    tasks) up to DRAIN_TIMEOUT to finish, then stop the jobs and pools'''
+    global ready
+    ready = False
+    # open change streams end instead of holding the drain up
+    wake_streams()
+    deadline = asyncio.get_running_loop().time() + get_settings().DRAIN_TIMEOUT
+    while MetricsMiddleware.in_flight or hash_pool.pending or image_pool.pending:
+        if asyncio.get_running_loop().time() > deadline:
+            break
+        await asyncio.sleep(0.05)
+    # a cancel that lands in a library's wait_for (every aiosmtplib call
+    # is one) can be swallowed on 3.9, so cancel again until they stop
+    running = set(background_jobs)
+    while running:
+        for job in running:
+            job.cancel()
+        _, running = await asyncio.wait(running, timeout=0.1)
+    await asyncio.gather(*background_jobs, return_exceptions=True)
+    background_jobs.clear()
+    hash_pool.shutdown()
+    image_pool.shutdown()
+
+
+# ahead of register_tortoise's handler, so the jobs stop while the
+# database is still open
+app.router.on_shutdown.insert(0, drain)
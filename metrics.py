@@ -0,0 +1,272 @@
+"""
+request metrics in the Prometheus text format, served on /metrics
+
+every request gets a RequestStats in a context variable; the db
+client, the worker pools and the SMTP dispatcher add the time they
+spend to it through `timed()`, and MetricsMiddleware turns it into
+per-route histograms once the response is sent.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from config import get_settings
+
+logger = logging.getLogger(__name__)
+
+SECONDS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERIES = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+MAX_LOGGED_QUERIES = 50
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = SECONDS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., sum, count]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, series):
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_labels(self.labels, labels, le)} {count}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_labels(self.labels, labels, le)} {series[-1]}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {series[-2]}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {series[-1]}"
+
+
+class Callback:
+    '''a counter or gauge read at scrape time, e.g. cache hits;
+    `read` returns a number or {label value: number}'''
+
+    def __init__(self, name: str, help: str, kind: str,
+                 read: Callable, label: Optional[str] = None) -> None:
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.read = read
+        self.label = label
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        value = self.read()
+        if isinstance(value, dict):
+            for label, number in sorted(value.items()):
+                yield f"{self.name}{_labels((self.label,), (label,))} {number}"
+        else:
+            yield f"{self.name} {value}"
+
+
+class Registry:
+
+    def __init__(self) -> None:
+        self.metrics: list = []
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, read: Callable, label: Optional[str] = None) -> None:
+        self.metrics.append(Callback(name, help, "counter", read, label))
+
+    def gauge(self, name: str, help: str, read: Callable, label: Optional[str] = None) -> None:
+        self.metrics.append(Callback(name, help, "gauge", read, label))
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    "http_request_duration_seconds", "Time to send the full response",
+    labels=("method", "route", "status"))
+REQUEST_COMPONENT_SECONDS = registry.histogram(
+    "http_request_component_seconds", "Time a request spent in db/bcrypt/pillow/smtp",
+    labels=("route", "component"))
+REQUEST_QUERIES = registry.histogram(
+    "http_request_queries", "SQL statements issued per request",
+    labels=("route",), buckets=QUERIES)
+OPERATION_SECONDS = registry.histogram(
+    "operation_duration_seconds", "Duration of every single db/bcrypt/pillow/smtp call, "
+    "including background work", labels=("component",))
+LOOP_LAG_SECONDS = registry.histogram(
+    "event_loop_lag_seconds", "How late a sleep on the event loop wakes up",
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+
+
+class RequestStats:
+
+    def __init__(self, capture_queries: bool = False) -> None:
+        self.seconds: Dict[str, float] = {}
+        self.query_count = 0
+        # only kept when the slow request log is on
+        self.queries: Optional[List[str]] = [] if capture_queries else None
+
+    def add(self, component: str, seconds: float) -> None:
+        self.seconds[component] = self.seconds.get(component, 0.0) + seconds
+
+    def query(self, sql: str) -> None:
+        self.query_count += 1
+        if self.queries is not None and len(self.queries) < MAX_LOGGED_QUERIES:
+            self.queries.append(sql)
+
+
+current: "contextvars.ContextVar[Optional[RequestStats]]" = \
+    contextvars.ContextVar("request_stats", default=None)
+
+
+@contextmanager
+def timed(component: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        OPERATION_SECONDS.observe(elapsed, component)
+        stats = current.get()
+        if stats is not None:
+            stats.add(component, elapsed)
+
+
+# set while a db call is timed, so a client method calling another
+# one is not counted twice
+_in_db: "contextvars.ContextVar[bool]" = contextvars.ContextVar("in_db", default=False)
+DB_METHODS = ("execute_query", "execute_query_dict", "execute_insert",
+              "execute_many", "execute_script")
+
+
+def _timed_db_method(method):
+    async def wrapper(self, query, *args, **kwargs):
+        if _in_db.get():
+            return await method(self, query, *args, **kwargs)
+        token = _in_db.set(True)
+        try:
+            stats = current.get()
+            if stats is not None:
+                stats.query(query)
+            with timed("db"):
+                return await method(self, query, *args, **kwargs)
+        finally:
+            _in_db.reset(token)
+    wrapper.timed = True
+    return wrapper
+
+
+def instrument_db(connection) -> None:
+    '''time every statement run through this kind of tortoise client
+    (and its transaction wrapper, a subclass)'''
+    client_class = type(connection)
+    for cls in (client_class, *client_class.__subclasses__()):
+        for name in DB_METHODS:
+            method = cls.__dict__.get(name)
+            if method is not None and not getattr(method, "timed", False):
+                setattr(cls, name, _timed_db_method(method))
+
+
+class MetricsMiddleware:
+    '''plain ASGI middleware: the histograms are observed when the last
+    body chunk is sent, so background tasks don't count as latency'''
+
+    # requests being handled, background tasks included; shutdown
+    # waits for this to reach 0
+    in_flight = 0
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self._routes: Dict[Callable, str] = {}
+
+    def route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if endpoint not in self._routes:
+            self._routes = {route.endpoint: route.path for route in scope["app"].routes
+                            if hasattr(route, "endpoint")}
+        return self._routes.get(endpoint, "unmatched")
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        slow_after = get_settings().SLOW_REQUEST_SECONDS
+        stats = RequestStats(capture_queries=slow_after > 0)
+        token = current.set(stats)
+        start = time.perf_counter()
+        status_code = 500
+        done = False
+
+        def finish() -> None:
+            nonlocal done
+            done = True
+            elapsed = time.perf_counter() - start
+            route = self.route(scope)
+            REQUEST_SECONDS.observe(elapsed, scope["method"], route, str(status_code))
+            REQUEST_QUERIES.observe(stats.query_count, route)
+            for component, seconds in stats.seconds.items():
+                REQUEST_COMPONENT_SECONDS.observe(seconds, route, component)
+            if slow_after and elapsed >= slow_after:
+                logger.warning(
+                    "slow request %s %s: %.3fs (%s), %s queries%s",
+                    scope["method"], scope["path"], elapsed,
+                    ", ".join(f"{name} {seconds:.3f}s" for name, seconds in stats.seconds.items()),
+                    stats.query_count, "".join("\n  " + sql for sql in stats.queries))
+
+        async def send_and_measure(message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                finish()
+
+        MetricsMiddleware.in_flight += 1
+        try:
+            await self.app(scope, receive, send_and_measure)
+        finally:
+            MetricsMiddleware.in_flight -= 1
+            if not done:
+                finish()
+            current.reset(token)
+
+
+async def sample_loop_lag(interval: float) -> None:
+    '''a blocked event loop shows up as sleeps that wake up late'''
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - start - interval))
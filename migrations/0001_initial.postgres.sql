@@ -0,0 +1,48 @@
+CREATE TABLE IF NOT EXISTS "outboxemail" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "recipients" TEXT NOT NULL,
+    "subject" VARCHAR(255) NOT NULL,
+    "body" TEXT NOT NULL,
+    "subtype" VARCHAR(10) NOT NULL  DEFAULT 'html',
+    "status" VARCHAR(10) NOT NULL  DEFAULT 'pending',
+    "attempts" INT NOT NULL  DEFAULT 0,
+    "lease" INT NOT NULL  DEFAULT 0,
+    "next_attempt_at" TIMESTAMPTZ NOT NULL,
+    "last_error" TEXT,
+    "created_at" TIMESTAMPTZ NOT NULL,
+    "sent_at" TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS "idx_outboxemail_status_830028" ON "outboxemail" ("status", "next_attempt_at");
+CREATE TABLE IF NOT EXISTS "user" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "username" VARCHAR(30) NOT NULL UNIQUE,
+    "email" VARCHAR(200) NOT NULL UNIQUE,
+    "password" VARCHAR(200) NOT NULL,
+    "is_verifide" BOOL NOT NULL  DEFAULT False,
+    "join_date" TIMESTAMPTZ NOT NULL
+);
+CREATE TABLE IF NOT EXISTS "business" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "business_name" VARCHAR(30) NOT NULL UNIQUE,
+    "city" VARCHAR(100) NOT NULL  DEFAULT 'Unspecified',
+    "region" VARCHAR(100) NOT NULL  DEFAULT 'Unspecified',
+    "business_description" TEXT,
+    "logo" VARCHAR(200) NOT NULL  DEFAULT 'default.jpg',
+    "owner_id" INT NOT NULL REFERENCES "user" ("id") ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS "product" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "name" VARCHAR(100) NOT NULL,
+    "category" VARCHAR(30) NOT NULL,
+    "original_price" DECIMAL(20,2) NOT NULL,
+    "new_price" DECIMAL(20,2) NOT NULL,
+    "percentage_discount" INT NOT NULL,
+    "offer_expiration_date" DATE NOT NULL,
+    "product_image" VARCHAR(200) NOT NULL  DEFAULT 'productDefault.jpg',
+    "date_published" TIMESTAMPTZ NOT NULL,
+    "business_id" INT NOT NULL REFERENCES "business" ("id") ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS "idx_product_name_683352" ON "product" ("name");
+CREATE INDEX IF NOT EXISTS "idx_product_categor_5402db" ON "product" ("category");
+CREATE INDEX IF NOT EXISTS "idx_product_date_pu_2b8abf" ON "product" ("date_published", "id");
+CREATE INDEX IF NOT EXISTS "idx_product_new_pri_e8bdcb" ON "product" ("new_price", "id");
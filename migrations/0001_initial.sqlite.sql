@@ -0,0 +1,49 @@
+CREATE TABLE IF NOT EXISTS "outboxemail" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "recipients" TEXT NOT NULL,
+    "subject" VARCHAR(255) NOT NULL,
+    "body" TEXT NOT NULL,
+    "subtype" VARCHAR(10) NOT NULL  DEFAULT 'html',
+    "status" VARCHAR(10) NOT NULL  DEFAULT 'pending',
+    "attempts" INT NOT NULL  DEFAULT 0,
+    "lease" INT NOT NULL  DEFAULT 0,
+    "next_attempt_at" TIMESTAMP NOT NULL,
+    "last_error" TEXT,
+    "created_at" TIMESTAMP NOT NULL,
+    "sent_at" TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS "idx_outboxemail_status_830028" ON "outboxemail" ("status", "next_attempt_at");
+CREATE TABLE IF NOT EXISTS "user" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "username" VARCHAR(30) NOT NULL UNIQUE,
+    "email" VARCHAR(200) NOT NULL UNIQUE,
+    "password" VARCHAR(200) NOT NULL,
+    "is_verifide" INT NOT NULL  DEFAULT 0,
+    "join_date" TIMESTAMP NOT NULL
+);
+CREATE TABLE IF NOT EXISTS "business" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "business_name" VARCHAR(30) NOT NULL UNIQUE,
+    "city" VARCHAR(100) NOT NULL  DEFAULT 'Unspecified',
+    "region" VARCHAR(100) NOT NULL  DEFAULT 'Unspecified',
+    "business_description" TEXT,
+    "logo" VARCHAR(200) NOT NULL  DEFAULT 'default.jpg',
+    "owner_id" INT NOT NULL REFERENCES "user" ("id") ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS "product" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "name" VARCHAR(100) NOT NULL,
+    "category" VARCHAR(30) NOT NULL,
+    "original_price" VARCHAR(40) NOT NULL,
+    "new_price" VARCHAR(40) NOT NULL,
+    "percentage_discount" INT NOT NULL,
+    "offer_expiration_date" DATE NOT NULL,
+    "product_image" VARCHAR(200) NOT NULL  DEFAULT 'productDefault.jpg',
+    "date_published" TIMESTAMP NOT NULL,
+    "business_id" INT NOT NULL REFERENCES "business" ("id") ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS "idx_product_name_683352" ON "product" ("name");
+CREATE INDEX IF NOT EXISTS "idx_product_categor_5402db" ON "product" ("category");
+CREATE INDEX IF NOT EXISTS "idx_product_date_pu_2b8abf" ON "product" ("date_published", "id");
+CREATE INDEX IF NOT EXISTS "idx_product_new_pri_e8bdcb" ON "product" ("new_price", "id");
+CREATE INDEX IF NOT EXISTS "idx_product_price_numeric" ON "product" (CAST("new_price" AS NUMERIC), "id");
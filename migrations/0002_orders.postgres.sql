@@ -0,0 +1,23 @@
+CREATE TABLE IF NOT EXISTS "inventory" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "stock" INT NOT NULL  DEFAULT 0 CHECK ("stock" >= 0),
+    "product_id" INT NOT NULL UNIQUE REFERENCES "product" ("id") ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS "order" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "status" VARCHAR(20) NOT NULL  DEFAULT 'placed',
+    "total" DECIMAL(20,2) NOT NULL,
+    "idempotency_key" VARCHAR(64),
+    "created_at" TIMESTAMPTZ NOT NULL,
+    "user_id" INT NOT NULL REFERENCES "user" ("id") ON DELETE CASCADE,
+    CONSTRAINT "uid_order_user_id_a568df" UNIQUE ("user_id", "idempotency_key")
+);
+CREATE TABLE IF NOT EXISTS "orderitem" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "name" VARCHAR(100) NOT NULL,
+    "quantity" INT NOT NULL,
+    "unit_price" DECIMAL(20,2) NOT NULL,
+    "order_id" INT NOT NULL REFERENCES "order" ("id") ON DELETE CASCADE,
+    "product_id" INT REFERENCES "product" ("id") ON DELETE SET NULL
+);
+CREATE INDEX IF NOT EXISTS "idx_orderitem_order_id" ON "orderitem" ("order_id");
@@ -0,0 +1,10 @@
+CREATE INDEX IF NOT EXISTS "idx_product_categor_3bece9" ON "product" ("category", "percentage_discount", "id");
+-- deals.expire_offers, only products with a running offer are indexed
+CREATE INDEX IF NOT EXISTS "idx_product_offer_running" ON "product" ("offer_expiration_date") WHERE "percentage_discount" > 0;
+CREATE TABLE IF NOT EXISTS "deal" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "category" VARCHAR(30) NOT NULL,
+    "percentage_discount" INT NOT NULL,
+    "product_id" INT NOT NULL UNIQUE REFERENCES "product" ("id") ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS "idx_deal_categor_4d9d5e" ON "deal" ("category", "percentage_discount");
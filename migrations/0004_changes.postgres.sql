@@ -0,0 +1,9 @@
+-- the catalogue change log, see changes.py
+CREATE TABLE IF NOT EXISTS "changeevent" (
+    "seq" BIGSERIAL NOT NULL PRIMARY KEY,
+    "entity" VARCHAR(20) NOT NULL,
+    "entity_id" INT NOT NULL,
+    "action" VARCHAR(10) NOT NULL,
+    "data" JSONB,
+    "created_at" TIMESTAMPTZ NOT NULL
+);
@@ -0,0 +1,9 @@
+-- the catalogue change log, see changes.py; AUTOINCREMENT so a seq is never reused
+CREATE TABLE IF NOT EXISTS "changeevent" (
+    "seq" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "entity" VARCHAR(20) NOT NULL,
+    "entity_id" INT NOT NULL,
+    "action" VARCHAR(10) NOT NULL,
+    "data" JSON,
+    "created_at" TIMESTAMP NOT NULL
+);
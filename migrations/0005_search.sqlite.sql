@@ -0,0 +1,8 @@
+-- the FTS5 search index, see search.FTS5Backend; rowid = product id.
+-- Databases that predate this migration may have it already (it used
+-- to be created at startup), so the backfill replaces instead of inserting
+CREATE VIRTUAL TABLE IF NOT EXISTS "product_fts" USING fts5(
+    name, category, tokenize="unicode61 remove_diacritics 2"
+);
+INSERT OR REPLACE INTO "product_fts" (rowid, name, category)
+    SELECT "id", "name", "category" FROM "product";
@@ -1,6 +1,10 @@
 from tortoise import Model, fields
 from tortoise.contrib.pydantic import pydantic_model_creator
+from pydantic import BaseModel, conint, conlist, constr, validator
 from datetime import datetime
+from decimal import Decimal
+import re
+from typing import Dict, List, Optional, Union
 
 
 class User(Model):
@@ -37,6 +41,85 @@ class Product(Model):
     business = fields.ForeignKeyField(
         "models.Business", related_name="product")
 
+    class Meta:
+        # one composite index per sort in pagination.PRODUCT_SORTS, and
+        # a category's biggest discounts for deals.refresh_category
+        indexes = (("date_published", "id"), ("new_price", "id"),
+                   ("category", "percentage_discount", "id"))
+
+
+# a category's top active offers, maintained by deals.py
+class Deal(Model):
+    id = fields.IntField(pk=True)
+    product = fields.OneToOneField("models.Product", related_name="deal")
+    category = fields.CharField(max_length=30)
+    percentage_discount = fields.IntField()
+
+    class Meta:
+        indexes = (("category", "percentage_discount"),)
+
+
+class Inventory(Model):
+    # no row means nothing in stock; checkout only ever decrements with
+    # a conditional UPDATE, see orders.reserve
+    product = fields.OneToOneField("models.Product", related_name="inventory")
+    stock = fields.IntField(default=0)
+
+
+class Order(Model):
+    id = fields.IntField(pk=True)
+    user = fields.ForeignKeyField("models.User", related_name="orders")
+    status = fields.CharField(max_length=20, default="placed")
+    total = fields.DecimalField(max_digits=20, decimal_places=2)
+    # client supplied, a retried checkout with the same key gets this order back
+    idempotency_key = fields.CharField(max_length=64, null=True)
+    created_at = fields.DatetimeField(default=datetime.utcnow)
+
+    class Meta:
+        unique_together = (("user", "idempotency_key"),)
+
+
+class OrderItem(Model):
+    id = fields.IntField(pk=True)
+    order = fields.ForeignKeyField("models.Order", related_name="items")
+    # name and price are copied, the order outlives product edits and deletes
+    product = fields.ForeignKeyField("models.Product", related_name="order_items",
+                                     null=True, on_delete=fields.SET_NULL)
+    name = fields.CharField(max_length=100)
+    quantity = fields.IntField()
+    unit_price = fields.DecimalField(max_digits=20, decimal_places=2)
+
+
+class OutboxEmail(Model):
+    id = fields.IntField(pk=True)
+    recipients = fields.TextField()  # comma separated
+    subject = fields.CharField(max_length=255)
+    body = fields.TextField()
+    subtype = fields.CharField(max_length=10, default="html")
+    # pending -> sent, or dead after OUTBOX_MAX_ATTEMPTS
+    status = fields.CharField(max_length=10, default="pending")
+    attempts = fields.IntField(default=0)
+    lease = fields.IntField(default=0)
+    next_attempt_at = fields.DatetimeField(default=datetime.utcnow)
+    last_error = fields.TextField(null=True)
+    created_at = fields.DatetimeField(default=datetime.utcnow)
+    sent_at = fields.DatetimeField(null=True)
+
+    class Meta:
+        indexes = (("status", "next_attempt_at"),)
+
+
+# append-only log of catalogue writes, see changes.py; seq never goes
+# back, a consumer resumes after the last one it saw
+class ChangeEvent(Model):
+    seq = fields.BigIntField(pk=True)
+    entity = fields.CharField(max_length=20)  # "product" or "business"
+    entity_id = fields.IntField()
+    action = fields.CharField(max_length=10)  # create, update or delete
+    # the row after the change, null for a delete
+    data = fields.JSONField(null=True)
+    created_at = fields.DatetimeField(default=datetime.utcnow)
+
 
 user_pydantic = pydantic_model_creator(
     User, name="User", exclude=("is_verifide", ))
@@ -47,6 +130,28 @@ user_pydanticIn = pydantic_model_creator(
 user_pydanticOut = pydantic_model_creator(
     User, name="UserOut", exclude=("password", ))
 
+# compiled once; no nested or overlapping quantifiers, so a bad
+# address fails in linear time instead of backtracking
+EMAIL_REGEX = re.compile(
+    r"^[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,}$")
+
+
+class UserRegistration(BaseModel):
+    '''POST /users/ body, fully checked before the database is touched'''
+    username: constr(min_length=5, max_length=30)
+    email: constr(max_length=200)
+    password: constr(min_length=8, max_length=128)
+
+    @validator("email")
+    def valid_email(cls, email: str) -> str:
+        if not EMAIL_REGEX.match(email):
+            raise ValueError("This is not a valid email")
+        return email
+
+
+class RefreshToken(BaseModel):
+    refresh_token: str
+
 
 business_pydantic = pydantic_model_creator(Business, name="Business")
 business_pydanticIn = pydantic_model_creator(
@@ -55,3 +160,111 @@ business_pydanticIn = pydantic_model_creator(
 product_pydantic = pydantic_model_creator(Product, name="Product")
 product_pydanticIn = pydantic_model_creator(
     Product, name="ProductIn", exclude=("percentage_discount", "id", "product_image", "date_published"))
+
+
+class UserPage(BaseModel):
+    data: List[user_pydanticOut]
+    next_cursor: Optional[str]
+
+
+class ProductWithBusiness(product_pydantic):
+    business: business_pydantic
+
+
+class ProductPage(BaseModel):
+    # embedded rows must be tried first, they are a superset
+    data: List[Union[ProductWithBusiness, product_pydantic]]
+    next_cursor: Optional[str]
+
+
+class BatchIds(BaseModel):
+    # a repeated id is answered at each of its places
+    ids: conlist(int, min_items=1, max_items=100)
+
+
+class BatchProduct(product_pydantic):
+    business_id: int
+
+
+class ProductBatch(BaseModel):
+    # one entry per requested id, in order; null where there is no such product
+    data: List[Optional[BatchProduct]]
+    # business id -> business, once however many of the products share it
+    businesses: Dict[int, business_pydantic]
+    not_found: List[int]
+
+
+class BusinessBatch(BaseModel):
+    data: List[Optional[business_pydantic]]
+    not_found: List[int]
+
+
+class Facet(BaseModel):
+    value: str
+    count: int
+
+
+class ProductSearchPage(BaseModel):
+    data: List[product_pydantic]
+    total: int
+    facets: Dict[str, List[Facet]]
+
+
+class DealPage(BaseModel):
+    # category -> its deals, biggest discount first
+    data: Dict[str, List[product_pydantic]]
+
+
+class RowError(BaseModel):
+    line: int
+    errors: List[str]
+
+
+class BulkImportResult(BaseModel):
+    created: int
+    failed: int
+    # at most catalogue.MAX_REPORTED_ERRORS rows
+    errors: List[RowError]
+
+
+class OrderLine(BaseModel):
+    product_id: int
+    quantity: conint(ge=1, le=1000)
+
+
+class OrderIn(BaseModel):
+    items: conlist(OrderLine, min_items=1, max_items=100)
+
+
+class OrderItemOut(BaseModel):
+    product_id: Optional[int]
+    name: str
+    quantity: int
+    unit_price: Decimal
+
+
+class OrderOut(BaseModel):
+    id: int
+    status: str
+    total: Decimal
+    created_at: datetime
+    items: List[OrderItemOut]
+
+
+class StockIn(BaseModel):
+    stock: conint(ge=0)
+
+
+class Change(BaseModel):
+    seq: int
+    entity: str
+    entity_id: int
+    action: str
+    data: Optional[Dict]
+    created_at: datetime
+
+
+class ChangePage(BaseModel):
+    data: List[Change]
+    # the seq to ask for next, unchanged when there was nothing new
+    next_since: int
@@ -0,0 +1,114 @@
+"""
+checkout
+
+stock is only ever taken with a conditional
+UPDATE ... SET stock = stock - n WHERE stock >= n, one per item and all
+in the order's transaction. The database serializes buyers on the row;
+an UPDATE that matches nothing means the item is out of stock and rolls
+the whole order back. Nothing is read and written back, so two
+checkouts can never both get the last unit.
+"""
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from tortoise import BaseDBAsyncClient
+from tortoise.exceptions import IntegrityError
+from tortoise.expressions import F
+from tortoise.transactions import in_transaction
+
+from models import Inventory, Order, OrderItem, OrderLine, Product, User
+from emails import send_order_receipt
+
+
+def merge_lines(lines: List[OrderLine]) -> Dict[int, int]:
+    '''product id -> quantity, in id order so concurrent multi-item
+    checkouts lock rows in the same order and can't deadlock'''
+    quantities: Dict[int, int] = {}
+    for line in lines:
+        quantities[line.product_id] = quantities.get(line.product_id, 0) + line.quantity
+    return dict(sorted(quantities.items()))
+
+
+async def reserve(connection: BaseDBAsyncClient, product_id: int, quantity: int) -> bool:
+    updated = await Inventory.filter(product_id=product_id, stock__gte=quantity) \
+        .using_db(connection).update(stock=F("stock") - quantity)
+    return updated == 1
+
+
+async def set_stock(product_id: int, stock: int) -> None:
+    # one upsert: an UPDATE then INSERT lets two first-time sets both
+    # miss the row, and the second INSERT fails on the unique product_id
+    async with in_transaction() as connection:
+        params = ["$1", "$2"] if connection.capabilities.dialect == "postgres" else ["?", "?"]
+        await connection.execute_query(
+            f'INSERT INTO "inventory" ("product_id", "stock") VALUES ({params[0]}, {params[1]}) '
+            'ON CONFLICT ("product_id") DO UPDATE SET "stock" = EXCLUDED."stock"',
+            [product_id, stock])
+
+
+def order_out(order: Order, items: List[OrderItem]) -> Dict[str, Any]:
+    return {
+        "id": order.id,
+        "status": order.status,
+        "total": order.total,
+        "created_at": order.created_at,
+        "items": [{"product_id": item.product_id, "name": item.name,
+                   "quantity": item.quantity, "unit_price": item.unit_price}
+                  for item in items]
+    }
+
+
+async def existing_order(user_id: int, idempotency_key: Optional[str]) -> Optional[Dict[str, Any]]:
+    if idempotency_key is None:
+        return None
+    order = await Order.get_or_none(user_id=user_id, idempotency_key=idempotency_key)
+    if order is None:
+        return None
+    return order_out(order, await OrderItem.filter(order_id=order.id).order_by("id"))
+
+
+async def place_order(user: User, lines: List[OrderLine],
+                      idempotency_key: Optional[str] = None) -> Tuple[Dict[str, Any], bool]:
+    '''(the order, whether it was created now); a key that was already
+    used by this user returns that order and takes no stock'''
+    order = await existing_order(user.id, idempotency_key)
+    if order is not None:
+        return order, False
+
+    quantities = merge_lines(lines)
+    products = {row["id"]: row for row in
+                await Product.filter(id__in=list(quantities)).values("id", "name", "new_price")}
+    missing = [str(product_id) for product_id in quantities if product_id not in products]
+    if missing:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Product Not Found: {', '.join(missing)}")
+    items = [OrderItem(product_id=product_id, name=products[product_id]["name"],
+                       quantity=quantity, unit_price=products[product_id]["new_price"])
+             for product_id, quantity in quantities.items()]
+    total = sum((item.unit_price * item.quantity for item in items), Decimal(0))
+
+    try:
+        async with in_transaction() as connection:
+            for item in items:
+                if not await reserve(connection, item.product_id, item.quantity):
+                    raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                        detail=f"Not enough stock for {item.name}")
+            order = await Order.create(user_id=user.id, total=total,
+                                       idempotency_key=idempotency_key, using_db=connection)
+            for item in items:
+                item.order_id = order.id
+            await OrderItem.bulk_create(items, using_db=connection)
+            await send_order_receipt(
+                user, order.id,
+                [{"name": item.name, "quantity": item.quantity, "unit_price": item.unit_price}
+                 for item in items],
+                total, using_db=connection)
+    except IntegrityError:
+        # a retry with the same key committed first; ours rolled back,
+        # stock included
+        order = await existing_order(user.id, idempotency_key)
+        if order is None:
+            raise
+        return order, False
+    return order_out(order, items), True
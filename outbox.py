@@ -0,0 +1,158 @@
+"""
+email outbox
+
+mail is written to the OutboxEmail table (in the caller's transaction)
+and sent later by a background dispatcher, so a slow or failing SMTP
+server never fails or delays the request that produced the mail.
+
+the dispatcher claims due rows with a conditional UPDATE, so several
+workers can run it against one database without sending twice; a
+claim that is never completed (crashed worker) expires after
+OUTBOX_LEASE seconds and the row is picked up again.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from typing import TYPE_CHECKING, List, Optional
+
+from tortoise import BaseDBAsyncClient
+
+from models import OutboxEmail
+from config import get_settings
+from metrics import timed
+
+if TYPE_CHECKING:
+    from aiosmtplib import SMTP
+
+logger = logging.getLogger(__name__)
+
+PENDING, SENT, DEAD = "pending", "sent", "dead"
+
+# set by enqueue() so the dispatcher doesn't wait for the next poll
+_wakeup: Optional[asyncio.Event] = None
+
+
+async def enqueue(recipients: List[str], subject: str, body: str,
+                  subtype: str = "html",
+                  using_db: Optional[BaseDBAsyncClient] = None) -> OutboxEmail:
+    email = await OutboxEmail.create(recipients=",".join(recipients),
+                                     subject=subject, body=body,
+                                     subtype=subtype, using_db=using_db)
+    if _wakeup is not None:
+        _wakeup.set()
+    return email
+
+
+def build_message(email: OutboxEmail) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = get_settings().MAIL_FROM
+    message["To"] = email.recipients
+    message["Subject"] = email.subject
+    message.set_content(email.body, subtype=email.subtype)
+    return message
+
+
+async def claim(email: OutboxEmail, now: datetime) -> bool:
+    '''take the row for one lease; False if another dispatcher got it first'''
+    lease_end = now + timedelta(seconds=get_settings().OUTBOX_LEASE)
+    claimed = await OutboxEmail.filter(id=email.id, status=PENDING, lease=email.lease).update(
+        lease=email.lease + 1, next_attempt_at=lease_end)
+    email.lease += 1
+    return claimed == 1
+
+
+async def failed(email: OutboxEmail, error: Exception, now: datetime) -> None:
+    settings = get_settings()
+    email.attempts += 1
+    email.last_error = repr(error)[:1000]
+    if email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        email.status = DEAD
+        logger.error("outbox email %s is dead after %s attempts: %r",
+                     email.id, email.attempts, error)
+    else:
+        delay = min(settings.OUTBOX_BACKOFF * 2 ** (email.attempts - 1), 3600)
+        email.next_attempt_at = now + timedelta(seconds=delay)
+    await email.save(update_fields=["attempts", "last_error", "status", "next_attempt_at"])
+
+
+def smtp_client() -> "SMTP":
+    # imported on the first send, most workers start with nothing to send
+    from aiosmtplib import SMTP
+
+    settings = get_settings()
+    credentials = {}
+    if settings.USE_CREDENTIALS:
+        credentials = {"username": settings.MAIL_USERNAME,
+                       "password": settings.MAIL_PASSWORD}
+    return SMTP(hostname=settings.MAIL_SERVER, port=settings.MAIL_PORT,
+                use_tls=settings.MAIL_SSL, start_tls=settings.MAIL_TLS,
+                validate_certs=settings.VALIDATE_CERTS, **credentials)
+
+
+async def dispatch_batch() -> int:
+    '''send up to OUTBOX_BATCH_SIZE due emails over one SMTP connection,
+    returns how many were claimed'''
+    now = datetime.utcnow()
+    due = await OutboxEmail.filter(status=PENDING, next_attempt_at__lte=now) \
+        .order_by("next_attempt_at").limit(get_settings().OUTBOX_BATCH_SIZE)
+    batch = [email for email in due if await claim(email, now)]
+    if not batch:
+        return 0
+
+    try:
+        smtp = smtp_client()
+        with timed("smtp"):
+            await smtp.connect()
+    except Exception as e:
+        for email in batch:
+            await failed(email, e, now)
+        return len(batch)
+
+    try:
+        for email in batch:
+            try:
+                with timed("smtp"):
+                    await smtp.send_message(build_message(email))
+            except Exception as e:
+                await failed(email, e, now)
+                if not smtp.is_connected:
+                    with timed("smtp"):
+                        await smtp.connect()
+                continue
+            email.status = SENT
+            email.sent_at = datetime.utcnow()
+            await email.save(update_fields=["status", "sent_at"])
+    except Exception as e:
+        # reconnect failed; the rest of the batch retries after the lease
+        logger.warning("outbox batch aborted: %r", e)
+    finally:
+        if smtp.is_connected:
+            try:
+                await smtp.quit()
+            except Exception:
+                smtp.close()
+    return len(batch)
+
+
+async def run_dispatcher() -> None:
+    '''send due mail until cancelled; sleeps until enqueue() is called
+    or OUTBOX_POLL_INTERVAL passes'''
+    global _wakeup
+    _wakeup = asyncio.Event()
+    while True:
+        try:
+            while await dispatch_batch() == get_settings().OUTBOX_BATCH_SIZE:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("outbox dispatch failed")
+        # not wait_for: on 3.9 it swallows a cancel that lands just as
+        # enqueue() wakes us, and shutdown would wait on us forever
+        waiter = asyncio.ensure_future(_wakeup.wait())
+        try:
+            await asyncio.wait({waiter}, timeout=get_settings().OUTBOX_POLL_INTERVAL)
+        finally:
+            waiter.cancel()
+        _wakeup.clear()
@@ -0,0 +1,128 @@
+"""
+keyset (cursor) pagination
+
+pages are selected with `WHERE (sort keys) > (last seen keys)` instead of
+an offset or an id range, so every page costs one index range scan no
+matter how deep the client goes, and deleted rows never shorten a page.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from typing import Any, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from pypika.enums import SqlTypes
+from pypika.functions import Cast
+from tortoise.functions import Function
+from tortoise.query_utils import Q
+from tortoise.queryset import QuerySet
+
+
+class Numeric(Function):
+    '''CAST(field AS NUMERIC); sqlite stores DecimalField as text'''
+    database_func = Cast
+
+    def __init__(self, field: str) -> None:
+        super().__init__(field, SqlTypes.NUMERIC)
+
+
+class Sort:
+    '''an ordering over unique keys; the last key must be the primary key'''
+
+    def __init__(self, name: str, *keys: Tuple[str, type], descending: bool = False):
+        self.name = name
+        self.keys = keys
+        self.descending = descending
+
+    def columns(self, queryset: QuerySet) -> Tuple[QuerySet, List[str]]:
+        '''names to filter and order on; sqlite decimal keys go through
+        a CAST annotation, as text '10.00' would sort before '9.00' '''
+        names = []
+        sqlite = queryset.model._meta.db.capabilities.dialect == "sqlite"
+        for i, (field, kind) in enumerate(self.keys):
+            if kind is Decimal and sqlite:
+                name = f"_key{i}"
+                queryset = queryset.annotate(**{name: Numeric(field)})
+                names.append(name)
+            else:
+                names.append(field)
+        return queryset, names
+
+
+# every sort here is backed by a composite index in models.py
+# (sqlite gets an expression index instead, see migrations/)
+PRODUCT_SORTS = {
+    "newest": Sort("newest", ("date_published", datetime), ("id", int), descending=True),
+    "price_asc": Sort("price_asc", ("new_price", Decimal), ("id", int)),
+    "price_desc": Sort("price_desc", ("new_price", Decimal), ("id", int), descending=True),
+}
+
+USER_SORT = Sort("id", ("id", int))
+
+
+def _dump(value: Any) -> Any:
+    if isinstance(value, datetime):
+        # compare against the naive UTC values the db stores
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _load(value: Any, kind: type) -> Any:
+    if kind is datetime:
+        return datetime.fromisoformat(value)
+    return kind(value)
+
+
+def encode_cursor(sort: Sort, row: Any) -> str:
+    '''`row` is a model or a .values() dict'''
+    keys = [row[field] if isinstance(row, dict) else getattr(row, field)
+            for field, _ in sort.keys]
+    payload = {"s": sort.name, "k": [_dump(key) for key in keys]}
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(sort: Sort, cursor: str) -> List[Any]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        if payload["s"] != sort.name or len(payload["k"]) != len(sort.keys):
+            raise ValueError
+        return [_load(value, kind) for value, (_, kind) in zip(payload["k"], sort.keys)]
+    except (ValueError, TypeError, KeyError, InvalidOperation, binascii.Error):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid cursor")
+
+
+def _after(sort: Sort, fields: List[str], values: List[Any]) -> Q:
+    '''row-value comparison `(k1, k2, ...) > (v1, v2, ...)` spelled with Q objects'''
+    op = "lt" if sort.descending else "gt"
+    clauses = []
+    for i, field in enumerate(fields):
+        equal = {f: v for f, v in zip(fields[:i], values[:i])}
+        clauses.append(Q(**equal, **{f"{field}__{op}": values[i]}))
+    return Q(*clauses, join_type="OR")
+
+
+def paginate(queryset: QuerySet, sort: Sort, limit: int,
+             cursor: Optional[str] = None) -> QuerySet:
+    '''order the queryset by `sort` and fetch one row past the page
+    so `next_page` can tell whether there is more'''
+    queryset, names = sort.columns(queryset)
+    if cursor:
+        queryset = queryset.filter(_after(sort, names, decode_cursor(sort, cursor)))
+    prefix = "-" if sort.descending else ""
+    return queryset.order_by(*[prefix + name for name in names]).limit(limit + 1)
+
+
+def next_page(rows: List[Any], sort: Sort, limit: int) -> Tuple[List[Any], Optional[str]]:
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(sort, rows[-1])
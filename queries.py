@@ -0,0 +1,48 @@
+"""
+query planning for the Product -> Business -> User chain
+
+endpoints fetch the whole chain they need up front with
+select_related (one JOIN) or prefetch_related (one extra IN query
+shared by a whole page) instead of awaiting each relation in turn.
+"""
+from typing import List, Optional
+
+from tortoise.queryset import QuerySet
+
+from models import Business, Product
+
+
+def products_with_business() -> QuerySet[Product]:
+    '''product + business in one SELECT; enough for ownership checks'''
+    return Product.all().select_related("business")
+
+
+def products_with_owner() -> QuerySet[Product]:
+    '''product + business + owner in one SELECT'''
+    return Product.all().select_related("business__owner")
+
+
+def with_business(queryset: QuerySet[Product]) -> QuerySet[Product]:
+    '''a page of products shares few businesses, so load them with
+    one IN query instead of repeating the business columns per row'''
+    return queryset.prefetch_related("business")
+
+
+async def products_by_ids(ids: List[int]) -> List[Optional[Product]]:
+    '''the products in `ids` order, None for a missing one: one IN query
+    for the products and one for their businesses, each loaded once'''
+    products = {product.id: product
+                for product in await with_business(Product.filter(id__in=set(ids)))}
+    return [products.get(id) for id in ids]
+
+
+async def businesses_by_ids(ids: List[int]) -> List[Optional[Business]]:
+    '''the businesses in `ids` order, None for a missing one; one query'''
+    businesses = {business.id: business
+                  for business in await Business.filter(id__in=set(ids))}
+    return [businesses.get(id) for id in ids]
+
+
+def is_owner(business, user) -> bool:
+    '''compare on the foreign key so the owner row is never loaded'''
+    return business.owner_id == user.id
@@ -0,0 +1,154 @@
+"""
+token-bucket rate limiting for the expensive endpoints
+"""
+import math
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, Optional, Tuple
+
+from fastapi import Depends, HTTPException, Request, status
+
+from config import get_settings
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+def parse_rule(rule: str) -> Optional[Tuple[int, float]]:
+    '''"10/minute" -> (capacity 10, 10/60 tokens per second);
+    an empty rule or a zero count turns the limit off'''
+    if not rule:
+        return None
+    count, _, period = rule.partition("/")
+    if period not in PERIODS:
+        raise ValueError(f"invalid rate limit {rule!r}, expected e.g. 10/minute")
+    if int(count) <= 0:
+        return None
+    return int(count), int(count) / PERIODS[period]
+
+
+class MemoryBackend:
+    '''per-process buckets; with several workers every worker allows the full rate'''
+
+    def __init__(self, maxsize: int = 100000,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.maxsize = maxsize
+        self.clock = clock
+        # key -> (tokens, last refill); an evicted key just starts full again
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def take(self, key: str, capacity: int, rate: float) -> float:
+        '''take one token; return 0 or the seconds until one is available'''
+        now = self.clock()
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+# KEYS[1] bucket, ARGV capacity, rate (tokens/s), now (s); the refill
+# and take happen in one script so concurrent workers can't both spend
+# the last token. The wait goes back as a string, redis would truncate
+# a Lua number to an integer.
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("PEXPIRE", KEYS[1], math.ceil(capacity / rate * 1000))
+return tostring(wait)
+"""
+
+
+class RedisBackend:
+    '''buckets shared by every worker; a bucket expires once it would be full again'''
+
+    def __init__(self, redis, prefix: str = "rate-limit:",
+                 clock: Callable[[], float] = time.time) -> None:
+        self.redis = redis
+        self.prefix = prefix
+        self.clock = clock
+        self._take = redis.register_script(TAKE_SCRIPT)
+
+    async def take(self, key: str, capacity: int, rate: float) -> float:
+        wait = await self._take(keys=[self.prefix + key],
+                                args=[capacity, rate, self.clock()])
+        return float(wait)
+
+
+@lru_cache()
+def get_backend():
+    settings = get_settings()
+    if settings.backend("RATE_LIMIT_BACKEND") == "redis":
+        from cache import get_redis
+        return RedisBackend(get_redis())
+    return MemoryBackend(maxsize=settings.RATE_LIMIT_KEYS)
+
+
+def client_ip(request: Request) -> str:
+    # behind a proxy run uvicorn with --proxy-headers and
+    # --forwarded-allow-ips so this is the real client
+    return request.client.host if request.client else "unknown"
+
+
+class RateLimit:
+    '''a named limit such as "10/minute", used as a dependency
+
+        Depends(token_limit)                      # per client IP
+        Depends(upload_limit.per_user(get_user))  # per user, returns the user
+
+    requests over the limit get a 429 with Retry-After'''
+
+    def __init__(self, name: str, rule: str) -> None:
+        self.name = name
+        self.rule = parse_rule(rule)
+        self.rejected = 0
+
+    async def hit(self, key: str) -> None:
+        if self.rule is None:
+            return
+        capacity, rate = self.rule
+        wait = await get_backend().take(f"{self.name}:{key}", capacity, rate)
+        if wait > 0:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, try again later",
+                headers={"Retry-After": str(math.ceil(wait))}
+            )
+
+    async def __call__(self, request: Request) -> None:
+        await self.hit(f"ip:{client_ip(request)}")
+
+    def per_user(self, get_user: Callable) -> Callable:
+        async def dependency(user=Depends(get_user)):
+            await self.hit(f"user:{user.id}")
+            return user
+        return dependency
+
+
+limits: Dict[str, RateLimit] = {}
+
+
+def rate_limit(name: str, rule: str) -> RateLimit:
+    '''the RateLimit called `name`, registered for /metrics'''
+    limits[name] = RateLimit(name, rule)
+    return limits[name]
@@ -0,0 +1,75 @@
+"""
+shared Jinja2 environment for HTML pages and outbound mail
+
+one Environment compiles each template once and keeps it in memory
+(auto_reload is off, so renders never stat the file); set
+TEMPLATE_CACHE_DIR to also keep the compiled bytecode across restarts.
+Jinja is imported and the environment built on the first render, so a
+worker that never renders anything doesn't pay for either.
+"""
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator
+
+from config import get_settings
+
+if TYPE_CHECKING:
+    from jinja2 import Environment
+    from starlette.responses import Response
+
+TEMPLATE_DIR = "templates"
+
+
+@lru_cache()
+def get_env() -> "Environment":
+    from jinja2 import (Environment, FileSystemBytecodeCache, FileSystemLoader,
+                        select_autoescape)
+
+    settings = get_settings()
+    env = Environment(
+        loader=FileSystemLoader(TEMPLATE_DIR),
+        autoescape=select_autoescape(["html", "xml"]),
+        auto_reload=False,
+        cache_size=-1,
+        bytecode_cache=(FileSystemBytecodeCache(settings.TEMPLATE_CACHE_DIR)
+                        if settings.TEMPLATE_CACHE_DIR else None),
+    )
+    env.globals["site_url"] = settings.SITE_URL
+    env.globals["site_name"] = settings.SITE_NAME
+    return env
+
+
+@lru_cache()
+def get_pages():
+    '''starlette's TemplateResponse, rendered from the shared environment'''
+    from fastapi.templating import Jinja2Templates
+
+    class SharedTemplates(Jinja2Templates):
+        def get_env(self, directory: str) -> "Environment":
+            return get_env()
+
+    return SharedTemplates(directory=TEMPLATE_DIR)
+
+
+def page(name: str, context: Dict[str, Any]) -> "Response":
+    return get_pages().TemplateResponse(name, context)
+
+
+def render(name: str, **context: Any) -> str:
+    return get_env().get_template(name).render(context)
+
+
+def render_many(name: str, contexts: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    '''one body per context, e.g. a campaign send; the template is looked
+    up once and every render reuses its compiled code'''
+    render = get_env().get_template(name).render
+    for context in contexts:
+        yield render(context)
+
+
+def warm_up() -> int:
+    '''compile every template up front so the first request doesn't pay for it'''
+    env = get_env()
+    names = env.list_templates(extensions=["html", "txt"])
+    for name in names:
+        env.get_template(name)
+    return len(names)
@@ -0,0 +1,239 @@
+"""
+product search
+
+a search index kept in sync from Product save/delete signals. On
+sqlite it is an FTS5 table ranked with bm25; any other database falls
+back to DatabaseBackend, which filters with icontains through the ORM.
+"""
+import re
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Dict, List, Optional, Type
+
+from pydantic import BaseModel
+from tortoise import BaseDBAsyncClient, Tortoise
+from tortoise.functions import Count
+from tortoise.signals import post_delete, post_save
+from tortoise.transactions import current_transaction_map
+
+from models import Product
+from config import get_settings
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+SORTS = ("relevance", "price_asc", "price_desc", "discount")
+FACET_LIMIT = 20
+
+
+class SearchQuery(BaseModel):
+    q: Optional[str] = None
+    category: Optional[str] = None
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    min_discount: Optional[int] = None
+    sort: str = "relevance"
+    limit: int = 20
+    offset: int = 0
+
+    @property
+    def terms(self) -> List[str]:
+        return TOKEN.findall(self.q.lower()) if self.q else []
+
+
+class SearchResult(BaseModel):
+    ids: List[int]
+    total: int
+    # facet name -> [{"value": ..., "count": ...}]
+    facets: Dict[str, List[Dict]]
+
+
+class SearchBackend(ABC):
+
+    @abstractmethod
+    async def setup(self) -> None:
+        '''runs at startup'''
+
+    @abstractmethod
+    async def index(self, products: List[Product]) -> None:
+        ...
+
+    @abstractmethod
+    async def remove(self, ids: List[int]) -> None:
+        ...
+
+    @abstractmethod
+    async def index_new(self, after_id: int, **filters) -> None:
+        '''index products with id > after_id; bulk inserts skip the signals'''
+
+    @abstractmethod
+    async def search(self, query: SearchQuery) -> SearchResult:
+        ...
+
+
+class DatabaseBackend(SearchBackend):
+    '''no separate index; relevance sort degrades to newest first'''
+
+    # searches the product table itself, there is nothing to keep in sync
+    async def setup(self) -> None:
+        pass
+
+    async def index(self, products: List[Product]) -> None:
+        pass
+
+    async def remove(self, ids: List[int]) -> None:
+        pass
+
+    async def index_new(self, after_id: int, **filters) -> None:
+        pass
+
+    def _filter(self, query: SearchQuery, with_category: bool = True):
+        queryset = Product.all()
+        for term in query.terms:
+            queryset = queryset.filter(name__icontains=term)
+        if with_category and query.category:
+            queryset = queryset.filter(category=query.category)
+        if query.min_price is not None:
+            queryset = queryset.filter(new_price__gte=query.min_price)
+        if query.max_price is not None:
+            queryset = queryset.filter(new_price__lte=query.max_price)
+        if query.min_discount is not None:
+            queryset = queryset.filter(percentage_discount__gte=query.min_discount)
+        return queryset
+
+    async def search(self, query: SearchQuery) -> SearchResult:
+        ordering = {"relevance": ("-date_published", "-id"),
+                    "price_asc": ("new_price", "id"),
+                    "price_desc": ("-new_price", "-id"),
+                    "discount": ("-percentage_discount", "-id")}[query.sort]
+        queryset = self._filter(query)
+        ids = await queryset.order_by(*ordering).offset(query.offset) \
+            .limit(query.limit).values_list("id", flat=True)
+        facets = await self._filter(query, with_category=False) \
+            .annotate(count=Count("id")).group_by("category") \
+            .order_by("-count").limit(FACET_LIMIT).values("category", "count")
+        return SearchResult(
+            ids=ids, total=await queryset.count(),
+            facets={"category": [{"value": row["category"], "count": row["count"]}
+                                 for row in facets]})
+
+
+class FTS5Backend(SearchBackend):
+    '''sqlite FTS5 table `product_fts(name, category)`, rowid = product id'''
+
+    def __init__(self, connection: str = "default") -> None:
+        self.connection = connection
+
+    @property
+    def db(self) -> BaseDBAsyncClient:
+        # inside a transaction (changes.atomic) the index is written in it:
+        # the plain connection would wait for the lock the transaction holds
+        return current_transaction_map[self.connection].get()
+
+    async def setup(self) -> None:
+        # migration 0005 creates and fills the table; a throwaway database
+        # made with GENERATE_SCHEMAS has no migrations, and no products yet
+        if get_settings().GENERATE_SCHEMAS:
+            await self.db.execute_script(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS "product_fts" USING fts5('
+                'name, category, tokenize="unicode61 remove_diacritics 2")')
+
+    async def index_new(self, after_id: int, batch_size: int = 5000, **filters) -> None:
+        last_id = after_id
+        while True:
+            batch = await Product.filter(id__gt=last_id, **filters).order_by("id") \
+                .limit(batch_size).only("id", "name", "category")
+            if not batch:
+                return
+            await self.index(batch)
+            last_id = batch[-1].id
+
+    async def index(self, products: List[Product]) -> None:
+        # one statement per row: a remove + insert pair from two
+        # concurrent saves of the same product could interleave
+        await self.db.execute_many(
+            'INSERT OR REPLACE INTO "product_fts" (rowid, name, category) VALUES (?, ?, ?)',
+            [[product.id, product.name, product.category] for product in products])
+
+    async def remove(self, ids: List[int]) -> None:
+        await self.db.execute_many('DELETE FROM "product_fts" WHERE rowid = ?',
+                                   [[id] for id in ids])
+
+    def _where(self, query: SearchQuery, with_category: bool = True):
+        joins, where, values = "", [], []
+        if query.terms:
+            joins = ' JOIN "product_fts" ON "product_fts".rowid = "product"."id"'
+            where.append('"product_fts" MATCH ?')
+            # every term must match, as a prefix so "lapt" finds "laptop"
+            values.append(" ".join(f'"{term}"*' for term in query.terms))
+        if with_category and query.category:
+            where.append('"product"."category" = ?')
+            values.append(query.category)
+        if query.min_price is not None:
+            where.append('CAST("product"."new_price" AS NUMERIC) >= ?')
+            values.append(query.min_price)
+        if query.max_price is not None:
+            where.append('CAST("product"."new_price" AS NUMERIC) <= ?')
+            values.append(query.max_price)
+        if query.min_discount is not None:
+            where.append('"product"."percentage_discount" >= ?')
+            values.append(query.min_discount)
+        sql = ' FROM "product"' + joins
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return sql, values
+
+    async def search(self, query: SearchQuery) -> SearchResult:
+        ordering = {
+            "relevance": 'bm25("product_fts"), "product"."id" DESC' if query.terms
+                         else '"product"."date_published" DESC, "product"."id" DESC',
+            "price_asc": 'CAST("product"."new_price" AS NUMERIC), "product"."id"',
+            "price_desc": 'CAST("product"."new_price" AS NUMERIC) DESC, "product"."id" DESC',
+            "discount": '"product"."percentage_discount" DESC, "product"."id" DESC',
+        }[query.sort]
+        where, values = self._where(query)
+        rows = await self.db.execute_query_dict(
+            f'SELECT "product"."id" AS id{where} ORDER BY {ordering} LIMIT ? OFFSET ?',
+            values + [query.limit, query.offset])
+        total = await self.db.execute_query_dict(f"SELECT COUNT(*) AS n{where}", values)
+
+        # facet counts ignore the category filter so every option stays visible
+        where, values = self._where(query, with_category=False)
+        facets = await self.db.execute_query_dict(
+            f'SELECT "product"."category" AS value, COUNT(*) AS count{where} '
+            f'GROUP BY "product"."category" ORDER BY count DESC LIMIT {FACET_LIMIT}', values)
+        return SearchResult(ids=[row["id"] for row in rows], total=total[0]["n"],
+                            facets={"category": facets})
+
+
+@lru_cache()
+def get_search_backend() -> SearchBackend:
+    backend = get_settings().SEARCH_BACKEND
+    if backend == "auto":
+        dialect = Tortoise.get_connection("default").capabilities.dialect
+        backend = "fts5" if dialect == "sqlite" else "database"
+    return FTS5Backend() if backend == "fts5" else DatabaseBackend()
+
+
+async def search_products(query: SearchQuery):
+    '''(products in result order, SearchResult)'''
+    result = await get_search_backend().search(query)
+    products = {product.id: product for product in await Product.filter(id__in=result.ids)}
+    return [products[id] for id in result.ids if id in products], result
+
+
+@post_save(Product)
+async def index_saved_product(
+        sender: "Type[Product]",
+        instance: Product,
+        created: bool,
+        using_db: "Optional[BaseDBAsyncClient]",
+        update_fields: List[str]) -> None:
+    if not update_fields or {"name", "category"} & set(update_fields):
+        await get_search_backend().index([instance])
+
+
+@post_delete(Product)
+async def unindex_deleted_product(
+        sender: "Type[Product]",
+        instance: Product,
+        using_db: "Optional[BaseDBAsyncClient]") -> None:
+    await get_search_backend().remove([instance.id])
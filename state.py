@@ -0,0 +1,102 @@
+"""
+what the workers of a multi-worker deployment share
+
+STATE_BACKEND is where the response cache, rate limits and revocation
+list keep their data unless their own *_BACKEND setting says otherwise:
+"memory" is per process and only right with one worker, "redis"
+(REDIS_URL) is shared by all of them. Through the same backend the
+workers get
+
+- a broadcast: publish("forget-user", "42") runs the handlers
+  subscribed to that channel in every worker, e.g. to drop an entry
+  from a per-process cache
+- locks, so a periodic job or a startup task runs in one worker
+  instead of in all of them
+"""
+import asyncio
+import logging
+from functools import lru_cache, wraps
+from typing import Awaitable, Callable, Dict, List
+
+from config import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryState:
+    '''a single process: handlers run in place and every lock is free'''
+
+    def __init__(self) -> None:
+        self.handlers: Dict[str, List[Callable[[str], None]]] = {}
+
+    def subscribe(self, channel: str, handler: Callable[[str], None]) -> None:
+        self.handlers.setdefault(channel, []).append(handler)
+
+    async def publish(self, channel: str, message: str) -> None:
+        for handler in self.handlers.get(channel, []):
+            handler(message)
+
+    async def acquire(self, name: str, ttl: float) -> bool:
+        return True
+
+    async def listen(self) -> None:
+        pass
+
+
+class RedisState(MemoryState):
+    '''messages go through redis pub/sub and locks are SET NX keys'''
+
+    def __init__(self, redis, prefix: str = "state:") -> None:
+        super().__init__()
+        self.redis = redis
+        self.prefix = prefix
+
+    async def publish(self, channel: str, message: str) -> None:
+        # handle it here right away, the copy coming back is harmless
+        await super().publish(channel, message)
+        await self.redis.publish(self.prefix + channel, message)
+
+    async def acquire(self, name: str, ttl: float) -> bool:
+        '''True for the one worker that gets `name` for the next `ttl` seconds'''
+        return bool(await self.redis.set(f"{self.prefix}lock:{name}", "1",
+                                         nx=True, ex=max(1, int(ttl))))
+
+    async def listen(self) -> None:
+        '''run the handlers for every worker's messages until cancelled;
+        a dropped connection is retried, the caches expire meanwhile'''
+        channels = [self.prefix + channel for channel in self.handlers]
+        while channels:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(*channels)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    channel = message["channel"].decode()[len(self.prefix):]
+                    await MemoryState.publish(self, channel, message["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("state listener failed, resubscribing")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.close()
+
+
+@lru_cache()
+def get_state() -> MemoryState:
+    if get_settings().STATE_BACKEND == "redis":
+        from cache import get_redis
+        return RedisState(get_redis())
+    return MemoryState()
+
+
+def exclusive(name: str, ttl: float,
+              job: Callable[[], Awaitable]) -> Callable[[], Awaitable]:
+    '''`job`, run only by the worker that takes the lock `name`; with a
+    `ttl` of a job's interval one worker runs each tick'''
+    @wraps(job)
+    async def run() -> None:
+        if await get_state().acquire(name, ttl):
+            await job()
+    return run
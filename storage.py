@@ -0,0 +1,217 @@
+"""
+content-addressed media storage
+
+objects are named after the sha256 of the uploaded bytes, so the same
+image uploaded twice is stored once and a key's content never changes,
+which lets clients cache /media/ responses forever.
+"""
+import asyncio
+import os
+import re
+import shutil
+import time
+from abc import ABC, abstractmethod
+from functools import lru_cache, partial
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from fastapi import Response
+from fastapi.responses import FileResponse
+
+from config import get_settings
+
+MEDIA_URL = "/media/"
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg",
+                 "jpeg": "image/jpeg", "webp": "image/webp"}
+
+# <sha256 of the upload>[_<rendition>].<ext>
+KEY_PATTERN = re.compile(r"^([0-9a-f]{64})(?:_[a-z]+)?\.(png|jpe?g|webp)$")
+
+
+def media_path(key: str) -> str:
+    '''the value stored in Business.logo / Product.product_image'''
+    return MEDIA_URL + key
+
+
+def key_digest(key: str) -> Optional[str]:
+    match = KEY_PATTERN.match(key)
+    return match.group(1) if match else None
+
+
+class Storage(ABC):
+    '''what the upload pipeline and /media/ need from a backend'''
+
+    @abstractmethod
+    async def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def put_file(self, key: str, path: str) -> None:
+        '''store the local file at `path` under `key`, consuming the file'''
+
+    @abstractmethod
+    async def touch(self, key: str) -> None:
+        '''restart the object's age, for an upload that reuses it'''
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def keys(self) -> AsyncIterator[Tuple[str, float]]:
+        '''(key, last modified timestamp) of every stored object'''
+
+    @abstractmethod
+    async def response(self, key: str, headers: Dict[str, str]) -> Response:
+        ...
+
+
+class LocalStorage(Storage):
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    async def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    async def put_file(self, key: str, path: str) -> None:
+        # same filesystem: an atomic rename, readers never see a partial file
+        shutil.move(path, self._path(key))
+
+    async def touch(self, key: str) -> None:
+        os.utime(self._path(key))
+
+    async def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    async def keys(self) -> AsyncIterator[Tuple[str, float]]:
+        for entry in os.scandir(self.root):
+            if entry.is_file() and key_digest(entry.name):
+                yield entry.name, entry.stat().st_mtime
+
+    async def response(self, key: str, headers: Dict[str, str]) -> Response:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return Response(status_code=404)
+        extension = key.rsplit(".", 1)[-1]
+        return FileResponse(path, media_type=CONTENT_TYPES[extension], headers=headers)
+
+
+class S3Storage(Storage):
+    '''any S3-compatible service, through a boto3-style client
+
+    only put_object / head_object / copy_object / delete_object /
+    get_object / list_objects_v2 are used, so the tests run it against
+    an in-process stand-in (tests.support.MemoryS3Client)'''
+
+    def __init__(self, client, bucket: str, prefix: str = "") -> None:
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    async def _call(self, method: str, **kwargs):
+        # boto3 clients block, keep them off the event loop
+        loop = asyncio.get_running_loop()
+        func = partial(getattr(self.client, method), Bucket=self.bucket, **kwargs)
+        return await loop.run_in_executor(None, func)
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await self._call("head_object", Key=self.prefix + key)
+        except Exception as e:
+            if _status(e) == 404:
+                return False
+            raise
+        return True
+
+    async def put_file(self, key: str, path: str) -> None:
+        body = await asyncio.get_running_loop().run_in_executor(None, _read, path)
+        extension = key.rsplit(".", 1)[-1]
+        await self._call("put_object", Key=self.prefix + key, Body=body,
+                         ContentType=CONTENT_TYPES[extension],
+                         CacheControl=CACHE_CONTROL)
+        os.remove(path)
+
+    async def touch(self, key: str) -> None:
+        # S3 has no touch, copying an object onto itself is what moves
+        # LastModified; REPLACE drops the metadata, so it is sent again
+        extension = key.rsplit(".", 1)[-1]
+        await self._call("copy_object", Key=self.prefix + key,
+                         CopySource={"Bucket": self.bucket, "Key": self.prefix + key},
+                         MetadataDirective="REPLACE",
+                         ContentType=CONTENT_TYPES[extension],
+                         CacheControl=CACHE_CONTROL)
+
+    async def delete(self, key: str) -> None:
+        await self._call("delete_object", Key=self.prefix + key)
+
+    async def keys(self) -> AsyncIterator[Tuple[str, float]]:
+        kwargs = {"Prefix": self.prefix}
+        while True:
+            page = await self._call("list_objects_v2", **kwargs)
+            for obj in page.get("Contents", []):
+                key = obj["Key"][len(self.prefix):]
+                if key_digest(key):
+                    yield key, obj["LastModified"].timestamp()
+            if not page.get("IsTruncated"):
+                return
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+    async def response(self, key: str, headers: Dict[str, str]) -> Response:
+        try:
+            obj = await self._call("get_object", Key=self.prefix + key)
+        except Exception as e:
+            if _status(e) == 404:
+                return Response(status_code=404)
+            raise
+        # the body is a blocking stream too
+        body = await asyncio.get_running_loop().run_in_executor(None, obj["Body"].read)
+        return Response(body, media_type=obj["ContentType"], headers=headers)
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _status(error: Exception) -> Optional[int]:
+    '''HTTP status of a botocore ClientError (or the stand-in's KeyError)'''
+    if isinstance(error, KeyError):
+        return 404
+    response = getattr(error, "response", {})
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    if status is None and response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+        status = 404
+    return status
+
+
+@lru_cache()
+def get_storage() -> Storage:
+    settings = get_settings()
+    if settings.STORAGE_BACKEND == "s3":
+        import boto3  # optional dependency, only needed for this backend
+        client = boto3.client("s3", endpoint_url=settings.S3_ENDPOINT_URL or None)
+        return S3Storage(client, settings.S3_BUCKET, settings.S3_PREFIX)
+    return LocalStorage(settings.MEDIA_ROOT)
+
+
+async def collect_garbage(storage: Storage, referenced: set, min_age: float) -> int:
+    '''delete objects whose digest no row references any more
+
+    objects younger than `min_age` seconds are kept: an upload is stored
+    (or, when its bytes were already there, touched) before the row
+    pointing at it is saved'''
+    deleted = 0
+    cutoff = time.time() - min_age
+    async for key, modified in storage.keys():
+        if key_digest(key) not in referenced and modified < cutoff:
+            await storage.delete(key)
+            deleted += 1
+    return deleted
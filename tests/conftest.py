@@ -0,0 +1,80 @@
+"""
+the tests run the app in process against a throwaway sqlite database,
+with the benchmark settings (benchmarks.common.bench_env) instead of
+.env; `async def` tests run on one event loop shared by the session
+"""
+import asyncio
+import inspect
+import os
+from contextlib import ExitStack
+
+import httpx
+import pytest
+
+from benchmarks.common import bench_env, workdir
+from tests.support import fresh_database
+
+_stack = ExitStack()
+loop = asyncio.new_event_loop()
+
+
+def pytest_configure(config) -> None:
+    path = _stack.enter_context(workdir())
+    os.environ.update(bench_env(os.path.join(path, "test.sqlite3"), path,
+                                RESPONSE_CACHE_SIZE=0, USER_CACHE_SIZE=0,
+                                OFFER_EXPIRY_INTERVAL=0))
+    # the app looks for static/ and templates/ in its working directory
+    os.chdir(path)
+    asyncio.set_event_loop(loop)
+
+
+def pytest_unconfigure(config) -> None:
+    _stack.close()
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    if inspect.iscoroutinefunction(pyfuncitem.obj):
+        arguments = {name: pyfuncitem.funcargs[name]
+                     for name in pyfuncitem._fixtureinfo.argnames}
+        loop.run_until_complete(pyfuncitem.obj(**arguments))
+        return True
+
+
+def run(coroutine):
+    '''for fixtures, which can't be coroutines here'''
+    return loop.run_until_complete(coroutine)
+
+
+def start(app) -> httpx.AsyncClient:
+    run(app.router.startup())
+    return httpx.AsyncClient(app=app, base_url="http://test")
+
+
+def stop(app, client: httpx.AsyncClient) -> None:
+    run(client.aclose())
+    run(app.router.shutdown())
+
+
+@pytest.fixture
+def client():
+    '''the app on an empty, migrated database'''
+    from main import app
+
+    run(fresh_database())
+    client = start(app)
+    yield client
+    stop(app, client)
+
+
+@pytest.fixture
+def database():
+    '''an empty, migrated database without the app, for module level tests'''
+    from tortoise import Tortoise
+
+    from database import tortoise_config
+
+    run(fresh_database())
+    run(Tortoise.init(config=tortoise_config()))
+    yield
+    run(Tortoise.close_connections())
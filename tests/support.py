@@ -0,0 +1,151 @@
+"""
+helpers for the tests: a fresh database, an SQL statement counter and
+an S3 client that keeps objects in memory
+"""
+import logging
+import os
+import random
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+SQL_VERBS = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+
+class QueryCounter(logging.Handler):
+    '''collects the SQL statements tortoise issues while active
+
+        with QueryCounter() as queries:
+            await client.get("/products/1")
+        assert queries.count == 1
+    '''
+
+    logger = logging.getLogger("tortoise.db_client")
+
+    def __init__(self) -> None:
+        super().__init__(level=logging.DEBUG)
+        self.queries: List[str] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.queries)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        message = record.getMessage()
+        if message.lstrip().upper().startswith(SQL_VERBS):
+            self.queries.append(message)
+
+    def __enter__(self) -> "QueryCounter":
+        self._level = self.logger.level
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.logger.removeHandler(self)
+        self.logger.setLevel(self._level)
+
+
+def database_path() -> str:
+    return os.environ["DB_URL"][len("sqlite://"):]
+
+
+async def fresh_database(users: int = 0, products: int = 0,
+                         rng: Optional[random.Random] = None) -> None:
+    '''drop the test database and migrate a new one, optionally seeded
+    with benchmarks.seed'''
+    from tortoise import Tortoise
+
+    from database import migrate, tortoise_config
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(database_path() + suffix):
+            os.remove(database_path() + suffix)
+    await Tortoise.init(config=tortoise_config())
+    try:
+        await migrate()
+        if users:
+            from benchmarks.seed import seed
+            await seed(users, products, rng or random.Random(1))
+    finally:
+        await Tortoise.close_connections()
+
+
+async def make_user(client, name: str = "alice", password: str = "password123") -> dict:
+    '''register and verify a user (and its business), returns auth headers'''
+    from models import User
+
+    response = await client.post("/users/", json={
+        "username": name, "email": f"{name}@example.com", "password": password})
+    assert response.status_code == 201, response.text
+    await User.filter(username=name).update(is_verifide=True)
+    response = await client.post("/token", data={"username": name, "password": password})
+    assert response.status_code == 200, response.text
+    return {"Authorization": "Bearer " + response.json()["access_token"]}
+
+
+async def make_product(client, headers: dict, stock: int = 0, **fields) -> int:
+    product = {"name": "laptop", "category": "laptops", "original_price": 10,
+               "new_price": 8, "offer_expiration_date": "2030-01-01", **fields}
+    response = await client.post("/products/", headers=headers, json=product)
+    assert response.status_code == 200, response.text
+    id = response.json()["id"]
+    if stock:
+        response = await client.put(f"/products/{id}/stock", headers=headers,
+                                    json={"stock": stock})
+        assert response.status_code == 200, response.text
+    return id
+
+
+class Clock:
+    '''a clock for the caches and limiters that only moves when told'''
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class MemoryS3Client:
+    '''in-process stand-in for a boto3 S3 client'''
+
+    class _Body:
+        def __init__(self, data: bytes) -> None:
+            self.data = data
+
+        def read(self) -> bytes:
+            return self.data
+
+    def __init__(self, page_size: int = 1000) -> None:
+        self.objects: Dict[Tuple[str, str], dict] = {}
+        self.page_size = page_size
+
+    def put_object(self, Bucket, Key, Body, ContentType, CacheControl=None):
+        self.objects[(Bucket, Key)] = {"Body": Body, "ContentType": ContentType,
+                                       "LastModified": datetime.now(timezone.utc)}
+
+    def head_object(self, Bucket, Key):
+        return self.objects[(Bucket, Key)]
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective,
+                    ContentType, CacheControl=None):
+        source = self.objects[(CopySource["Bucket"], CopySource["Key"])]
+        self.put_object(Bucket, Key, source["Body"], ContentType, CacheControl)
+
+    def get_object(self, Bucket, Key):
+        obj = self.objects[(Bucket, Key)]
+        return {**obj, "Body": self._Body(obj["Body"])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None):
+        contents = [{"Key": key, "LastModified": obj["LastModified"]}
+                    for (bucket, key), obj in sorted(self.objects.items())
+                    if bucket == Bucket and key.startswith(Prefix)]
+        start = int(ContinuationToken or 0)
+        end = start + self.page_size
+        page = {"Contents": contents[start:end], "IsTruncated": end < len(contents)}
+        if page["IsTruncated"]:
+            page["NextContinuationToken"] = str(end)
+        return page
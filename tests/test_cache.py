@@ -0,0 +1,66 @@
+from cache import TTLCache
+from tests.support import Clock
+
+
+def test_entries_expire_ttl_seconds_after_being_set():
+    clock = Clock()
+    cache = TTLCache(maxsize=10, ttl=30, clock=clock)
+    cache.set("a", 1)
+
+    clock.now += 29.9
+    assert cache.get("a") == 1
+    clock.now += 0.1
+    assert cache.get("a") is None
+    # the expired entry is dropped, not only hidden
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_setting_again_restarts_the_ttl():
+    clock = Clock()
+    cache = TTLCache(maxsize=10, ttl=30, clock=clock)
+    cache.set("a", 1)
+    clock.now += 20
+    cache.set("a", 2)
+    clock.now += 20
+    assert cache.get("a") == 2
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(maxsize=2, ttl=30, clock=Clock())
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # reading "a" makes "b" the oldest
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)
+
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+
+
+def test_falsy_values_are_cached():
+    cache = TTLCache(maxsize=2, ttl=30, clock=Clock())
+    cache.set("a", 0)
+    assert cache.get("a") == 0
+    assert cache.hits == 1
+
+
+def test_invalidate_and_clear():
+    cache = TTLCache(maxsize=10, ttl=30, clock=Clock())
+    for key in "abc":
+        cache.set(key, key)
+
+    cache.invalidate("a")
+    cache.invalidate("missing")
+    assert (cache.get("a"), cache.get("b")) == (None, "b")
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_zero_size_cache_stores_nothing():
+    cache = TTLCache(maxsize=0, ttl=30, clock=Clock())
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
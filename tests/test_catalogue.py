@@ -0,0 +1,124 @@
+import asyncio
+import json
+from decimal import Decimal
+
+import pytest
+
+from catalogue import csv_rows, ndjson_rows
+from config import get_settings
+from tests.support import make_product, make_user
+
+
+def ndjson(products) -> bytes:
+    return "".join(json.dumps(product) + "\n" for product in products).encode()
+
+
+async def parse(rows, data: bytes, chunk_size: int = 7) -> list:
+    '''feed `data` in small chunks, so lines and characters get split'''
+    async def stream():
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+    return [row async for row in rows(stream())]
+
+
+def product(name: str, category: str = "imported") -> dict:
+    return {"name": name, "category": category, "original_price": 10, "new_price": 5,
+            "offer_expiration_date": "2030-01-01"}
+
+
+async def test_import_records_exactly_the_rows_it_inserted(client, monkeypatch):
+    from models import ChangeEvent, Product
+
+    monkeypatch.setattr(get_settings(), "BULK_BATCH_SIZE", 3)
+    seller = await make_user(client, "seller")
+    existing = await make_product(client, seller)
+    headers = {**seller, "Content-Type": "application/x-ndjson"}
+
+    # two imports of one business at once, batches interleave
+    reports = await asyncio.gather(*[
+        client.post("/products/bulk", headers=headers,
+                    content=ndjson(product(f"{source} {n}") for n in range(7)))
+        for source in ("first", "second")])
+
+    assert [report.json()["created"] for report in reports] == [7, 7]
+    names = dict(await Product.exclude(id=existing).values_list("id", "name"))
+    assert len(names) == 14
+    events = await ChangeEvent.filter(entity="product", action="create") \
+        .exclude(entity_id=existing).values_list("entity_id", "data")
+    assert sorted(entity_id for entity_id, _ in events) == sorted(names)
+    assert all(data["name"] == names[entity_id] for entity_id, data in events)
+
+    # and indexed, bulk_create skips the signal that would have
+    response = await client.get("/products/search", params={"q": "second", "limit": 50})
+    assert response.status_code == 200, response.text
+    assert response.json()["total"] == 7
+
+
+async def test_ndjson_rows_reports_bad_lines_and_keeps_going():
+    data = ('{"name": "lamp", "new_price": 19.99}\n'
+            "\n"
+            "{not json\n"
+            "[1, 2]\n"
+            '{"name": "lämp"}').encode()
+
+    rows = await parse(ndjson_rows, data)
+
+    assert rows[0][:2] == (1, {"name": "lamp", "new_price": Decimal("19.99")})
+    assert [(line, error.split(":")[0] if error else None) for line, _, error in rows] == [
+        (1, None), (3, "invalid JSON"), (4, "expected a JSON object"), (5, None)]
+    assert rows[3][1] == {"name": "lämp"}
+
+
+async def test_csv_rows_numbers_records_by_their_first_line():
+    data = ("\ufeffname, category\r\n"
+            "lamp,lighting\r\n"
+            '"desk\nlamp",lighting\r\n'
+            "chair\r\n"
+            "\r\n"
+            "sofa,furniture,extra\r\n"
+            "stool,furniture\r\n").encode()
+
+    rows = await parse(csv_rows, data)
+
+    assert rows == [
+        (2, {"name": "lamp", "category": "lighting"}, None),
+        (3, {"name": "desk\nlamp", "category": "lighting"}, None),
+        (5, None, "expected 2 columns, got 1"),
+        (7, None, "expected 2 columns, got 3"),
+        (8, {"name": "stool", "category": "furniture"}, None),
+    ]
+
+
+async def test_csv_rows_reports_an_unterminated_quote():
+    rows = await parse(csv_rows, b'name,category\nlamp,lighting\n"desk,lighting\nchair,x\n')
+
+    assert rows == [(2, {"name": "lamp", "category": "lighting"}, None),
+                    (3, None, "unterminated quoted field")]
+
+
+@pytest.mark.parametrize("content_type, body", [
+    ("text/csv", b"name,category,original_price,new_price,offer_expiration_date\n"
+                 b"lamp,lighting,10,5,2030-01-01\n"
+                 b"desk,furniture,0,5,2030-01-01\n"
+                 b"chair,furniture,10,5\n"
+                 b"sofa,furniture,ten,5,2030-01-01\n"),
+    ("application/x-ndjson", ndjson([
+        product("lamp"),
+        {**product("desk"), "original_price": 0},
+        "chair",
+        {**product("sofa"), "original_price": "ten"}])),
+])
+async def test_import_reports_each_bad_row_by_line(client, content_type, body):
+    seller = await make_user(client, "seller")
+
+    response = await client.post("/products/bulk", content=body,
+                                 headers={**seller, "Content-Type": content_type})
+
+    assert response.status_code == 200, response.text
+    report = response.json()
+    offset = 1 if content_type == "text/csv" else 0  # the header
+    assert (report["created"], report["failed"]) == (1, 3)
+    assert [error["line"] for error in report["errors"]] == [2 + offset, 3 + offset, 4 + offset]
+    assert report["errors"][0]["errors"] == [
+        "original_price: the original price must be greater than 0"]
+    assert report["errors"][2]["errors"][0].startswith("original_price:")
@@ -0,0 +1,8 @@
+async def test_ready_once_started_with_templates_compiled(client):
+    from rendering import get_env
+
+    response = await client.get("/health/ready")
+
+    assert response.status_code == 200
+    env = get_env()
+    assert len(env.cache) == len(env.list_templates(extensions=["html", "txt"])) > 0
@@ -0,0 +1,79 @@
+import asyncio
+from collections import Counter
+
+from tests.support import make_product, make_user
+
+BUYERS = 500
+STOCK = 100
+
+
+async def stock_of(product_id: int) -> int:
+    from models import Inventory
+
+    return (await Inventory.get(product_id=product_id)).stock
+
+
+async def test_parallel_buyers_never_oversell(client):
+    from models import Order, OrderItem
+
+    seller = await make_user(client, "seller")
+    buyer = await make_user(client, "buyer")
+    product = await make_product(client, seller, stock=STOCK)
+
+    responses = await asyncio.gather(*[
+        client.post("/orders", headers=buyer,
+                    json={"items": [{"product_id": product, "quantity": 1}]})
+        for _ in range(BUYERS)])
+
+    statuses = Counter(response.status_code for response in responses)
+    assert statuses == {201: STOCK, 409: BUYERS - STOCK}
+    assert await stock_of(product) == 0
+    assert await Order.all().count() == STOCK
+    assert sum(await OrderItem.all().values_list("quantity", flat=True)) == STOCK
+
+
+async def test_multi_item_order_is_all_or_nothing(client):
+    seller = await make_user(client, "seller")
+    buyer = await make_user(client, "buyer")
+    plenty = await make_product(client, seller, stock=10, name="cable")
+    scarce = await make_product(client, seller, stock=1, name="dock")
+    items = [{"product_id": plenty, "quantity": 1}, {"product_id": scarce, "quantity": 1}]
+
+    responses = await asyncio.gather(*[
+        client.post("/orders", headers=buyer, json={"items": items}) for _ in range(5)])
+
+    assert Counter(response.status_code for response in responses) == {201: 1, 409: 4}
+    assert (await stock_of(plenty), await stock_of(scarce)) == (9, 0)
+
+
+async def test_retried_idempotency_key_returns_the_original_order(client):
+    seller = await make_user(client, "seller")
+    buyer = await make_user(client, "buyer")
+    product = await make_product(client, seller, stock=5)
+    headers = {**buyer, "Idempotency-Key": "checkout-1"}
+    body = {"items": [{"product_id": product, "quantity": 2}]}
+
+    first = await client.post("/orders", headers=headers, json=body)
+    assert first.status_code == 201
+    retries = await asyncio.gather(*[
+        client.post("/orders", headers=headers, json=body) for _ in range(10)])
+
+    assert {response.status_code for response in retries} == {200}
+    assert {response.json()["id"] for response in retries} == {first.json()["id"]}
+    assert await stock_of(product) == 3
+
+
+async def test_concurrent_first_attempts_with_one_key_place_one_order(client):
+    seller = await make_user(client, "seller")
+    buyer = await make_user(client, "buyer")
+    product = await make_product(client, seller, stock=5)
+    headers = {**buyer, "Idempotency-Key": "checkout-2"}
+
+    responses = await asyncio.gather(*[
+        client.post("/orders", headers=headers,
+                    json={"items": [{"product_id": product, "quantity": 1}]})
+        for _ in range(10)])
+
+    assert Counter(response.status_code for response in responses) == {201: 1, 200: 9}
+    assert len({response.json()["id"] for response in responses}) == 1
+    assert await stock_of(product) == 4
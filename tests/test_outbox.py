@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from benchmarks.common import SMTPSink
+from config import get_settings
+from models import OutboxEmail
+from outbox import DEAD, PENDING, SENT, dispatch_batch, enqueue
+
+BACKOFF = get_settings().OUTBOX_BACKOFF
+# the dispatcher reads the clock itself, allow for the test's own time
+SLACK = timedelta(seconds=5)
+
+
+def next_attempt(email: OutboxEmail) -> datetime:
+    # the outbox works in naive UTC, tortoise reads it back as aware
+    return email.next_attempt_at.replace(tzinfo=None)
+
+
+async def make_due(email: OutboxEmail) -> None:
+    await OutboxEmail.filter(id=email.id).update(next_attempt_at=datetime.utcnow())
+
+
+async def test_due_mail_is_sent_once(database):
+    emails = [await enqueue([f"user{i}@example.com"], "hi", "<p>hi</p>") for i in range(3)]
+
+    async with SMTPSink() as sink:
+        assert await dispatch_batch() == 3
+        assert await dispatch_batch() == 0
+
+    assert sink.messages == 3
+    for email in emails:
+        await email.refresh_from_db()
+        assert (email.status, email.attempts) == (SENT, 0)
+        assert email.sent_at is not None
+
+
+async def test_transient_failure_backs_off_then_sends(database):
+    email = await enqueue(["user@example.com"], "hi", "<p>hi</p>")
+
+    async with SMTPSink() as sink:
+        sink.reject = b"451 4.3.0 try again later"
+        for attempt in (1, 2, 3):
+            before = datetime.utcnow()
+            assert await dispatch_batch() == 1
+            await email.refresh_from_db()
+            assert (email.status, email.attempts) == (PENDING, attempt)
+            assert "451" in email.last_error
+            delay = timedelta(seconds=BACKOFF * 2 ** (attempt - 1))
+            assert before + delay - SLACK <= next_attempt(email) <= before + delay + SLACK
+            # not due again until the backoff has passed
+            assert await dispatch_batch() == 0
+            await make_due(email)
+
+        sink.reject = None
+        assert await dispatch_batch() == 1
+
+    await email.refresh_from_db()
+    assert (email.status, email.attempts) == (SENT, 3)
+    assert sink.messages == 1
+
+
+async def test_backoff_is_capped_at_an_hour(database, monkeypatch):
+    monkeypatch.setattr(get_settings(), "OUTBOX_MAX_ATTEMPTS", 20)
+    email = await enqueue(["user@example.com"], "hi", "<p>hi</p>")
+    await OutboxEmail.filter(id=email.id).update(attempts=15)
+
+    async with SMTPSink() as sink:
+        sink.reject = b"421 4.7.0 busy"
+        before = datetime.utcnow()
+        await dispatch_batch()
+
+    await email.refresh_from_db()
+    hour = timedelta(seconds=3600)
+    assert before + hour - SLACK <= next_attempt(email) <= before + hour + SLACK
+
+
+@pytest.mark.parametrize("server", ["rejecting", "down"])
+async def test_mail_is_dead_after_max_attempts(database, monkeypatch, server):
+    monkeypatch.setattr(get_settings(), "OUTBOX_MAX_ATTEMPTS", 3)
+    email = await enqueue(["user@example.com"], "hi", "<p>hi</p>")
+
+    async def attempt():
+        assert await dispatch_batch() == 1
+        await email.refresh_from_db()
+        await make_due(email)
+
+    if server == "rejecting":
+        async with SMTPSink() as sink:
+            sink.reject = b"452 4.2.2 mailbox full"
+            for _ in range(3):
+                await attempt()
+    else:
+        # nothing listens on MAIL_PORT: connecting fails
+        for _ in range(3):
+            await attempt()
+
+    assert (email.status, email.attempts) == (DEAD, 3)
+    assert email.last_error
+    # dead mail is never claimed again
+    assert await dispatch_batch() == 0
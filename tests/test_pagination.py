@@ -0,0 +1,26 @@
+import base64
+import json
+from decimal import Decimal
+
+import pytest
+from fastapi import HTTPException
+
+from pagination import PRODUCT_SORTS, decode_cursor, encode_cursor
+
+
+def cursor(payload) -> str:
+    raw = json.dumps(payload).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def test_round_trip():
+    sort = PRODUCT_SORTS["price_asc"]
+    row = {"new_price": Decimal("9.50"), "id": 7}
+    assert decode_cursor(sort, encode_cursor(sort, row)) == [Decimal("9.50"), 7]
+
+
+@pytest.mark.parametrize("keys", [["not a price", 7], [[1], 7], ["9.50", "x"]])
+def test_tampered_price_cursor_is_a_400(keys):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(PRODUCT_SORTS["price_asc"], cursor({"s": "price_asc", "k": keys}))
+    assert error.value.status_code == 400
@@ -0,0 +1,83 @@
+"""
+SQL statements per endpoint, checked against a budget
+
+a request that goes over (say an N+1 query came back) fails with every
+statement it issued in the message
+"""
+import random
+
+import pytest
+
+from benchmarks.common import PASSWORD
+from tests.conftest import run, start, stop
+from tests.support import QueryCounter, fresh_database
+
+USERS = 50
+PRODUCTS = 500
+
+PRODUCT = {"name": "budget laptop", "category": "laptops", "original_price": 10,
+           "new_price": 8, "offer_expiration_date": "2030-01-01"}
+
+# (method, path, needs a token, budget)
+BUDGETS = [
+    ("GET", "/products?limit=100", False, 1),
+    ("GET", "/products?limit=100&embed_business=true", False, 2),
+    ("GET", "/products?limit=100&sort=price_desc", False, 1),
+    ("GET", "/products/7", False, 1),
+    ("GET", "/deals", False, 1),
+    ("GET", "/products/search?q=laptop", False, 4),
+    ("GET", "/products/search?category=books&sort=price_asc", False, 4),
+    # tokens are checked from their claims, only the page is read
+    ("GET", "/users/?limit=50", True, 1),
+    # the user, and its business id for the access token claims
+    ("POST", "/token", False, 2),
+    # the user, its business, the verification email and the business'
+    # change event; no SELECT
+    ("POST", "/users/", False, 4),
+    # + search index, deal lookup, the new deal row and the change event
+    ("POST", "/products/", True, 5),
+    # moves the product to another category: recomputes the old one's deals
+    ("PUT", "/products/1", True, 8),
+    ("GET", "/changes?limit=100", False, 1),
+    # the products with one IN query, their businesses with another
+    ("POST", "/products/batch", False, 2),
+    ("POST", "/business/batch", False, 1),
+    ("GET", "/products/export", True, 2),
+]
+
+
+@pytest.fixture(scope="module")
+def seeded():
+    '''(client, access token) on a small seeded database'''
+    from main import app, background_jobs
+
+    run(fresh_database(USERS, PRODUCTS, random.Random(1)))
+    client = start(app)
+    # the outbox dispatcher (woken by POST /users/) would land in the counts
+    for job in background_jobs:
+        job.cancel()
+    response = run(client.post("/token", data={"username": "user1", "password": PASSWORD}))
+    yield client, response.json()["access_token"]
+    stop(app, client)
+
+
+@pytest.mark.parametrize("method, path, auth, budget", BUDGETS,
+                         ids=[f"{method} {path}" for method, path, _, _ in BUDGETS])
+async def test_query_budget(seeded, method, path, auth, budget):
+    client, token = seeded
+    kwargs = {"headers": {"Authorization": f"Bearer {token}"} if auth else {}}
+    if path == "/token":
+        kwargs["data"] = {"username": "user1", "password": PASSWORD}
+    elif path == "/users/":
+        kwargs["json"] = {"username": "budgetuser", "email": "budget@bench.local",
+                          "password": PASSWORD}
+    elif path.endswith("/batch"):
+        kwargs["json"] = {"ids": [7, 3, 7, 999999, *range(100, 140)]}
+    elif method in ("POST", "PUT"):
+        kwargs["json"] = PRODUCT
+
+    with QueryCounter() as queries:
+        response = await client.request(method, path, **kwargs)
+
+    assert response.status_code < 400, response.text
+    assert queries.count <= budget, "\n".join([f"{queries.count} > {budget}"] + queries.queries)
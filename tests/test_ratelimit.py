@@ -0,0 +1,79 @@
+import pytest
+from fastapi import HTTPException
+
+import ratelimit
+from ratelimit import MemoryBackend, RateLimit, parse_rule
+from tests.support import Clock
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_parse_rule():
+    assert parse_rule("10/minute") == (10, 10 / 60)
+    assert parse_rule("3/second") == (3, 3)
+    assert parse_rule("") is None
+    assert parse_rule("0/hour") is None
+    with pytest.raises(ValueError):
+        parse_rule("10/fortnight")
+
+
+async def test_bucket_allows_a_burst_then_refills_at_the_rate(clock):
+    backend = MemoryBackend(clock=clock)
+
+    assert [await backend.take("a", 3, 0.5) for _ in range(3)] == [0, 0, 0]
+    # empty: one token takes 1 / 0.5 seconds
+    assert await backend.take("a", 3, 0.5) == pytest.approx(2)
+
+    clock.now += 1
+    assert await backend.take("a", 3, 0.5) == pytest.approx(1)
+    clock.now += 1
+    assert await backend.take("a", 3, 0.5) == 0
+    assert await backend.take("a", 3, 0.5) == pytest.approx(2)
+
+
+async def test_refill_stops_at_capacity(clock):
+    backend = MemoryBackend(clock=clock)
+    for _ in range(3):
+        await backend.take("a", 3, 0.5)
+
+    clock.now += 3600
+    assert [await backend.take("a", 3, 0.5) for _ in range(4)][-1] == pytest.approx(2)
+
+
+async def test_buckets_are_per_key_and_evicted_least_recently_used(clock):
+    backend = MemoryBackend(maxsize=2, clock=clock)
+    await backend.take("a", 1, 0.1)
+    await backend.take("b", 1, 0.1)
+    assert await backend.take("a", 1, 0.1) == pytest.approx(10)
+
+    # "a" was used last, "b" goes
+    await backend.take("c", 1, 0.1)
+    assert await backend.take("b", 1, 0.1) == 0
+    assert await backend.take("c", 1, 0.1) == pytest.approx(10)
+
+
+async def test_over_the_limit_is_a_429_with_retry_after(clock, monkeypatch):
+    backend = MemoryBackend(clock=clock)
+    monkeypatch.setattr(ratelimit, "get_backend", lambda: backend)
+    limit = RateLimit("test", "2/minute")
+
+    await limit.hit("user:1")
+    await limit.hit("user:1")
+    with pytest.raises(HTTPException) as error:
+        await limit.hit("user:1")
+    assert error.value.status_code == 429
+    assert error.value.headers["Retry-After"] == "30"
+
+    # rounded up: retrying after Retry-After seconds must get through
+    clock.now += 10.5
+    with pytest.raises(HTTPException) as error:
+        await limit.hit("user:1")
+    assert error.value.headers["Retry-After"] == "20"
+    clock.now += 20
+    await limit.hit("user:1")
+
+    await limit.hit("user:2")
+    assert limit.rejected == 2
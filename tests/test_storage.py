@@ -0,0 +1,97 @@
+import os
+import time
+from datetime import timedelta
+
+import pytest
+
+from storage import LocalStorage, S3Storage, collect_garbage
+from tests.support import MemoryS3Client
+
+OLD = 3600
+
+
+def key(n: int, suffix: str = "", extension: str = "png") -> str:
+    return f"{n:064x}{suffix}.{extension}"
+
+
+@pytest.fixture(params=["local", "s3"])
+def storage(request, tmp_path):
+    if request.param == "local":
+        return LocalStorage(str(tmp_path / "media"))
+    return S3Storage(MemoryS3Client(page_size=2), "bucket", "media/")
+
+
+def age(storage, key: str, seconds: float) -> None:
+    '''make the stored object `seconds` older'''
+    if isinstance(storage, LocalStorage):
+        modified = os.stat(storage._path(key)).st_mtime - seconds
+        os.utime(storage._path(key), (modified, modified))
+    else:
+        obj = storage.client.objects[(storage.bucket, storage.prefix + key)]
+        obj["LastModified"] -= timedelta(seconds=seconds)
+
+
+async def put(storage, tmp_path, key: str, data: bytes = b"image") -> str:
+    path = tmp_path / ("upload_" + key)
+    path.write_bytes(data)
+    await storage.put_file(key, str(path))
+    assert not path.exists()  # consumed
+    return key
+
+
+async def stored(storage) -> dict:
+    return {key: modified async for key, modified in storage.keys()}
+
+
+async def test_put_then_exists_and_serve(storage, tmp_path):
+    await put(storage, tmp_path, key(1), b"png bytes")
+
+    assert await storage.exists(key(1))
+    assert not await storage.exists(key(2))
+    response = await storage.response(key(1), {"ETag": '"1"'})
+    assert response.media_type == "image/png"
+    assert response.headers["etag"] == '"1"'
+    assert (await storage.response(key(2), {})).status_code == 404
+
+
+async def test_keys_lists_every_page_and_only_media(storage, tmp_path):
+    for n in range(5):
+        await put(storage, tmp_path, key(n, "_thumb" if n % 2 else ""))
+    if isinstance(storage, LocalStorage):
+        open(os.path.join(storage.root, "notes.txt"), "w").close()
+    else:
+        storage.client.put_object("bucket", "media/notes.txt", b"", "text/plain")
+        storage.client.put_object("bucket", "other/" + key(9), b"", "image/png")
+
+    assert sorted(await stored(storage)) == sorted(
+        key(n, "_thumb" if n % 2 else "") for n in range(5))
+
+
+async def test_touch_restarts_the_age(storage, tmp_path):
+    await put(storage, tmp_path, key(1))
+    age(storage, key(1), OLD)
+    assert (await stored(storage))[key(1)] < time.time() - OLD / 2
+
+    await storage.touch(key(1))
+
+    assert (await stored(storage))[key(1)] > time.time() - OLD / 2
+    assert await storage.exists(key(1))
+
+
+async def test_collect_garbage_keeps_referenced_and_young_objects(storage, tmp_path):
+    for name in (key(1), key(1, "_thumb"), key(2), key(2, "_medium", "webp"), key(3)):
+        await put(storage, tmp_path, name)
+    for name in (key(1), key(1, "_thumb"), key(2), key(2, "_medium", "webp")):
+        age(storage, name, OLD)
+
+    # 1 is referenced, 3 was just uploaded and its row may not be saved yet
+    deleted = await collect_garbage(storage, {f"{1:064x}"}, min_age=OLD / 2)
+
+    assert deleted == 2
+    assert sorted(await stored(storage)) == sorted([key(1), key(1, "_thumb"), key(3)])
+    assert not await storage.exists(key(2))
+
+
+async def test_delete_of_a_missing_key_is_quiet(storage, tmp_path):
+    await storage.delete(key(1))
+    assert await stored(storage) == {}
@@ -0,0 +1,65 @@
+from tests.support import Clock
+from tokens import BloomFilter, MemoryBackend, RevocationList, bloom_positions
+
+PERIOD = 100
+
+
+def test_bloom_positions_are_stable_and_in_range():
+    positions = bloom_positions("jti", 1000, 7)
+    assert positions == bloom_positions("jti", 1000, 7)
+    assert len(positions) == 7
+    assert all(0 <= position < 1000 for position in positions)
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives():
+    bloom = BloomFilter(1 << 14, 5)
+    added = [f"added-{i}" for i in range(1000)]
+    for item in added:
+        bloom.add(item)
+
+    assert all(item in bloom for item in added)
+    # about 0.13% expected at this size
+    false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+    assert false_positives < 100
+
+
+def test_empty_bloom_filter_contains_nothing():
+    assert "jti" not in BloomFilter(64, 3)
+
+
+async def test_revoke_then_is_revoked():
+    backend = MemoryBackend(1 << 12, 5, PERIOD, clock=Clock())
+
+    assert await backend.revoke("a", 1050)
+    assert await backend.is_revoked("a", 1050)
+    assert not await backend.is_revoked("b", 1050)
+    # the exp picks the group, a jti is only found with its own token's exp
+    assert not await backend.is_revoked("a", 1250)
+    # second use of a single-use token
+    assert not await backend.revoke("a", 1050)
+
+
+async def test_groups_of_expired_tokens_are_pruned():
+    clock = Clock()
+    backend = MemoryBackend(1 << 12, 5, PERIOD, clock=clock)
+    await backend.revoke("expiring", 1050)
+    await backend.revoke("lasting", 1150)
+
+    # every token of the first group has expired by now
+    clock.now = 1100
+    await backend.revoke("new", 1190)
+
+    assert sorted(backend._groups) == [11]
+    assert not await backend.is_revoked("expiring", 1050)
+    assert await backend.is_revoked("lasting", 1150)
+    assert await backend.is_revoked("new", 1190)
+
+
+async def test_revocation_list_counts_first_revocations():
+    revocations = RevocationList(MemoryBackend(1 << 12, 5, PERIOD, clock=Clock()))
+    claims = {"jti": "a", "exp": 1050}
+
+    assert await revocations.revoke(claims)
+    assert not await revocations.revoke(claims)
+    assert await revocations.is_revoked(claims)
+    assert revocations.revoked == 1
@@ -0,0 +1,44 @@
+import pytest
+
+from config import get_settings
+from images import MULTIPART_OVERHEAD
+
+MAX_SIZE = 1024
+
+
+@pytest.fixture
+def max_upload_size(monkeypatch):
+    monkeypatch.setattr(get_settings(), "MAX_UPLOAD_SIZE", MAX_SIZE)
+    return MAX_SIZE
+
+
+async def test_content_length_over_the_limit_is_refused_unread(client, max_upload_size):
+    # no token: a 413 rather than a 401 means the endpoint never ran
+    response = await client.post("/uploadfile/profile",
+                                 files={"file": ("a.png", b"x" * (MAX_SIZE + MULTIPART_OVERHEAD))})
+    assert response.status_code == 413
+    assert response.json() == {"detail": f"File larger than {MAX_SIZE} bytes"}
+
+
+async def test_body_without_content_length_is_cut_off(client, max_upload_size):
+    sent = 0
+
+    async def body():
+        nonlocal sent
+        yield (b'--b\r\nContent-Disposition: form-data; name="file"; filename="a.png"\r\n'
+               b"Content-Type: image/png\r\n\r\n")
+        for _ in range(100):
+            sent += 1
+            yield b"x" * MAX_SIZE
+        yield b"\r\n--b--\r\n"
+
+    response = await client.post("/uploadfile/profile", content=body(),
+                                 headers={"Content-Type": "multipart/form-data; boundary=b"})
+    assert response.status_code == 413
+    assert sent < 100
+
+
+async def test_upload_under_the_limit_reaches_the_endpoint(client, max_upload_size):
+    response = await client.post("/uploadfile/profile",
+                                 files={"file": ("a.png", b"x" * MAX_SIZE)})
+    assert response.status_code == 401
@@ -0,0 +1,187 @@
+"""
+signed, expiring tokens and the list of revoked ones
+
+every token is an HS256 JWT with a type, an exp and a random jti.
+Access tokens carry the claims the endpoints authorize with, so
+checking one costs no query; refresh tokens and the single-use email
+tokens are revoked the moment they are used, and logging out revokes
+both halves of a session.
+
+the revocation list keeps a bloom filter in front of the exact jtis: a
+token nobody revoked, which is nearly every token checked, fails one of
+a handful of bit lookups and is answered without touching the rest.
+Entries are grouped by the period their token expires in, so a whole
+group is dropped once all of its tokens are dead anyway.
+"""
+import hashlib
+import secrets
+import time
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+import jwt
+
+from config import get_settings
+
+ACCESS = "access"
+REFRESH = "refresh"
+VERIFY_EMAIL = "verify_email"
+PASSWORD_RESET = "password_reset"
+
+
+def encode(token_type: str, ttl: int, **claims: Any) -> str:
+    now = int(time.time())
+    claims.update(type=token_type, iat=now, exp=now + ttl, jti=secrets.token_urlsafe(12))
+    return jwt.encode(claims, get_settings().SECRET, algorithm="HS256")
+
+
+def decode(token: str, token_type: str) -> Dict[str, Any]:
+    '''claims of an unexpired token of this type, or jwt.InvalidTokenError'''
+    claims = jwt.decode(token, get_settings().SECRET, algorithms=["HS256"],
+                        options={"require": ["exp", "jti", "type"]})
+    if claims["type"] != token_type:
+        raise jwt.InvalidTokenError(f"expected a {token_type} token")
+    return claims
+
+
+def email_token(user, purpose: str) -> str:
+    '''the token in a mail link, for VERIFY_EMAIL or PASSWORD_RESET'''
+    return encode(purpose, get_settings().EMAIL_TOKEN_TTL, id=user.id, email=user.email)
+
+
+def bloom_positions(item: str, bits: int, hashes: int) -> List[int]:
+    '''`hashes` bit positions for `item`, double hashing one blake2b digest'''
+    digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+    first = int.from_bytes(digest[:8], "little")
+    second = int.from_bytes(digest[8:], "little") | 1
+    return [(first + i * second) % bits for i in range(hashes)]
+
+
+class BloomFilter:
+    def __init__(self, bits: int, hashes: int) -> None:
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def add(self, item: str) -> None:
+        for position in bloom_positions(item, self.bits, self.hashes):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._array[position >> 3] & (1 << (position & 7))
+                   for position in bloom_positions(item, self.bits, self.hashes))
+
+
+class MemoryBackend:
+    '''per-process list; with several workers a token revoked in one is
+    still accepted by the others, and a restart forgets everything'''
+
+    def __init__(self, bits: int, hashes: int, period: int,
+                 clock: Callable[[], float] = time.time) -> None:
+        self.bits = bits
+        self.hashes = hashes
+        self.period = period
+        self.clock = clock
+        # expiry period -> (filter, exact jtis)
+        self._groups: Dict[int, Tuple[BloomFilter, Set[str]]] = {}
+
+    def _prune(self) -> None:
+        current = int(self.clock() // self.period)
+        for group in [group for group in self._groups if group < current]:
+            del self._groups[group]
+
+    async def revoke(self, jti: str, exp: int) -> bool:
+        self._prune()
+        group = self._groups.get(exp // self.period)
+        if group is None:
+            group = self._groups[exp // self.period] = (BloomFilter(self.bits, self.hashes), set())
+        bloom, exact = group
+        if jti in exact:
+            return False
+        bloom.add(jti)
+        exact.add(jti)
+        return True
+
+    async def is_revoked(self, jti: str, exp: int) -> bool:
+        group = self._groups.get(exp // self.period)
+        return group is not None and jti in group[0] and jti in group[1]
+
+
+# KEYS[1] the group's filter bitmap, KEYS[2] the jti; ARGV[1] when the
+# group expires, ARGV[2] when the token does, ARGV[3..] bit positions.
+# SET NX makes a second use of the same token lose, across workers.
+REVOKE_SCRIPT = """
+if not redis.call("SET", KEYS[2], "1", "NX") then
+    return 0
+end
+redis.call("EXPIREAT", KEYS[2], ARGV[2])
+for i = 3, #ARGV do
+    redis.call("SETBIT", KEYS[1], ARGV[i], 1)
+end
+redis.call("EXPIREAT", KEYS[1], ARGV[1])
+return 1
+"""
+
+# same keys, ARGV bit positions; one round trip either way
+CHECK_SCRIPT = """
+for i = 1, #ARGV do
+    if redis.call("GETBIT", KEYS[1], ARGV[i]) == 0 then
+        return 0
+    end
+end
+return redis.call("EXISTS", KEYS[2])
+"""
+
+
+class RedisBackend:
+    '''shared by every worker; keys expire with the tokens they revoke'''
+
+    def __init__(self, redis, bits: int, hashes: int, period: int,
+                 prefix: str = "revoked:") -> None:
+        self.bits = bits
+        self.hashes = hashes
+        self.period = period
+        self.prefix = prefix
+        self._revoke = redis.register_script(REVOKE_SCRIPT)
+        self._check = redis.register_script(CHECK_SCRIPT)
+
+    def _keys(self, jti: str, exp: int) -> List[str]:
+        return [f"{self.prefix}bloom:{exp // self.period}", f"{self.prefix}jti:{jti}"]
+
+    async def revoke(self, jti: str, exp: int) -> bool:
+        group_expires = (exp // self.period + 1) * self.period
+        return bool(await self._revoke(
+            keys=self._keys(jti, exp),
+            args=[group_expires, exp, *bloom_positions(jti, self.bits, self.hashes)]))
+
+    async def is_revoked(self, jti: str, exp: int) -> bool:
+        return bool(await self._check(keys=self._keys(jti, exp),
+                                      args=bloom_positions(jti, self.bits, self.hashes)))
+
+
+class RevocationList:
+    def __init__(self, backend) -> None:
+        self.backend = backend
+        self.revoked = 0
+
+    async def revoke(self, claims: Dict[str, Any]) -> bool:
+        '''False when the token was already revoked, e.g. a reused refresh token'''
+        revoked = await self.backend.revoke(claims["jti"], claims["exp"])
+        self.revoked += revoked
+        return revoked
+
+    async def is_revoked(self, claims: Dict[str, Any]) -> bool:
+        return await self.backend.is_revoked(claims["jti"], claims["exp"])
+
+
+@lru_cache()
+def get_revocations() -> RevocationList:
+    settings = get_settings()
+    # no token outlives this, so at most two groups are alive at once
+    period = max(settings.ACCESS_TOKEN_TTL, settings.REFRESH_TOKEN_TTL, settings.EMAIL_TOKEN_TTL)
+    options = dict(bits=settings.REVOCATION_BLOOM_BITS,
+                   hashes=settings.REVOCATION_BLOOM_HASHES, period=period)
+    if settings.backend("REVOCATION_BACKEND") == "redis":
+        from cache import get_redis
+        return RevocationList(RedisBackend(get_redis(), **options))
+    return RevocationList(MemoryBackend(**options))
@@ -0,0 +1,79 @@
+"""
+bounded executors for CPU-bound work (bcrypt, PIL) and periodic jobs
+"""
+import asyncio
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+
+from fastapi import HTTPException, status
+
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    '''runs blocking functions off the event loop
+
+    once `max_pending` jobs are in flight new callers get a 503 instead of
+    queueing behind a burst; pass `admit=False` for work that was already
+    accepted (e.g. a background task scheduled after `check()`)'''
+
+    def __init__(self, name: str, workers: int, max_pending: int, kind: str = "thread"):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self.kind = kind
+        self.pending = 0
+        self.rejected = 0
+        self._executor: Optional[Executor] = None
+
+    @property
+    def executor(self) -> Executor:
+        # created on first use so importing a module never forks
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix=self.name)
+        return self._executor
+
+    def check(self) -> None:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, try again later",
+                headers={"Retry-After": "1"}
+            )
+
+    async def run(self, func, *args, admit: bool = True):
+        if admit:
+            self.check()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            with timed(self.name):
+                return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+async def run_periodically(interval: float, job: Callable[[], Awaitable]) -> None:
+    '''await `job` every `interval` seconds until cancelled; a failing
+    run is logged and retried on the next tick'''
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("periodic job %s failed", job.__name__)